@@ -0,0 +1,161 @@
+"""SSE coalescing end to end: frames, CPU on both sides, and added latency
+
+Streams --tokens content lines into a GenerationStream at --rate tokens/sec,
+pausing --pause seconds every --burst tokens (a model stalling mid-reply),
+while a reader thread follows it like a client: follow() on the server
+side, then parsing every SSE frame and re-rendering the whole reply at
+most once per animation frame, like static/assistant.js does. The render
+is a Python stand-in for marked.parse(), so compare its cost across rows
+rather than reading it as browser time.
+
+Each --coalesce setting runs twice: "next-chunk" holds content until the
+next chunk arrives, as before readers flushed it on a deadline, and
+"deadline" is the current behaviour. Latency is how long each token took
+from arriving upstream to being parsed by the client.
+
+    python bench/coalesce.py
+    python bench/coalesce.py --coalesce 0,50,100 --rate 200 --pause 1
+"""
+
+import argparse
+import html
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(tempfile.mkdtemp(prefix="light-bench-"))
+os.environ.setdefault("WARMUP_ENABLED", "0")
+os.environ.setdefault("METRICS_DIR", "")
+os.environ.setdefault("OLLAMA_PROBE_INTERVAL", "3600")   # no Ollama needed
+
+import main  # noqa: E402
+
+ANIMATION_FRAME = 1 / 60
+INLINE = re.compile(r"(\*\*[^*]+\*\*|`[^`]+`)")
+
+
+def line(i: int) -> bytes:
+    return json.dumps({"model": main.MODEL, "message": {"role": "assistant", "content": f"w{i} "},
+                       "done": False}, separators=(",", ":")).encode()
+
+
+def render(text: str) -> str:
+    """Stand-in for marked.parse(): escape, inline markup, paragraphs"""
+    text = INLINE.sub(lambda m: f"<b>{m.group(0)}</b>", html.escape(text))
+    return "".join(f"<p>{p}</p>" for p in text.split("\n\n"))
+
+
+class Client:
+    """Reads a stream through follow() and does the browser's share of the work"""
+
+    def __init__(self, stream: main.GenerationStream, arrivals: list):
+        self.stream = stream
+        self.arrivals = arrivals
+        self.frames = 0
+        self.bytes = 0
+        self.renders = 0
+        self.latencies = []
+        self.cpu = 0.0          # parse and render
+        self.server_cpu = 0.0   # follow() itself
+
+    def run(self):
+        reply = ""
+        last_render = 0.0
+        started = time.thread_time()
+        for text in main.follow(self.stream):
+            received = time.monotonic()
+            t0 = time.thread_time()
+            self.bytes += len(text)
+            for frame in text.split("\n\n"):
+                data = next((l[6:] for l in frame.split("\n") if l.startswith("data: ")), None)
+                if data is None:
+                    continue
+                content = json.loads(data).get("content")
+                if not content:
+                    continue
+                self.frames += 1
+                reply += content
+                for token in content.split():
+                    self.latencies.append(received - self.arrivals[int(token[1:])])
+            if received - last_render >= ANIMATION_FRAME:
+                render(reply)
+                self.renders += 1
+                last_render = received
+            self.cpu += time.thread_time() - t0
+        render(reply)
+        self.renders += 1
+        self.server_cpu = time.thread_time() - started - self.cpu
+
+
+def measure(coalesce_ms: float, deadline: bool, args) -> dict:
+    payload = {"model": main.MODEL, "messages": [], "stream": True}
+    turn = main.ChatTurn("bench@example.com", {"id": "bench"}, {"role": "user", "content": "hi"},
+                         payload, coalesce_ms=coalesce_ms)
+    stream = main.GenerationStream("bench@example.com", turn)
+    if not deadline:
+        stream.flush_held = lambda: None
+    arrivals = [0.0] * args.tokens
+    client = Client(stream, arrivals)
+    reader = threading.Thread(target=client.run)
+    reader.start()
+
+    cpu = 0.0
+    interval = 1 / args.rate
+    due = time.monotonic()
+    for i in range(args.tokens):
+        if i and i % args.burst == 0:
+            due += args.pause
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        due += interval
+        arrivals[i] = time.monotonic()
+        t0 = time.thread_time()
+        stream.push(turn.feed, line(i))
+        cpu += time.thread_time() - t0
+    stream.push(lambda: [turn.flush()] if turn.pending else [])
+    stream.finish()
+    reader.join()
+
+    latencies = sorted(client.latencies)
+    return {
+        "frames": client.frames,
+        "bytes": client.bytes,
+        "server_cpu": cpu + client.server_cpu,
+        "client_cpu": client.cpu,
+        "renders": client.renders,
+        "p50": latencies[len(latencies) // 2],
+        "p99": latencies[int(len(latencies) * 0.99)],
+        "max": latencies[-1],
+    }
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--coalesce", default="0,25,50,100", help="SSE_COALESCE_MS values to compare")
+    parser.add_argument("--rate", type=float, default=100, help="tokens/sec while generating")
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--burst", type=int, default=50, help="tokens between pauses")
+    parser.add_argument("--pause", type=float, default=0.5, help="seconds upstream goes quiet")
+    args = parser.parse_args()
+
+    print(f"{args.tokens} tokens at {args.rate:.0f}/s, {args.pause}s pause every {args.burst}")
+    print(f"{'ms':>5} {'flush':<11} {'frames':>7} {'KiB':>7} {'server CPU':>11} {'client CPU':>11} "
+          f"{'renders':>8} {'p50 lat':>9} {'p99 lat':>9} {'max lat':>9}")
+    for coalesce_ms in (float(c) for c in args.coalesce.split(",")):
+        for mode, deadline in (("next-chunk", False), ("deadline", True)):
+            r = measure(coalesce_ms, deadline, args)
+            print(f"{coalesce_ms:>5.0f} {mode:<11} {r['frames']:>7} {r['bytes'] / 1024:>7.1f} "
+                  f"{r['server_cpu'] * 1e3:>9.1f}ms {r['client_cpu'] * 1e3:>9.1f}ms {r['renders']:>8} "
+                  f"{r['p50'] * 1e3:>7.1f}ms {r['p99'] * 1e3:>7.1f}ms {r['max'] * 1e3:>7.1f}ms")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,160 @@
+"""User lookups in the old flat and the new sharded data directory layouts
+
+For each size in --sizes, builds that many users (a directory holding a
+small index.json) in a temp dir twice: flat as data/<safe_email>, and
+sharded as data/ab/cd/<safe_email> through JSONUserStorage itself. Then
+it times, per layout:
+
+  lookup    resolving and reading index.json for --lookups random existing users
+  create    resolving the directory for --lookups new users
+  scan      list_users()-style glob over every index.json
+
+Flat lookups use the old get_user_dir() (mkdir(exist_ok=True) on every
+call); sharded ones start from an empty per-process directory cache, as
+after a restart.
+
+    python bench/dir_layout.py
+    python bench/dir_layout.py --sizes 10000,100000 --drop-caches
+
+1M users needs a few million inodes and several minutes per layout.
+--drop-caches (root only) empties the page cache before each timing, for
+cold-disk numbers.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(tempfile.mkdtemp(prefix="light-bench-"))
+os.environ.setdefault("WARMUP_ENABLED", "0")
+os.environ.setdefault("METRICS_DIR", "")
+
+import main  # noqa: E402
+
+
+def safe(email: str) -> str:
+    return email.replace("@", "_at_").replace(".", "_")
+
+
+def email(i: int) -> str:
+    return f"user{i}@example.com"
+
+
+class Flat:
+    """The layout before sharding: every user directly under data/"""
+
+    name = "flat"
+
+    def __init__(self, data_dir: Path):
+        self.data_dir = data_dir
+        data_dir.mkdir(parents=True)
+
+    def user_dir(self, email: str) -> Path:
+        user_dir = self.data_dir / safe(email)
+        user_dir.mkdir(exist_ok=True)
+        return user_dir
+
+    def reset(self):
+        pass
+
+    def scan(self) -> int:
+        return sum(1 for _ in self.data_dir.glob(f"*/{main.JSONUserStorage.INDEX_FILE}"))
+
+
+class Sharded:
+    """The current layout, resolved by JSONUserStorage"""
+
+    name = "sharded"
+
+    def __init__(self, data_dir: Path):
+        data_dir.mkdir(parents=True)
+        self.storage = main.JSONUserStorage(data_dir, cache_mode="off")
+
+    def user_dir(self, email: str) -> Path:
+        return self.storage.get_user_dir(email)
+
+    def reset(self):
+        main.JSONUserStorage._resolve_user_dir.cache_clear()
+
+    def scan(self) -> int:
+        return sum(1 for _ in self.storage.data_dir.glob(f"*/*/*/{main.JSONUserStorage.INDEX_FILE}"))
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def timed(fn, cold: bool) -> float:
+    if cold:
+        drop_caches()
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def build(layout, users: int) -> float:
+    started = time.perf_counter()
+    for i in range(users):
+        index = layout.user_dir(email(i)) / main.JSONUserStorage.INDEX_FILE
+        index.write_text(json.dumps({"email": email(i), "conversations": []}), encoding="utf-8")
+    return time.perf_counter() - started
+
+
+def widest_dir(data_dir: Path) -> int:
+    widest = len(os.listdir(data_dir))
+    for entry in os.scandir(data_dir):
+        if entry.is_dir() and len(entry.name) == 2:
+            for sub in os.scandir(entry.path):
+                widest = max(widest, len(os.listdir(sub.path)))
+    return widest
+
+
+def run_size(users: int, lookups: int, cold: bool, scan: bool):
+    sample = [email(i) for i in random.sample(range(users), min(lookups, users))]
+    new = [email(users + i) for i in range(lookups)]
+    for layout_class in (Flat, Sharded):
+        work = Path(tempfile.mkdtemp(prefix="light-layout-"))
+        layout = layout_class(work / "data")
+        build_seconds = build(layout, users)
+
+        layout.reset()
+        lookup = timed(lambda: [(layout.user_dir(e) / main.JSONUserStorage.INDEX_FILE).read_bytes()
+                                for e in sample], cold)
+        layout.reset()
+        create = timed(lambda: [layout.user_dir(e) for e in new], cold)
+        line = (f"{users:>9} {layout.name:<8} build {build_seconds:>7.1f}s  "
+                f"lookup {lookup / len(sample) * 1e6:>7.1f}us  create {create / len(new) * 1e6:>7.1f}us  "
+                f"widest dir {widest_dir(work / 'data'):>8}")
+        if scan:
+            scan_seconds = timed(layout.scan, cold)
+            line += f"  scan {scan_seconds:>6.1f}s"
+        print(line, flush=True)
+        shutil.rmtree(work)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--drop-caches", action="store_true", help="time against a cold page cache (root only)")
+    parser.add_argument("--no-scan", action="store_true", help="skip the full directory scan")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    for users in (int(n) for n in args.sizes.split(",")):
+        run_size(users, args.lookups, args.drop_caches, not args.no_scan)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,83 @@
+"""Per-chunk CPU of relaying Ollama's stream, parse vs passthrough
+
+Feeds ChatTurn compact NDJSON content lines, shaped like the ones Ollama
+sends, paced at each --rates tokens/sec for --seconds, once with every
+line decoded (STREAM_RELAY=parse) and once in passthrough mode. The CPU
+time of the feed() calls is measured with the thread's CPU clock, so the
+pacing sleeps don't count, and SSE coalescing sees real arrival times.
+
+    python bench/relay.py
+    python bench/relay.py --rates 50,200,1000 --seconds 10
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(tempfile.mkdtemp(prefix="light-bench-"))
+os.environ.setdefault("WARMUP_ENABLED", "0")
+os.environ.setdefault("METRICS_DIR", "")
+os.environ.setdefault("OLLAMA_PROBE_INTERVAL", "3600")   # no Ollama needed
+
+import main  # noqa: E402
+
+WORDS = [" the", " model", " streams", " tokens", " quickly", ",", " and", " \"quotes\"", " café", "\n"]
+
+
+def lines(count: int) -> list:
+    """Content chunks as Ollama writes them (Go's encoding/json, no spaces)"""
+    return [json.dumps({"model": main.MODEL, "created_at": "2026-10-15T09:00:00.123456789Z",
+                        "message": {"role": "assistant", "content": WORDS[i % len(WORDS)]},
+                        "done": False}, separators=(",", ":")).encode()
+            for i in range(count)]
+
+
+def new_turn(relay: bool) -> main.ChatTurn:
+    payload = {"model": main.MODEL, "messages": [], "stream": True}
+    return main.ChatTurn("bench@example.com", {"id": "bench"}, {"role": "user", "content": "hi"},
+                         payload, relay=relay)
+
+
+def measure(relay: bool, rate: float, seconds: float) -> dict:
+    chunks = lines(max(1, int(rate * seconds)))
+    turn = new_turn(relay)
+    interval = 1 / rate
+    cpu = 0.0
+    frames = 0
+    started = time.perf_counter()
+    for i, line in enumerate(chunks):
+        # Pace arrivals like a model generating at `rate` tokens/sec
+        delay = started + i * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        t0 = time.thread_time()
+        frames += len(turn.feed(line))
+        cpu += time.thread_time() - t0
+    wall = time.perf_counter() - started
+    return {"chunks": len(chunks), "frames": frames, "cpu": cpu, "wall": wall}
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rates", default="50,200,1000", help="tokens/sec")
+    parser.add_argument("--seconds", type=float, default=5, help="stream length per rate and mode")
+    args = parser.parse_args()
+
+    print(f"SSE_COALESCE_MS={main.SSE_COALESCE_MS} SSE_COALESCE_BYTES={main.SSE_COALESCE_BYTES}")
+    print(f"{'tok/s':>6} {'mode':<12} {'chunks':>7} {'frames':>7} {'CPU/chunk':>10} {'CPU/stream':>11}")
+    for rate in (float(r) for r in args.rates.split(",")):
+        for mode, relay in (("parse", False), ("passthrough", True)):
+            result = measure(relay, rate, args.seconds)
+            print(f"{rate:>6.0f} {mode:<12} {result['chunks']:>7} {result['frames']:>7} "
+                  f"{result['cpu'] / result['chunks'] * 1e6:>8.2f}us "
+                  f"{result['cpu'] / result['wall'] * 100:>9.3f}%")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,206 @@
+"""Concurrent chat streams and memory per stream, threaded vs ASGI serving
+
+Starts the app in a subprocess in each SERVER_MODE against a local fake
+Ollama that streams slowly, then holds N chat streams open at once for
+each N in --levels. For every level it reports how many streams got
+their first token within --timeout, the time to that token, and the
+server's resident memory and thread count while all streams are open.
+The highest level where every stream started is the mode's capacity.
+
+    python bench/stream_capacity.py
+    python bench/stream_capacity.py --modes asgi --levels 100,500,1000,2000
+
+Linux only: memory and threads are read from /proc. Needs httpx, and
+asgiref and uvicorn for the asgi mode.
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from flask import Flask
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "tests"))
+
+from fake_ollama import FakeOllama  # noqa: E402
+
+SECRET = "stream-capacity-bench"
+
+SERVE = """
+import sys, main
+port = int(sys.argv[1])
+if main.SERVER_MODE == "asgi":
+    import uvicorn
+    uvicorn.run(main.asgi_app, host="127.0.0.1", port=port, log_level="warning")
+else:
+    main.app.run(host="127.0.0.1", port=port, threaded=True)
+"""
+
+
+def raise_fd_limit():
+    """Every stream holds a client and an upstream socket open"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def session_cookie(email: str) -> str:
+    """A signed Flask session cookie, as the OAuth callback would set it"""
+    app = Flask("bench")
+    app.secret_key = SECRET
+    return app.session_interface.get_signing_serializer(app).dumps({"email": email, "name": "Bench"})
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def proc_status(pid: int) -> dict:
+    status = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            status[key] = value.split()[0] if value.split() else ""
+    return {"rss_kb": int(status["VmRSS"]), "threads": int(status["Threads"])}
+
+
+def start_server(mode: str, fake: FakeOllama, max_streams: int) -> tuple:
+    port = free_port()
+    env = dict(os.environ,
+               SERVER_MODE=mode,
+               OLLAMA_URL=fake.url,
+               FLASK_SECRET_KEY=SECRET,
+               OLLAMA_MAX_CONCURRENCY=str(max_streams),
+               CHAT_MAX_QUEUE=str(max_streams),
+               OLLAMA_POOL_SIZE=str(max_streams),
+               STREAM_CANCEL_GRACE="0",
+               WARMUP_ENABLED="0",
+               METRICS_DIR="",
+               PYTHONPATH=str(ROOT))
+    server = subprocess.Popen([sys.executable, "-c", SERVE, str(port)], env=env,
+                              cwd=tempfile.mkdtemp(prefix="light-bench-"),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"{url}/health", timeout=1)
+            return server, url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.kill()
+    raise SystemExit(f"{mode} server did not start")
+
+
+async def open_stream(client: httpx.AsyncClient, url: str, i: int, ready: list,
+                      release: asyncio.Event, timeout: float):
+    """Seconds to the first token, or None; then keep reading until released
+
+    Leaving the line iterator closes the connection, which the server
+    rightly treats as the client going away.
+    """
+    t0 = time.perf_counter()
+    cookies = {"session": session_cookie(f"bench{i}@example.com")}
+    first = None
+    try:
+        async with client.stream("POST", f"{url}/api/chat", json={"message": f"Question {i}"},
+                                 cookies=cookies) as response:
+            if response.status_code == 200:
+                async for line in response.aiter_lines():
+                    if first is None and line.startswith("data:") and '"content"' in line:
+                        first = time.perf_counter() - t0
+                        if first > timeout:
+                            first = None
+                            break
+                        ready.append(first)
+                    if release.is_set():
+                        break
+    except httpx.HTTPError:
+        pass
+    if first is None:
+        ready.append(None)
+    return first
+
+
+async def level(url: str, pid: int, n: int, timeout: float) -> dict:
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=0)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(timeout, read=timeout)) as client:
+        ready, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(open_stream(client, url, i, ready, release, timeout)) for i in range(n)]
+        # Sample the server once every stream has started or given up
+        deadline = time.monotonic() + timeout
+        while len(ready) < n and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        status = proc_status(pid)
+        release.set()
+        results = await asyncio.gather(*tasks)
+    firsts = [r for r in results if r is not None]
+    return {"n": n, "ok": len(firsts), "firsts": firsts, **status}
+
+
+def run_mode(mode: str, levels: list, timeout: float, settle: float) -> list:
+    fake = FakeOllama(tokens=100_000, delay=0.05)
+    server, url = start_server(mode, fake, max(levels))
+    rows = []
+    try:
+        baseline = proc_status(server.pid)
+        print(f"\n{mode}: idle RSS {baseline['rss_kb'] / 1024:.1f}MB, {baseline['threads']} threads")
+        print(f"{'streams':>8} {'started':>8} {'TTFT p50':>9} {'TTFT p95':>9} "
+              f"{'RSS MB':>8} {'KB/stream':>10} {'threads':>8}")
+        for n in levels:
+            row = asyncio.run(level(url, server.pid, n, timeout))
+            firsts = row["firsts"]
+            per_stream = (row["rss_kb"] - baseline["rss_kb"]) / row["ok"] if row["ok"] else float("nan")
+            print(f"{n:>8} {row['ok']:>8} {percentile(firsts, 0.5) * 1000:>7.0f}ms "
+                  f"{percentile(firsts, 0.95) * 1000:>7.0f}ms "
+                  f"{row['rss_kb'] / 1024:>8.1f} {per_stream:>10.1f} {row['threads']:>8}")
+            rows.append(row)
+            # Let the server notice the disconnects before the next level
+            time.sleep(settle)
+            if row["ok"] < n:
+                break
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        fake.stop()
+    capacity = max((r["n"] for r in rows if r["ok"] == r["n"]), default=0)
+    print(f"{mode}: every stream started up to {capacity} concurrent streams")
+    return rows
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", default="threaded,asgi")
+    parser.add_argument("--levels", default="50,100,200,400,800")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds a stream may take to start")
+    parser.add_argument("--settle", type=float, default=3, help="pause between levels")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    levels = [int(n) for n in args.levels.split(",")]
+    for mode in args.modes.split(","):
+        run_mode(mode.strip(), levels, args.timeout, args.settle)
+
+
+if __name__ == "__main__":
+    run()
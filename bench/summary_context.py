@@ -0,0 +1,138 @@
+"""Prompt size and time to first token with and without rolling summaries
+
+Builds a synthetic conversation of --turns turns and compares three
+prompts for the next turn: the whole history untrimmed, the context
+window start_chat_turn() builds with summaries off, and the same with the
+history that fell out of the window folded into a summary. Prompt tokens are reported from the local
+estimate and, against a reachable Ollama, as prompt_eval_count together
+with the time to the first streamed token.
+
+    python bench/summary_context.py --turns 200 --runs 3
+    OLLAMA_URL=http://gpu-box:11434 python bench/summary_context.py
+
+Without Ollama, only the estimates are printed, using a placeholder summary
+of SUMMARY_MAX_TOKENS.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(tempfile.mkdtemp(prefix="light-bench-"))
+os.environ.setdefault("WARMUP_ENABLED", "0")
+os.environ["STORAGE_CACHE_MODE"] = "writethrough"
+
+import main  # noqa: E402
+
+WORDS = ("model context window token summary latency cache request stream server user "
+         "question answer python flask storage index message history prompt budget").split()
+
+
+def sentence(i: int, words: int) -> str:
+    return " ".join(WORDS[(i * 7 + k * 3) % len(WORDS)] for k in range(words)) + "."
+
+
+def build_conversation(email: str, turns: int) -> str:
+    conv_id = main.storage.get_active_conversation(email)["id"]
+    for i in range(turns):
+        question = f"Question {i}: " + sentence(i, 40)
+        answer = f"Answer {i}: " + " ".join(sentence(i + k, 30) for k in range(4))
+        main.storage.append_messages(email, conv_id, [
+            {"role": "user", "content": question, "tokens": main.estimate_tokens(question)},
+            {"role": "assistant", "content": answer, "tokens": main.estimate_tokens(answer)},
+        ])
+    return conv_id
+
+
+def first_token(payload: dict) -> tuple:
+    """(seconds to the first content chunk, prompt_eval_count) for one streamed chat"""
+    started = time.perf_counter()
+    ttft = None
+    prompt_eval = None
+    with main.ollama.chat(payload) as (_, response):
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if ttft is None and chunk.get("message", {}).get("content"):
+                ttft = time.perf_counter() - started
+            if chunk.get("done"):
+                prompt_eval = chunk.get("prompt_eval_count")
+    return ttft, prompt_eval
+
+
+def full_history_payload(email: str, conv_id: str, message: str) -> dict:
+    """The whole conversation, untrimmed, with num_ctx raised to fit it"""
+    history = main.storage.load_messages(email, conv_id)
+    messages = [{"role": "system", "content": main.SYSTEM_PROMPT}]
+    messages += [{"role": m["role"], "content": m["content"]} for m in history]
+    messages.append({"role": "user", "content": message})
+    tokens = sum(main.message_tokens(m) for m in messages)
+    return {"model": main.MODEL, "messages": messages, "stream": True,
+            "options": {"temperature": main.CHAT_TEMPERATURE, "num_ctx": tokens + 512}}
+
+
+def measure(label: str, email: str, runs: int, online: bool, conv_id: str = None):
+    estimates, ttfts, evals = [], [], []
+    for run in range(runs):
+        message = f"Follow-up {run}: what did we decide about the cache?"
+        if conv_id is not None:
+            payload = full_history_payload(email, conv_id, message)
+        else:
+            payload = main.start_chat_turn(email, message).payload
+        payload["options"]["num_predict"] = 8
+        estimates.append(sum(main.message_tokens(m) for m in payload["messages"]))
+        if online:
+            ttft, prompt_eval = first_token(payload)
+            ttfts.append(ttft)
+            evals.append(prompt_eval)
+    line = f"{label:<20} prompt ~{statistics.median(estimates):>6.0f} tokens"
+    if online:
+        line += (f"  evaluated {statistics.median(e or 0 for e in evals):>6.0f}"
+                 f"  TTFT median {statistics.median(ttfts) * 1000:>7.0f}ms"
+                 f"  first run {ttfts[0] * 1000:>7.0f}ms")
+    print(line)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    online = main.ollama.is_online()
+    print(f"{args.turns} turns, NUM_CTX={main.NUM_CTX}, model {main.MODEL}, "
+          f"Ollama {'online' if online else 'offline (estimates only)'}")
+
+    email = "bench@example.com"
+    conv_id = build_conversation(email, args.turns)
+
+    main.summarizer = None
+    measure("full history", email, args.runs, online, conv_id)
+    measure("window, no summary", email, args.runs, online)
+
+    # The history before the context window, as the server would summarize it
+    first_seq = main.start_chat_turn(email, "probe").first_context_seq
+    summarizer = main.Summarizer(main.SUMMARY_MIN_MESSAGES, main.SUMMARY_MAX_TOKENS)
+    main.summarizer = summarizer
+    started = time.perf_counter()
+    if online:
+        summarizer.update(email, conv_id, first_seq)
+        print(f"summarized {first_seq} messages in {time.perf_counter() - started:.1f}s")
+    else:
+        text = sentence(0, int(main.SUMMARY_MAX_TOKENS * 0.75))
+        main.storage.set_summary(email, conv_id, {"text": text, "upto_seq": first_seq,
+                                                  "tokens": main.estimate_tokens(text)})
+    measure("with summary", email, args.runs, online)
+
+
+if __name__ == "__main__":
+    run()
@@ -8,13 +8,55 @@ import secrets
 import json
 import logging
 import base64
+import sqlite3
+import threading
+import time
+import atexit
+import tempfile
+import queue
+import hashlib
+import socket
+import asyncio
+import re
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from itertools import islice
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime, timedelta
 from pathlib import Path
+from urllib.parse import parse_qsl
 from dotenv import load_dotenv
-from flask import Flask, redirect, url_for, session, render_template, request, jsonify, Response
+import click
+from flask import Flask, redirect, url_for, session, render_template, request, jsonify, Response, g
 from authlib.integrations.flask_client import OAuth
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie
+
+try:
+    import fcntl
+except ImportError:  # Windows: cross-process locking is unavailable
+    fcntl = None
+
+# Async serving mode (SERVER_MODE=asgi) needs httpx and asgiref
+try:
+    import httpx
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    httpx = None
+    WsgiToAsgi = None
+
+# The semantic response cache needs numpy
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Load environment variables
 load_dotenv()
@@ -38,8 +80,120 @@ FLASK_SECRET_KEY = os.getenv("FLASK_SECRET_KEY", secrets.token_hex(32))
 
 # Ollama settings
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/chat")
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "32"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "3"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "120"))
+OLLAMA_CONNECT_RETRIES = int(os.getenv("OLLAMA_CONNECT_RETRIES", "2"))
+
+# Several Ollama servers can be listed (comma-separated); defaults to OLLAMA_URL alone
+OLLAMA_URLS = [u.strip() for u in os.getenv("OLLAMA_URLS", OLLAMA_URL).split(",") if u.strip()]
+OLLAMA_STICKY = os.getenv("OLLAMA_STICKY", "1") == "1"   # keep a conversation on one backend
+OLLAMA_EJECT_SECONDS = float(os.getenv("OLLAMA_EJECT_SECONDS", "30"))
+OLLAMA_PROBE_INTERVAL = float(os.getenv("OLLAMA_PROBE_INTERVAL", "10"))
+
+# Model warm-up: MODEL is preloaded at startup and kept loaded (refreshed every
+# WARMUP_INTERVAL seconds) during WARMUP_HOURS (e.g. "8-18" or "22-6", local time) or while
+# users were active in the last WARMUP_ACTIVE_SECONDS; WARMUP_ON_PAGE preloads
+# when the assistant page is opened
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+WARMUP_KEEP_ALIVE = os.getenv("WARMUP_KEEP_ALIVE", "") or os.getenv("OLLAMA_KEEP_ALIVE", "") or "30m"
+WARMUP_INTERVAL = float(os.getenv("WARMUP_INTERVAL", "240"))
+WARMUP_HOURS = os.getenv("WARMUP_HOURS", "")
+WARMUP_ACTIVE_SECONDS = float(os.getenv("WARMUP_ACTIVE_SECONDS", "900"))
+WARMUP_ON_PAGE = os.getenv("WARMUP_ON_PAGE", "1") == "1"
+
+# Admission control: concurrent generations sent to Ollama, and how many may wait
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "4"))
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "64"))
 MODEL = os.getenv("MODEL", "llama3:latest")
 
+# Model routing: with FAST_MODEL set, simple turns go to it and MODEL is kept for
+# turns scoring ROUTER_STRONG_SCORE of: a message of ROUTER_LONG_TOKENS tokens, a
+# conversation ROUTER_DEEP_MESSAGES deep, a code fence, a ROUTER_KEYWORDS match.
+# MODEL is also skipped when it can't produce MAX_TOKENS tokens (default
+# NUM_PREDICT) in ROUTER_LATENCY_BUDGET seconds.
+FAST_MODEL = os.getenv("FAST_MODEL", "")
+ROUTER_LONG_TOKENS = int(os.getenv("ROUTER_LONG_TOKENS", "60"))
+ROUTER_DEEP_MESSAGES = int(os.getenv("ROUTER_DEEP_MESSAGES", "20"))
+ROUTER_STRONG_SCORE = int(os.getenv("ROUTER_STRONG_SCORE", "2"))
+ROUTER_LATENCY_BUDGET = float(os.getenv("ROUTER_LATENCY_BUDGET", "10"))
+MAX_TOKENS = int(os.getenv("MAX_TOKENS", os.getenv("NUM_PREDICT", "256")))
+ROUTER_KEYWORDS = [k.strip().lower() for k in os.getenv(
+    "ROUTER_KEYWORDS", "explain,why,how does,compare,analyze,code,debug,write,plan,summarize,translate"
+).split(",") if k.strip()]
+
+# Context window: history is packed newest-first into NUM_CTX minus the reply budget.
+# NUM_CTX is sent as a fixed option; changing it per request would force model reloads.
+NUM_CTX = int(os.getenv("NUM_CTX", "4096"))
+NUM_PREDICT = int(os.getenv("NUM_PREDICT", "256"))
+CHAT_TEMPERATURE = float(os.getenv("CHAT_TEMPERATURE", "0.7"))
+
+# Prompt-prefix reuse: with CONTEXT_BLOCK_MESSAGES > 0 the window's first message
+# only advances in steps of that many messages, so consecutive prompts share a
+# prefix Ollama can serve from its KV cache. OLLAMA_KEEP_ALIVE keeps the model
+# (and that cache) loaded between turns, e.g. "30m".
+CONTEXT_BLOCK_MESSAGES = int(os.getenv("CONTEXT_BLOCK_MESSAGES", "0"))
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "")
+
+# Rolling summaries of history that no longer fits in the context window
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "0") == "1"
+SUMMARY_MIN_MESSAGES = int(os.getenv("SUMMARY_MIN_MESSAGES", "6"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "256"))
+
+# Exact-match response cache (opt-in). It only applies when CHAT_TEMPERATURE is 0,
+# unless RESPONSE_CACHE_FORCE=1. Hits are replayed with REPLAY_DELAY_MS between chunks.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1"
+RESPONSE_CACHE_FORCE = os.getenv("RESPONSE_CACHE_FORCE", "0") == "1"
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_REPLAY_DELAY_MS = float(os.getenv("RESPONSE_CACHE_REPLAY_DELAY_MS", "0"))
+# With the cache enabled, a prompt identical to one still generating is answered by
+# mirroring that generation instead of running it again (RESPONSE_CACHE_COALESCE=0 disables)
+RESPONSE_CACHE_COALESCE = os.getenv("RESPONSE_CACHE_COALESCE", "1") == "1"
+
+# Semantic cache (opt-in): opening questions similar enough to an earlier one, by
+# cosine similarity of their EMBED_MODEL embeddings, are answered from it.
+# SEMANTIC_CACHE_SCOPE is "global" or "user"; past ANN_MIN_SIZE entries per index
+# the search is approximate (LSH) instead of brute force.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "0") == "1"
+EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_SCOPE = os.getenv("SEMANTIC_CACHE_SCOPE", "global").lower()
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+SEMANTIC_CACHE_ANN_MIN_SIZE = int(os.getenv("SEMANTIC_CACHE_ANN_MIN_SIZE", "2048"))
+
+# Message history paging
+MESSAGE_PAGE_SIZE = int(os.getenv("MESSAGE_PAGE_SIZE", "50"))
+MAX_MESSAGE_PAGE_SIZE = 200
+
+# SSE coalescing: streamed content is sent once SSE_COALESCE_MS have passed since the
+# last frame (even if Ollama goes quiet) or SSE_COALESCE_BYTES are buffered; the first
+# token is always sent at once.
+# SSE_COALESCE_MS=0 sends one frame per Ollama chunk.
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "0"))
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "4096"))
+
+# Relay of Ollama's NDJSON: "parse" decodes every line; "passthrough" cuts the content
+# string out of each chunk and relays its JSON literal as-is, decoding only the final chunk
+STREAM_RELAY = os.getenv("STREAM_RELAY", "parse").lower()
+OLLAMA_READ_CHUNK_SIZE = int(os.getenv("OLLAMA_READ_CHUNK_SIZE", "16384"))
+
+# Generation streams: replies are produced independently of the client; the newest
+# STREAM_BUFFER_BYTES of SSE events are kept for resuming, for STREAM_RETAIN_SECONDS
+# after the reply finishes
+STREAM_BUFFER_BYTES = int(os.getenv("STREAM_BUFFER_BYTES", "262144"))
+STREAM_RETAIN_SECONDS = float(os.getenv("STREAM_RETAIN_SECONDS", "120"))
+# Generation stops once no client has been reading for STREAM_CANCEL_GRACE seconds;
+# idle streams send a heartbeat comment so disconnects are noticed
+STREAM_CANCEL_GRACE = float(os.getenv("STREAM_CANCEL_GRACE", "15"))
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "5"))
+# Chat requests carrying the same Idempotency-Key header (per user) attach to one
+# generation while its stream is retained; longer keys are rejected
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
+# Server mode: "threaded" (Werkzeug threads) or "asgi" (uvicorn, async chat streaming)
+SERVER_MODE = os.getenv("SERVER_MODE", "threaded").lower()
+
 # URLs
 PRODUCTION_URL = os.getenv("PRODUCTION_URL", "https://assistant.itslightning.online")
 LOCAL_URL = "http://127.0.0.1:5050"
@@ -48,6 +202,31 @@ LOCAL_URL = "http://127.0.0.1:5050"
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 
+# Storage backend: "json" (per-user files under DATA_DIR) or "sqlite"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_PATH = Path(os.getenv("SQLITE_PATH", str(DATA_DIR / "light.db")))
+
+# JSON storage cache: "writeback", "writethrough" or "off"
+STORAGE_CACHE_MODE = os.getenv("STORAGE_CACHE_MODE", "writeback").lower()
+STORAGE_CACHE_MAX_USERS = int(os.getenv("STORAGE_CACHE_MAX_USERS", "1000"))
+STORAGE_CACHE_MAX_BYTES = int(os.getenv("STORAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "1.0"))
+
+# Background persistence of chat turns
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", "1000"))
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "64"))
+PERSIST_GROUP_WINDOW_MS = float(os.getenv("PERSIST_GROUP_WINDOW_MS", "5"))
+PERSIST_FSYNC = os.getenv("PERSIST_FSYNC", "0") == "1"
+
+# Prometheus metrics on /metrics (METRICS_ENABLED=0 disables it); with METRICS_TOKEN
+# set, scrapes must send it as a bearer token. Under several worker processes, point
+# METRICS_DIR at a directory they share: each writes its samples there every
+# METRICS_WRITE_INTERVAL seconds and /metrics adds up every process's file
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_WRITE_INTERVAL = float(os.getenv("METRICS_WRITE_INTERVAL", "5"))
+
 logger.info(f"Configuration loaded. Model: {MODEL}")
 logger.info(f"Data directory: {DATA_DIR.absolute()}")
 
@@ -73,184 +252,2451 @@ try:
 except Exception as e:
     logger.error(f"OAuth configuration failed: {e}")
 
+# ============================================
+# METRICS
+# ============================================
+class Metric:
+    """A Prometheus metric family, with one sample per combination of label values
+    
+    Updates take the metric's own lock just for a dict update. A metric
+    given a `function` keeps no samples itself: it's read at collection
+    time, from a number or a {label values tuple: number} dict.
+    """
+    
+    kind = "untyped"
+    
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def samples(self) -> list:
+        """[(label values, value)] as of now"""
+        if self.function is None:
+            with self.lock:
+                return list(self.values.items())
+        value = self.function()
+        if isinstance(value, dict):
+            return list(value.items())
+        return [((), value)]
+    
+    def snapshot(self) -> dict:
+        return {"kind": self.kind, "help": self.documentation, "labels": list(self.labelnames),
+                "samples": [[list(labels), value] for labels, value in self.samples()]}
+
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down
+    
+    Across processes, `aggregate` "sum" adds the live workers' values (queue
+    depths, requests in flight); "max" takes the largest, for state every
+    worker reports for itself (whether a backend is healthy).
+    """
+    
+    kind = "gauge"
+    
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None, aggregate: str = "sum"):
+        super().__init__(name, documentation, labelnames, function)
+        self.aggregate = aggregate
+    
+    def set(self, value: float, *labels):
+        with self.lock:
+            self.values[labels] = value
+    
+    def snapshot(self) -> dict:
+        return {**super().snapshot(), "aggregate": self.aggregate}
+
+
+class Histogram(Metric):
+    """Observations counted into fixed buckets, plus their sum"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value: float, *labels):
+        # Per-bucket (not cumulative) counts, the last one for +Inf, then the sum
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+    
+    @contextmanager
+    def time(self, *labels):
+        """Observe how long the block takes, in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+    
+    def samples(self) -> list:
+        with self.lock:
+            return [(labels, list(counts)) for labels, counts in self.values.items()]
+    
+    def snapshot(self) -> dict:
+        return {**super().snapshot(), "buckets": list(self.buckets)}
+
+
+class MetricsRegistry:
+    """This process's metrics, rendered in the Prometheus text format
+    
+    With a `directory`, every process also writes its snapshot there as
+    <pid>.json every `interval` seconds (and on exit), and collect() adds up
+    all the processes' files. Counters and histograms of workers that have
+    exited are kept; gauges only count for live ones, summed or maxed as
+    the gauge's `aggregate` says.
+    """
+    
+    def __init__(self, prefix: str, directory: str = "", interval: float = 5.0):
+        self.prefix = prefix
+        self.directory = Path(directory) if directory else None
+        self.interval = interval
+        self.metrics = []
+    
+    def _register(self, metric: Metric) -> Metric:
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames=(), function=None) -> Counter:
+        return self._register(Counter(name, documentation, labelnames, function))
+    
+    def gauge(self, name: str, documentation: str, labelnames=(), function=None, aggregate: str = "sum") -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, function, aggregate))
+    
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=()) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+    
+    def snapshot(self) -> dict:
+        families = {}
+        for metric in self.metrics:
+            try:
+                families[metric.name] = metric.snapshot()
+            except Exception as e:
+                logger.warning(f"Metric {metric.name} unavailable: {e}")
+        return families
+    
+    def start(self):
+        """Begin writing this process's snapshot for the others (multi-process mode)"""
+        if self.directory is None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        atexit.register(self.write)
+        threading.Thread(target=self._write_loop, name="metrics-writer", daemon=True).start()
+    
+    def _write_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except Exception as e:
+                logger.error(f"Metrics write error: {e}")
+    
+    def write(self):
+        """Atomically replace this process's snapshot file"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".metrics-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self.directory / f"{os.getpid()}.json")
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+    
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        if os.name != "posix":
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    
+    def collect(self) -> dict:
+        """Families with samples combined over every process"""
+        families = self.snapshot()
+        if self.directory is None:
+            return families
+        
+        for path in self.directory.glob("*.json"):
+            try:
+                pid = int(path.stem)
+                if pid == os.getpid():
+                    continue
+                other = json.loads(path.read_text(encoding='utf-8'))
+            except (ValueError, OSError) as e:
+                logger.warning(f"Skipping metrics file {path.name}: {e}")
+                continue
+            alive = self._alive(pid)
+            for name, family in other.items():
+                mine = families.get(name)
+                if mine is None or mine["kind"] != family["kind"] or mine.get("buckets") != family.get("buckets"):
+                    continue
+                if family["kind"] == "gauge" and not alive:
+                    continue
+                merged = {tuple(labels): value for labels, value in mine["samples"]}
+                for labels, value in family["samples"]:
+                    labels = tuple(labels)
+                    if labels not in merged:
+                        merged[labels] = value
+                    elif isinstance(value, list):
+                        merged[labels] = [a + b for a, b in zip(merged[labels], value)]
+                    elif mine.get("aggregate") == "max":
+                        merged[labels] = max(merged[labels], value)
+                    else:
+                        merged[labels] += value
+                mine["samples"] = [[list(labels), value] for labels, value in merged.items()]
+        return families
+    
+    @staticmethod
+    def _number(value: float) -> str:
+        if value == float("inf"):
+            return "+Inf"
+        return repr(float(value)) if isinstance(value, float) else str(value)
+    
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    
+    @classmethod
+    def _labels(cls, names, values, extra: str = "") -> str:
+        pairs = [f'{n}="{cls._escape(v)}"' for n, v in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+    
+    def render(self) -> str:
+        lines = []
+        for name, family in self.collect().items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['kind']}")
+            names = family["labels"]
+            for values, value in sorted(family["samples"], key=lambda s: [str(v) for v in s[0]]):
+                if family["kind"] != "histogram":
+                    lines.append(f"{name}{self._labels(names, values)} {self._number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(family["buckets"] + [float("inf")], value):
+                    cumulative += count
+                    le = f'le="{self._number(float(bound))}"'
+                    lines.append(f"{name}_bucket{self._labels(names, values, le)} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(names, values)} {self._number(value[-1])}")
+                lines.append(f"{name}_count{self._labels(names, values)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry("light_", METRICS_DIR, METRICS_WRITE_INTERVAL)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+http_request_seconds = metrics.histogram(
+    "http_request_duration_seconds", "Time to response headers, by route",
+    ("method", "route", "status"), LATENCY_BUCKETS)
+ttft_seconds = metrics.histogram(
+    "chat_time_to_first_token_seconds", "From the chat request to the first reply content sent",
+    ("model", "source"), (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+generation_seconds = metrics.histogram(
+    "chat_generation_seconds", "From the chat request to the end of the reply",
+    ("model", "source"), (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+tokens_per_second = metrics.histogram(
+    "chat_tokens_per_second", "Ollama generation speed (eval_count / eval_duration)",
+    ("model",), (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300))
+prompt_tokens = metrics.histogram(
+    "chat_prompt_tokens", "Prompt size: estimated for the whole prompt, and as evaluated by Ollama",
+    ("model", "kind"), (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768))
+model_load_seconds = metrics.histogram(
+    "chat_model_load_seconds", "Ollama's load_duration for a reply",
+    ("model",), (0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60))
+generated_tokens = metrics.counter(
+    "chat_generated_tokens_total", "Tokens generated by Ollama", ("model",))
+replies_total = metrics.counter(
+    "chat_replies_total", "Replies finished (done) or cut short (stopped)", ("model", "source", "outcome"))
+storage_seconds = metrics.histogram(
+    "storage_operation_seconds", "UserStorage disk reads (load) and writes (save)",
+    ("backend", "op"), (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+storage_file_bytes = metrics.histogram(
+    "storage_file_bytes", "Size of storage files as read or written",
+    ("backend", "kind"), tuple(1024 * 4 ** i for i in range(10)))
+
 # ============================================
 # USER STORAGE
 # ============================================
-class UserStorage:
-    """Manages per-user conversation storage"""
+class UserStorage(ABC):
+    """Interface for per-user conversation storage"""
+    
+    def init_user(self, email: str):
+        """Prepare storage for a newly authenticated user"""
+    
+    def stats(self) -> dict:
+        """Backend-specific counters for /health"""
+        return {}
+    
+    @abstractmethod
+    def list_users(self) -> list:
+        """Emails of every user with stored conversations"""
+    
+    @abstractmethod
+    def list_conversations(self, email: str) -> list:
+        """List conversation metadata (id, title, timestamps, is_active, message_count)"""
+    
+    @abstractmethod
+    def load_conversations(self, email: str) -> list:
+        """Load user's conversations with their messages"""
+    
+    @abstractmethod
+    def get_conversation(self, email: str, conv_id: str):
+        """Get a conversation's metadata, or None if it doesn't exist"""
+    
+    @abstractmethod
+    def load_messages(self, email: str, conv_id: str, before: int = None, limit: int = None) -> list:
+        """Load a conversation's messages in seq order
+        
+        With `before` and/or `limit`, return only the newest `limit` messages
+        whose seq is below `before`. Every returned message carries its seq.
+        """
+    
+    @abstractmethod
+    def append_messages(self, email: str, conv_id: str, messages: list):
+        """Append messages to a conversation"""
+    
+    def append_batch(self, batch: list):
+        """Append several (email, conv_id, messages) groups as one commit"""
+        for email, conv_id, messages in batch:
+            self.append_messages(email, conv_id, messages)
+    
+    def sync(self, emails):
+        """Make the given users' writes durable on disk"""
+    
+    @abstractmethod
+    def get_active_conversation(self, email: str) -> dict:
+        """Get user's active conversation metadata, creating one if needed"""
+    
+    @abstractmethod
+    def create_new_conversation(self, email: str) -> dict:
+        """Create a new conversation and set it as active"""
+    
+    @abstractmethod
+    def set_active_conversation(self, email: str, conv_id: str) -> bool:
+        """Set a conversation as active"""
+    
+    @abstractmethod
+    def delete_conversation(self, email: str, conv_id: str) -> bool:
+        """Delete a conversation"""
+    
+    @abstractmethod
+    def set_summary(self, email: str, conv_id: str, summary: dict):
+        """Store a conversation's rolling summary ({text, upto_seq, tokens})"""
+    
+    def _new_conversation(self) -> dict:
+        return {
+            'id': secrets.token_hex(8),
+            'title': 'New Conversation',
+            'created_at': datetime.now().isoformat(),
+            'updated_at': datetime.now().isoformat(),
+            'is_active': True,
+            'message_count': 0
+        }
+    
+    def _title_from(self, messages: list):
+        """Derive a conversation title from its first user message"""
+        first_msg = next((m for m in messages if m['role'] == 'user'), None)
+        if first_msg:
+            return first_msg['content'][:50] + ('...' if len(first_msg['content']) > 50 else '')
+        return None
+
+
+class UserState:
+    """Parsed storage state for one user, as held by UserStateCache"""
+    
+    def __init__(self, email: str, conversations: list):
+        self.email = email
+        self.conversations = conversations
+        self.tails = {}            # conv_id -> newest messages, oldest first
+        self.pending = {}          # conv_id -> messages not yet appended to the log
+        self.index_dirty = False
+        # Unflushed index changes, for merging onto one another process wrote meanwhile
+        self.changed = set()       # conv_ids whose metadata changed here
+        self.created = set()       # conv_ids created here
+        self.deleted = set()       # conv_ids deleted here
+        self.activated = None      # conv_id made active here
+        self.index_sig = None      # (inode, mtime_ns, size) of index.json when last read/written
+        self.nbytes = 0
+        self.pins = 0
+        self.lock = threading.RLock()
+        self.lock_fd = None        # held fcntl lock file, see JSONUserStorage._hold
+        self.lock_depth = 0
+        self.unsynced = set()      # log files appended to since the last sync()
+    
+    @property
+    def dirty(self) -> bool:
+        return self.index_dirty or bool(self.pending)
+    
+    def find(self, conv_id: str):
+        return next((c for c in self.conversations if c['id'] == conv_id), None)
+    
+    def clear_changes(self):
+        self.changed = set()
+        self.created = set()
+        self.deleted = set()
+        self.activated = None
+    
+    def measure(self) -> int:
+        """Approximate in-memory size in bytes"""
+        size = 200 * len(self.conversations)
+        for messages in list(self.tails.values()) + list(self.pending.values()):
+            size += sum(100 + len(m.get('content', '')) for m in messages)
+        return size
+
+
+class UserStateCache:
+    """LRU cache of UserState bounded by user count and approximate bytes
+    
+    States are pinned while a request uses them; only unpinned, clean states
+    are dropped, so an eviction never races an in-flight mutation.
+    """
+    
+    def __init__(self, max_users: int, max_bytes: int):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+    
+    def pin(self, email: str, load) -> UserState:
+        """Get a user's state (loading it on a miss) and pin it"""
+        with self.lock:
+            state = self.states.get(email)
+            if state is not None:
+                self.hits += 1
+                self.states.move_to_end(email)
+                state.pins += 1
+                return state
+            self.misses += 1
+            evictions = self.evictions
+        
+        while True:
+            loaded = load()
+            with self.lock:
+                # Another thread may have loaded the same user meanwhile
+                state = self.states.get(email)
+                if state is None:
+                    if self.evictions != evictions:
+                        # A state flushed during our read may be newer than what we loaded
+                        evictions = self.evictions
+                        continue
+                    state = loaded
+                    state.nbytes = state.measure()
+                    self.states[email] = state
+                    self.nbytes += state.nbytes
+                state.pins += 1
+                return state
+    
+    def unpin(self, state: UserState):
+        """Release a pinned state and re-measure it"""
+        size = state.measure()
+        with self.lock:
+            state.pins -= 1
+            if self.states.get(state.email) is state:
+                self.nbytes += size - state.nbytes
+            state.nbytes = size
     
-    def __init__(self, data_dir: Path):
+    def victims(self) -> list:
+        """Unpinned states to drop to get back under budget, least recent first"""
+        with self.lock:
+            victims = []
+            users, nbytes = len(self.states), self.nbytes
+            for state in self.states.values():
+                if users <= self.max_users and nbytes <= self.max_bytes:
+                    break
+                if state.pins == 0:
+                    victims.append(state)
+                    users -= 1
+                    nbytes -= state.nbytes
+            return victims
+    
+    def drop(self, state: UserState) -> bool:
+        """Remove a clean, unpinned state"""
+        with self.lock:
+            if self.states.get(state.email) is not state or state.pins or state.dirty:
+                return False
+            del self.states[state.email]
+            self.nbytes -= state.nbytes
+            self.evictions += 1
+            return True
+    
+    def dirty_states(self) -> list:
+        with self.lock:
+            return [s for s in self.states.values() if s.dirty]
+    
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'users': len(self.states),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'flushes': self.flushes
+            }
+
+
+class JSONUserStorage(UserStorage):
+    """File-based conversation storage
+    
+    Layout per user directory:
+        index.json                  - conversation metadata (title, timestamps, active flag)
+        conversations/<id>.jsonl    - append-only message log, one message per line
+    
+    Adding a message is a single append to the conversation's log plus a
+    rewrite of the small index, instead of reserializing the whole history.
+    
+    Parsed per-user state is kept in a UserStateCache. In "writeback" mode
+    mutations only touch memory and a background thread flushes dirty users
+    every `flush_interval` seconds, coalescing appends; "writethrough" flushes
+    before each mutation returns; "off" keeps nothing cached between calls.
+    
+    Each operation holds the user's in-process lock plus an fcntl lock on the
+    user's .lock file, and index.json is replaced atomically. Cached state is
+    revalidated against index.json, and a flush that finds the index rewritten
+    by another process merges its unflushed changes onto it, renumbering
+    pending appends, so several worker processes can share DATA_DIR in any
+    cache mode. In "writeback" mode other processes see a change once it's
+    flushed.
+    """
+    
+    LEGACY_FILE = "conversations.json"
+    INDEX_FILE = "index.json"
+    LOGS_DIR = "conversations"
+    LOCK_FILE = ".lock"
+    
+    def __init__(self, data_dir: Path, cache_mode: str = "writeback", cache_max_users: int = 1000,
+                 cache_max_bytes: int = 64 * 1024 * 1024, flush_interval: float = 1.0,
+                 tail_size: int = 50):
         self.data_dir = data_dir
+        self.cache_mode = cache_mode
+        self.tail_size = tail_size
+        self.cache = UserStateCache(
+            cache_max_users if cache_mode != "off" else 0,
+            cache_max_bytes
+        )
+        self.flush_interval = flush_interval
+        
+        if cache_mode == "writeback":
+            threading.Thread(target=self._flush_loop, name="storage-flusher", daemon=True).start()
+            atexit.register(self.flush_all)
+    
+    def init_user(self, email: str):
+        self.get_user_dir(email)
     
     def get_user_dir(self, email: str) -> Path:
         """Get or create user directory"""
         # Sanitize email for folder name
         safe_email = email.replace("@", "_at_").replace(".", "_")
-        user_dir = self.data_dir / safe_email
+        return self._resolve_user_dir(safe_email)
+    
+    @lru_cache(maxsize=65536)
+    def _resolve_user_dir(self, safe_email: str) -> Path:
+        """Locate a user's sharded directory, creating or migrating it once per process
+        
+        Users live under two levels of hash-prefix directories
+        (data/ab/cd/<safe_email>) so no directory grows past a few
+        thousand entries. Directories from the old flat layout are moved
+        on first access.
+        """
+        digest = hashlib.sha1(safe_email.encode('utf-8')).hexdigest()
+        user_dir = self.data_dir / digest[:2] / digest[2:4] / safe_email
+        if user_dir.is_dir():
+            return user_dir
+        
+        user_dir.parent.mkdir(parents=True, exist_ok=True)
+        flat_dir = self.data_dir / safe_email
+        if flat_dir.is_dir():
+            try:
+                os.replace(flat_dir, user_dir)
+                logger.info(f"Moved {safe_email} to sharded layout")
+            except FileNotFoundError:
+                # Another process migrated it first
+                pass
         user_dir.mkdir(exist_ok=True)
         return user_dir
     
-    def get_conversations_file(self, email: str) -> Path:
-        """Get path to user's conversations file"""
-        return self.get_user_dir(email) / "conversations.json"
+    def get_index_file(self, email: str) -> Path:
+        """Get path to user's conversation index"""
+        user_dir = self.get_user_dir(email)
+        self._migrate_legacy(email, user_dir)
+        return user_dir / self.INDEX_FILE
     
-    def load_conversations(self, email: str) -> list:
-        """Load user's conversations"""
-        conv_file = self.get_conversations_file(email)
-        
-        if not conv_file.exists():
-            return []
+    def get_log_file(self, email: str, conv_id: str) -> Path:
+        """Get path to a conversation's message log"""
+        return self._logs_dir(self.get_user_dir(email)) / f"{conv_id}.jsonl"
+    
+    @lru_cache(maxsize=65536)
+    def _logs_dir(self, user_dir: Path) -> Path:
+        logs_dir = user_dir / self.LOGS_DIR
+        logs_dir.mkdir(exist_ok=True)
+        return logs_dir
+    
+    def _migrate_legacy(self, email: str, user_dir: Path):
+        """Split a legacy conversations.json into index + per-conversation logs"""
+        legacy_file = user_dir / self.LEGACY_FILE
+        if not legacy_file.exists() or (user_dir / self.INDEX_FILE).exists():
+            return
         
         try:
-            with open(conv_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get('conversations', [])
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                conversations = json.load(f).get('conversations', [])
         except Exception as e:
-            logger.error(f"Error loading conversations for {email}: {e}")
-            return []
-    
-    def save_conversations(self, email: str, conversations: list):
-        """Save user's conversations"""
-        conv_file = self.get_conversations_file(email)
+            logger.error(f"Error reading legacy conversations for {email}: {e}")
+            return
+        
+        logs_dir = user_dir / self.LOGS_DIR
+        logs_dir.mkdir(exist_ok=True)
+        index = []
+        for conv in conversations:
+            messages = conv.pop('messages', [])
+            conv['message_count'] = len(messages)
+            with open(logs_dir / f"{conv['id']}.jsonl", 'w', encoding='utf-8') as f:
+                for seq, msg in enumerate(messages):
+                    f.write(json.dumps({**msg, 'seq': seq}, ensure_ascii=False) + "\n")
+            index.append(conv)
         
+        self._write_index(email, user_dir / self.INDEX_FILE, index)
+        legacy_file.rename(user_dir / f"{self.LEGACY_FILE}.migrated")
+        logger.info(f"Migrated {len(index)} conversations to append-only logs for {email}")
+    
+    def _write_index(self, email: str, index_file: Path, conversations: list):
+        """Atomically replace the index via a temp file in the same directory"""
+        fd, tmp_path = tempfile.mkstemp(dir=index_file.parent, prefix=".index-", suffix=".tmp")
         try:
-            with open(conv_file, 'w', encoding='utf-8') as f:
+            with storage_seconds.time("json", "save"), os.fdopen(fd, 'w', encoding='utf-8') as f:
                 json.dump({
                     'email': email,
                     'updated_at': datetime.now().isoformat(),
                     'conversations': conversations
-                }, f, indent=2, ensure_ascii=False)
-            logger.info(f"Saved {len(conversations)} conversations for {email}")
-        except Exception as e:
-            logger.error(f"Error saving conversations for {email}: {e}")
+                }, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+                storage_file_bytes.observe(f.tell(), "json", "index")
+            os.replace(tmp_path, index_file)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
     
-    def get_active_conversation(self, email: str) -> dict:
-        """Get user's active conversation"""
-        conversations = self.load_conversations(email)
-        
-        # Find or create active conversation
-        for conv in conversations:
-            if conv.get('is_active', False):
-                return conv
-        
-        # Create new active conversation
-        new_conv = {
-            'id': secrets.token_hex(8),
-            'title': 'New Conversation',
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat(),
-            'is_active': True,
-            'messages': []
-        }
-        conversations.insert(0, new_conv)
-        self.save_conversations(email, conversations)
-        return new_conv
+    def _index_sig(self, index_file: Path):
+        try:
+            st = index_file.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
     
-    def update_conversation(self, email: str, conv_id: str, messages: list):
-        """Update a conversation's messages"""
-        conversations = self.load_conversations(email)
+    def _read_index(self, email: str) -> list:
+        """Read conversation metadata from disk"""
+        index_file = self.get_index_file(email)
         
-        for conv in conversations:
-            if conv['id'] == conv_id:
-                conv['messages'] = messages
-                conv['updated_at'] = datetime.now().isoformat()
-                
-                # Update title based on first message
-                if len(messages) > 0 and conv['title'] == 'New Conversation':
-                    first_msg = next((m for m in messages if m['role'] == 'user'), None)
-                    if first_msg:
-                        conv['title'] = first_msg['content'][:50] + ('...' if len(first_msg['content']) > 50 else '')
-                
-                break
+        if not index_file.exists():
+            return []
         
-        self.save_conversations(email, conversations)
+        try:
+            with storage_seconds.time("json", "load"), open(index_file, 'r', encoding='utf-8') as f:
+                storage_file_bytes.observe(os.fstat(f.fileno()).st_size, "json", "index")
+                return json.load(f).get('conversations', [])
+        except Exception as e:
+            logger.error(f"Error loading index for {email}: {e}")
+            return []
     
-    def create_new_conversation(self, email: str) -> dict:
-        """Create a new conversation and set it as active"""
-        conversations = self.load_conversations(email)
+    def _load_state(self, email: str) -> UserState:
+        state = UserState(email, [])
+        with self._hold(state):
+            self._read_state(state)
+        return state
+    
+    def _read_state(self, state: UserState):
+        """(Re)load a user's index from disk; caller holds the user's locks"""
+        email = state.email
+        # Stat before reading: a concurrent replace then shows up as a stale sig
+        state.index_sig = self._index_sig(self.get_index_file(email))
+        state.conversations = self._read_index(email)
+        state.tails = {}
         
-        # Deactivate all conversations
-        for conv in conversations:
-            conv['is_active'] = False
+        # Indexes written before message_count existed are backfilled once
+        for conv in state.conversations:
+            if 'message_count' not in conv:
+                conv['message_count'] = len(self._read_log(email, conv['id']))
+                state.index_dirty = True
+    
+    # ----------------------------------------
+    # Cache plumbing
+    # ----------------------------------------
+    @contextmanager
+    def _hold(self, state: UserState):
+        """Hold a user's thread lock and cross-process file lock (reentrant)"""
+        with state.lock:
+            if state.lock_depth == 0 and fcntl is not None:
+                lock_path = self.get_user_dir(state.email) / self.LOCK_FILE
+                state.lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(state.lock_fd, fcntl.LOCK_EX)
+            state.lock_depth += 1
+            try:
+                yield state
+            finally:
+                state.lock_depth -= 1
+                if state.lock_depth == 0 and state.lock_fd is not None:
+                    fcntl.flock(state.lock_fd, fcntl.LOCK_UN)
+                    os.close(state.lock_fd)
+                    state.lock_fd = None
+    
+    @contextmanager
+    def _user(self, email: str, write: bool = False):
+        """Pin and lock a user's state for the duration of an operation"""
+        state = self.cache.pin(email, lambda: self._load_state(email))
+        try:
+            with self._hold(state):
+                # Another process may have changed the index since we cached it
+                if state.index_sig != self._index_sig(self.get_index_file(email)):
+                    if state.dirty:
+                        # Merge our unflushed changes onto theirs before going on
+                        self._flush(state)
+                    else:
+                        self._read_state(state)
+                yield state
+                if write and self.cache_mode != "writeback":
+                    self._flush(state)
+        finally:
+            self.cache.unpin(state)
+        self._evict()
+    
+    def _evict(self):
+        for state in self.cache.victims():
+            if state.dirty:
+                self._flush(state)
+            self.cache.drop(state)
+    
+    def _flush(self, state: UserState):
+        """Write a user's pending appends and index to disk"""
+        with self._hold(state):
+            if not state.dirty:
+                return
+            index_file = self.get_index_file(state.email)
+            if state.index_sig != self._index_sig(index_file):
+                self._merge_index(state)
+            for conv_id, messages in list(state.pending.items()):
+                try:
+                    log_file = self.get_log_file(state.email, conv_id)
+                    self._append_log(log_file, messages)
+                    state.unsynced.add(log_file)
+                except Exception as e:
+                    logger.error(f"Error appending messages for {state.email}/{conv_id}: {e}")
+                    continue
+                del state.pending[conv_id]
+            
+            if state.index_dirty:
+                try:
+                    self._write_index(state.email, index_file, state.conversations)
+                    state.index_sig = self._index_sig(index_file)
+                    state.index_dirty = False
+                    state.clear_changes()
+                except Exception as e:
+                    logger.error(f"Error saving index for {state.email}: {e}")
+            
+            with self.cache.lock:
+                self.cache.flushes += 1
+    
+    def _merge_index(self, state: UserState):
+        """Rebase unflushed changes onto an index another process has rewritten
         
-        # Create new active conversation
-        new_conv = {
-            'id': secrets.token_hex(8),
-            'title': 'New Conversation',
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat(),
-            'is_active': True,
-            'messages': []
-        }
+        The index on disk is taken as the base. Conversations deleted here
+        are dropped, ones created here are added, and ones changed here
+        keep their title and newest summary. Pending appends are renumbered
+        to follow the other process's messages. Caller holds the user's locks.
+        """
+        email = state.email
+        logger.info(f"index.json for {email} changed on disk, merging unflushed changes")
+        mine = {c['id']: c for c in state.conversations}
+        merged = [c for c in self._read_index(email) if c['id'] not in state.deleted]
+        theirs = {c['id']: c for c in merged}
         
-        conversations.insert(0, new_conv)
-        self.save_conversations(email, conversations)
-        return new_conv
-    
-    def set_active_conversation(self, email: str, conv_id: str) -> bool:
-        """Set a conversation as active"""
-        conversations = self.load_conversations(email)
+        for conv_id, other in theirs.items():
+            conv = mine.get(conv_id)
+            if conv_id not in state.changed and conv is not None \
+                    and conv['message_count'] != other.get('message_count', 0):
+                state.tails.pop(conv_id, None)
         
-        found = False
-        for conv in conversations:
-            conv['is_active'] = (conv['id'] == conv_id)
-            if conv['id'] == conv_id:
-                found = True
+        for conv_id in state.changed:
+            conv = mine.get(conv_id)
+            if conv is None:
+                continue
+            pending = state.pending.get(conv_id, [])
+            other = theirs.get(conv_id)
+            if other is None:
+                if conv_id in state.created:
+                    merged.insert(0, conv)
+                    theirs[conv_id] = conv
+                elif pending:
+                    logger.warning(f"Dropping {len(pending)} messages for {email}/{conv_id}, deleted by another process")
+                continue
+            
+            base = other.get('message_count', 0)
+            if base != conv['message_count'] - len(pending):
+                for i, record in enumerate(pending):
+                    record['seq'] = base + i
+                # Cached tails no longer match the log
+                state.tails.pop(conv_id, None)
+            other['message_count'] = base + len(pending)
+            other['updated_at'] = max(other.get('updated_at', ''), conv['updated_at'])
+            if other.get('title') == 'New Conversation':
+                other['title'] = conv['title']
+            summary = conv.get('summary')
+            if summary and summary['upto_seq'] > other.get('summary', {}).get('upto_seq', -1):
+                other['summary'] = summary
         
-        if found:
-            self.save_conversations(email, conversations)
+        if state.activated in theirs:
+            for conv in merged:
+                conv['is_active'] = conv['id'] == state.activated
+        if merged and not any(c.get('is_active', False) for c in merged):
+            merged[0]['is_active'] = True
         
-        return found
+        state.conversations = merged
+        for conv_id in set(state.pending) - set(theirs):
+            del state.pending[conv_id]
+        for conv_id in set(state.tails) - set(theirs):
+            del state.tails[conv_id]
+        state.index_dirty = True
     
-    def delete_conversation(self, email: str, conv_id: str) -> bool:
-        """Delete a conversation"""
-        conversations = self.load_conversations(email)
+    def sync(self, emails):
+        """Flush the given users and fsync the logs they appended to"""
+        for email in emails:
+            with self._user(email) as state:
+                self._flush(state)
+                for log_file in state.unsynced:
+                    try:
+                        with open(log_file, 'rb') as f:
+                            os.fsync(f.fileno())
+                    except FileNotFoundError:
+                        pass
+                state.unsynced.clear()
+    
+    def flush_all(self):
+        """Flush every dirty user"""
+        for state in self.cache.dirty_states():
+            self._flush(state)
+    
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush_all()
+            except Exception as e:
+                logger.error(f"Storage flush error: {e}", exc_info=True)
+    
+    def stats(self) -> dict:
+        return {'cache': {'mode': self.cache_mode, **self.cache.stats()}}
+    
+    # ----------------------------------------
+    # Message logs
+    # ----------------------------------------
+    def _append_log(self, log_file: Path, messages: list):
+        """Append messages as JSON lines in a single write"""
+        data = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode('utf-8')
+        with storage_seconds.time("json", "save"), open(log_file, 'a+b') as f:
+            # Terminate a torn line left by a crash so it doesn't swallow this append
+            size = f.seek(0, os.SEEK_END)
+            if size > 0:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    data = b"\n" + data
+            f.write(data)
+        storage_file_bytes.observe(size + len(data), "json", "log")
+    
+    def _read_log(self, email: str, conv_id: str) -> list:
+        log_file = self.get_log_file(email, conv_id)
         
-        # Find and remove
-        conversations = [c for c in conversations if c['id'] != conv_id]
+        if not log_file.exists():
+            return []
         
-        # If we deleted the active conversation, make the first one active
-        has_active = any(c.get('is_active', False) for c in conversations)
-        if not has_active and conversations:
-            conversations[0]['is_active'] = True
+        messages = []
+        try:
+            with storage_seconds.time("json", "load"), open(log_file, 'r', encoding='utf-8') as f:
+                storage_file_bytes.observe(os.fstat(f.fileno()).st_size, "json", "log")
+                for line in f:
+                    try:
+                        msg = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn trailing line from an interrupted append
+                        continue
+                    msg.setdefault('seq', len(messages))
+                    messages.append(msg)
+        except Exception as e:
+            logger.error(f"Error loading messages for {email}/{conv_id}: {e}")
+        return messages
+    
+    def _read_window(self, email: str, conv_id: str, next_seq: int, before, limit) -> list:
+        """Read the newest messages below `before` by scanning the log backwards"""
+        log_file = self.get_log_file(email, conv_id)
         
-        self.save_conversations(email, conversations)
-        return True
-
-storage = UserStorage(DATA_DIR)
-
-# ============================================
-# HELPER FUNCTIONS
-# ============================================
-def get_logged_in_email():
-    """Get current logged-in email"""
-    return session.get("email")
-
-def require_auth(f):
-    """Decorator to require authentication"""
-    from functools import wraps
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        email = get_logged_in_email()
-        if not email:
-            logger.warning("Unauthorized access attempt")
-            return redirect(url_for("login"))
-        return f(*args, **kwargs)
-    return decorated
-
-# ============================================
-# AUTHENTICATION ROUTES
-# ============================================
-@app.route("/login")
-def login():
-    """Start OAuth login"""
-    try:
-        if request.host.startswith('127.0.0.1') or request.host.startswith('localhost'):
-            redirect_uri = f"{LOCAL_URL}/auth/callback"
-        else:
-            redirect_uri = f"{PRODUCTION_URL}/auth/callback"
+        if not log_file.exists():
+            return []
         
-        logger.info(f"Initiating OAuth login with redirect: {redirect_uri}")
+        window = []
+        try:
+            with storage_seconds.time("json", "load"):
+                for line in self._reverse_lines(log_file):
+                    try:
+                        msg = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    next_seq = msg.setdefault('seq', next_seq - 1)
+                    if before is not None and msg['seq'] >= before:
+                        continue
+                    window.append(msg)
+                    if limit is not None and len(window) >= limit:
+                        break
+        except Exception as e:
+            logger.error(f"Error loading messages for {email}/{conv_id}: {e}")
+        window.reverse()
+        return window
+    
+    def _reverse_lines(self, path: Path, block_size: int = 65536):
+        """Yield a file's lines from last to first, reading fixed-size blocks"""
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            tail = b""
+            while pos > 0:
+                size = min(block_size, pos)
+                pos -= size
+                f.seek(pos)
+                lines = (f.read(size) + tail).split(b"\n")
+                tail = lines[0]
+                for line in reversed(lines[1:]):
+                    if line:
+                        yield line
+            if tail:
+                yield tail
+    
+    # ----------------------------------------
+    # UserStorage interface
+    # ----------------------------------------
+    def list_users(self) -> list:
+        """Emails from every index.json, in sharded or not yet moved flat directories"""
+        self.flush_all()
+        emails = set()
+        for pattern in (f"*/*/*/{self.INDEX_FILE}", f"*/{self.INDEX_FILE}"):
+            for index_file in self.data_dir.glob(pattern):
+                try:
+                    email = json.loads(index_file.read_text(encoding='utf-8')).get('email')
+                except (OSError, ValueError):
+                    continue
+                if email:
+                    emails.add(email)
+        return sorted(emails)
+    
+    def list_conversations(self, email: str) -> list:
+        """List conversation metadata without reading message logs"""
+        with self._user(email) as state:
+            return [{k: v for k, v in c.items() if k != 'summary'} for c in state.conversations]
+    
+    def load_conversations(self, email: str) -> list:
+        """Load user's conversations with their messages"""
+        conversations = self.list_conversations(email)
+        for conv in conversations:
+            conv['messages'] = self.load_messages(email, conv['id'])
+        return conversations
+    
+    def get_conversation(self, email: str, conv_id: str):
+        """Get a conversation's metadata from the index"""
+        with self._user(email) as state:
+            conv = state.find(conv_id)
+            return dict(conv) if conv is not None else None
+    
+    def load_messages(self, email: str, conv_id: str, before: int = None, limit: int = None) -> list:
+        """Load a conversation's messages from its log and any pending appends"""
+        with self._user(email) as state:
+            conv = state.find(conv_id)
+            if conv is None:
+                return []
+            
+            if before is None and limit is None:
+                return self._read_log(email, conv_id) + [dict(m) for m in state.pending.get(conv_id, [])]
+            
+            # Serve from the cached tail when it covers the requested window
+            tail = state.tails.get(conv_id)
+            if tail is not None:
+                window = [m for m in tail if before is None or m['seq'] < before]
+                if limit is not None:
+                    window = window[-limit:]
+                complete = (limit is not None and len(window) >= limit) or (tail and tail[0]['seq'] == 0) \
+                    or conv['message_count'] == 0
+                if complete:
+                    return [dict(m) for m in window]
+            
+            self._flush(state)
+            window = self._read_window(email, conv_id, conv['message_count'], before, limit)
+            if before is None:
+                state.tails[conv_id] = window[-self.tail_size:]
+            return [dict(m) for m in window]
+    
+    def append_messages(self, email: str, conv_id: str, messages: list):
+        """Append messages to a conversation's log"""
+        with self._user(email, write=True) as state:
+            conv = state.find(conv_id)
+            if conv is None:
+                logger.warning(f"Append to unknown conversation {conv_id} for {email}")
+                return
+            
+            first_seq = conv.get('message_count', 0)
+            records = [{**m, 'seq': first_seq + i} for i, m in enumerate(messages)]
+            state.pending.setdefault(conv_id, []).extend(records)
+            if conv_id in state.tails:
+                state.tails[conv_id] = (state.tails[conv_id] + records)[-self.tail_size:]
+            
+            conv['updated_at'] = datetime.now().isoformat()
+            conv['message_count'] = first_seq + len(messages)
+            
+            # Update title based on first message
+            if conv['title'] == 'New Conversation':
+                conv['title'] = self._title_from(messages) or conv['title']
+            
+            state.changed.add(conv_id)
+            state.index_dirty = True
+        logger.info(f"Appended {len(messages)} messages to {conv_id} for {email}")
+    
+    def get_active_conversation(self, email: str) -> dict:
+        """Get user's active conversation"""
+        with self._user(email, write=True) as state:
+            # Find or create active conversation
+            for conv in state.conversations:
+                if conv.get('is_active', False):
+                    return dict(conv)
+            
+            # Create new active conversation
+            new_conv = self._new_conversation()
+            state.conversations.insert(0, new_conv)
+            state.tails[new_conv['id']] = []
+            self._created(state, new_conv['id'])
+            return dict(new_conv)
+    
+    def create_new_conversation(self, email: str) -> dict:
+        """Create a new conversation and set it as active"""
+        with self._user(email, write=True) as state:
+            # Deactivate all conversations
+            for conv in state.conversations:
+                conv['is_active'] = False
+            
+            # Create new active conversation
+            new_conv = self._new_conversation()
+            state.conversations.insert(0, new_conv)
+            state.tails[new_conv['id']] = []
+            self._created(state, new_conv['id'])
+            return dict(new_conv)
+    
+    def set_active_conversation(self, email: str, conv_id: str) -> bool:
+        """Set a conversation as active"""
+        with self._user(email, write=True) as state:
+            if state.find(conv_id) is None:
+                return False
+            
+            for conv in state.conversations:
+                conv['is_active'] = (conv['id'] == conv_id)
+            state.activated = conv_id
+            state.index_dirty = True
+            return True
+    
+    def delete_conversation(self, email: str, conv_id: str) -> bool:
+        """Delete a conversation"""
+        with self._user(email, write=True) as state:
+            # Find and remove
+            found = state.find(conv_id) is not None
+            state.conversations = [c for c in state.conversations if c['id'] != conv_id]
+            state.pending.pop(conv_id, None)
+            state.tails.pop(conv_id, None)
+            state.changed.discard(conv_id)
+            state.deleted.add(conv_id)
+            
+            # If we deleted the active conversation, make the first one active
+            has_active = any(c.get('is_active', False) for c in state.conversations)
+            if not has_active and state.conversations:
+                state.conversations[0]['is_active'] = True
+            
+            state.index_dirty = True
+            if found:
+                self.get_log_file(email, conv_id).unlink(missing_ok=True)
+            return True
+    
+    def set_summary(self, email: str, conv_id: str, summary: dict):
+        """Store a conversation's rolling summary in the index"""
+        with self._user(email, write=True) as state:
+            conv = state.find(conv_id)
+            if conv is not None:
+                conv['summary'] = summary
+                state.changed.add(conv_id)
+                state.index_dirty = True
+    
+    def _created(self, state: UserState, conv_id: str):
+        state.created.add(conv_id)
+        state.changed.add(conv_id)
+        state.activated = conv_id
+        state.index_dirty = True
+
+
+class SQLiteUserStorage(UserStorage):
+    """SQLite conversation storage (WAL mode, one connection per thread)
+    
+    Messages are keyed by (email, conv_id, seq), so appends, active-flag
+    changes and deletes are targeted statements rather than rewrites.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            email TEXT NOT NULL,
+            conv_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            is_active INTEGER NOT NULL DEFAULT 0,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            summary TEXT,
+            PRIMARY KEY (email, conv_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversations_active
+            ON conversations (email, is_active);
+        CREATE TABLE IF NOT EXISTS messages (
+            email TEXT NOT NULL,
+            conv_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (email, conv_id, seq)
+        ) WITHOUT ROWID;
+    """
+    
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connect().executescript(self.SCHEMA)
+        with self._write() as conn:
+            self._migrate(conn)
+    
+    def _migrate(self, conn: sqlite3.Connection):
+        """Bring databases created by older versions up to the current schema"""
+        columns = {r['name'] for r in conn.execute("PRAGMA table_info(conversations)")}
+        if 'message_count' not in columns:
+            conn.execute("ALTER TABLE conversations ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+            conn.execute(
+                "UPDATE conversations SET message_count = (SELECT COUNT(*) FROM messages m "
+                "WHERE m.email = conversations.email AND m.conv_id = conversations.conv_id)"
+            )
+        if 'summary' not in columns:
+            conn.execute("ALTER TABLE conversations ADD COLUMN summary TEXT")
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit; writes open their own transactions in _write()
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    @contextmanager
+    def _write(self):
+        """A write transaction holding the database's write lock from the start
+        
+        The default deferred transaction only locks at the first write, so
+        two writers could both read the same next seq or both find no
+        active conversation. BEGIN IMMEDIATE makes them take turns.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    
+    def _conv_dict(self, row, with_summary: bool = True) -> dict:
+        conv = {
+            'id': row['conv_id'],
+            'title': row['title'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at'],
+            'is_active': bool(row['is_active']),
+            'message_count': row['message_count']
+        }
+        if with_summary and row['summary']:
+            conv['summary'] = json.loads(row['summary'])
+        return conv
+    
+    def _insert_conversation(self, conn, email: str, conv: dict):
+        conn.execute(
+            "INSERT INTO conversations (email, conv_id, title, created_at, updated_at, is_active) "
+            "VALUES (?, ?, ?, ?, ?, 1)",
+            (email, conv['id'], conv['title'], conv['created_at'], conv['updated_at'])
+        )
+    
+    def _observe_size(self):
+        try:
+            storage_file_bytes.observe(self.db_path.stat().st_size, "sqlite", "db")
+        except FileNotFoundError:
+            pass
+    
+    def list_users(self) -> list:
+        rows = self._connect().execute("SELECT DISTINCT email FROM conversations ORDER BY email").fetchall()
+        return [r['email'] for r in rows]
+    
+    def list_conversations(self, email: str) -> list:
+        """List conversation metadata"""
+        with storage_seconds.time("sqlite", "load"):
+            rows = self._connect().execute(
+                "SELECT * FROM conversations WHERE email = ? ORDER BY rowid DESC", (email,)
+            ).fetchall()
+        return [self._conv_dict(r, with_summary=False) for r in rows]
+    
+    def load_conversations(self, email: str) -> list:
+        """Load user's conversations with their messages"""
+        conversations = self.list_conversations(email)
+        for conv in conversations:
+            conv['messages'] = self.load_messages(email, conv['id'])
+        return conversations
+    
+    def get_conversation(self, email: str, conv_id: str):
+        """Get a conversation's metadata"""
+        row = self._connect().execute(
+            "SELECT * FROM conversations WHERE email = ? AND conv_id = ?", (email, conv_id)
+        ).fetchone()
+        return self._conv_dict(row) if row is not None else None
+    
+    def load_messages(self, email: str, conv_id: str, before: int = None, limit: int = None) -> list:
+        """Load a conversation's messages"""
+        with storage_seconds.time("sqlite", "load"):
+            rows = self._connect().execute(
+                "SELECT seq, data FROM messages WHERE email = ? AND conv_id = ? AND seq < ? "
+                "ORDER BY seq DESC LIMIT ?",
+                (email, conv_id, before if before is not None else 2**62, limit if limit is not None else -1)
+            ).fetchall()
+        return [{**json.loads(r['data']), 'seq': r['seq']} for r in reversed(rows)]
+    
+    def _append(self, conn: sqlite3.Connection, email: str, conv_id: str, messages: list):
+        row = conn.execute(
+            "SELECT title FROM conversations WHERE email = ? AND conv_id = ?",
+            (email, conv_id)
+        ).fetchone()
+        if row is None:
+            logger.warning(f"Append to unknown conversation {conv_id} for {email}")
+            return
+        
+        next_seq = conn.execute(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE email = ? AND conv_id = ?",
+            (email, conv_id)
+        ).fetchone()[0]
+        conn.executemany(
+            "INSERT INTO messages (email, conv_id, seq, data) VALUES (?, ?, ?, ?)",
+            [(email, conv_id, next_seq + i, json.dumps(m, ensure_ascii=False))
+             for i, m in enumerate(messages)]
+        )
+        
+        title = row['title']
+        if title == 'New Conversation':
+            title = self._title_from(messages) or title
+        conn.execute(
+            "UPDATE conversations SET title = ?, updated_at = ?, message_count = message_count + ? "
+            "WHERE email = ? AND conv_id = ?",
+            (title, datetime.now().isoformat(), len(messages), email, conv_id)
+        )
+    
+    def append_messages(self, email: str, conv_id: str, messages: list):
+        """Append messages to a conversation"""
+        try:
+            with storage_seconds.time("sqlite", "save"), self._write() as conn:
+                self._append(conn, email, conv_id, messages)
+            self._observe_size()
+            logger.info(f"Appended {len(messages)} messages to {conv_id} for {email}")
+        except sqlite3.Error as e:
+            logger.error(f"Error appending messages for {email}/{conv_id}: {e}")
+    
+    def append_batch(self, batch: list):
+        """Append several groups in a single transaction"""
+        try:
+            with storage_seconds.time("sqlite", "save"), self._write() as conn:
+                for email, conv_id, messages in batch:
+                    self._append(conn, email, conv_id, messages)
+            self._observe_size()
+            logger.info(f"Appended {len(batch)} message groups in one transaction")
+        except sqlite3.Error as e:
+            logger.error(f"Error appending message batch: {e}")
+            # Retry individually so one bad group doesn't drop the rest
+            for email, conv_id, messages in batch:
+                self.append_messages(email, conv_id, messages)
+    
+    def get_active_conversation(self, email: str) -> dict:
+        """Get user's active conversation"""
+        with self._write() as conn:
+            row = conn.execute(
+                "SELECT * FROM conversations WHERE email = ? AND is_active = 1 LIMIT 1", (email,)
+            ).fetchone()
+            if row is not None:
+                return self._conv_dict(row)
+            
+            new_conv = self._new_conversation()
+            self._insert_conversation(conn, email, new_conv)
+        return new_conv
+    
+    def create_new_conversation(self, email: str) -> dict:
+        """Create a new conversation and set it as active"""
+        new_conv = self._new_conversation()
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE conversations SET is_active = 0 WHERE email = ? AND is_active = 1", (email,)
+            )
+            self._insert_conversation(conn, email, new_conv)
+        return new_conv
+    
+    def set_active_conversation(self, email: str, conv_id: str) -> bool:
+        """Set a conversation as active"""
+        with self._write() as conn:
+            found = conn.execute(
+                "SELECT 1 FROM conversations WHERE email = ? AND conv_id = ?", (email, conv_id)
+            ).fetchone() is not None
+            if found:
+                conn.execute(
+                    "UPDATE conversations SET is_active = (conv_id = ?) WHERE email = ?",
+                    (conv_id, email)
+                )
+        return found
+    
+    def delete_conversation(self, email: str, conv_id: str) -> bool:
+        """Delete a conversation"""
+        with self._write() as conn:
+            conn.execute("DELETE FROM messages WHERE email = ? AND conv_id = ?", (email, conv_id))
+            conn.execute("DELETE FROM conversations WHERE email = ? AND conv_id = ?", (email, conv_id))
+            
+            # If we deleted the active conversation, make the most recent one active
+            has_active = conn.execute(
+                "SELECT 1 FROM conversations WHERE email = ? AND is_active = 1", (email,)
+            ).fetchone()
+            if not has_active:
+                conn.execute(
+                    "UPDATE conversations SET is_active = 1 WHERE rowid = "
+                    "(SELECT MAX(rowid) FROM conversations WHERE email = ?)",
+                    (email,)
+                )
+        return True
+    
+    def set_summary(self, email: str, conv_id: str, summary: dict):
+        """Store a conversation's rolling summary"""
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE conversations SET summary = ? WHERE email = ? AND conv_id = ?",
+                (json.dumps(summary, ensure_ascii=False), email, conv_id)
+            )
+
+def create_storage() -> UserStorage:
+    """Build the storage backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "sqlite":
+        logger.info(f"Using SQLite storage: {SQLITE_PATH.absolute()}")
+        return SQLiteUserStorage(SQLITE_PATH)
+    if STORAGE_BACKEND != "json":
+        logger.warning(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', falling back to json")
+    return JSONUserStorage(
+        DATA_DIR,
+        cache_mode=STORAGE_CACHE_MODE,
+        cache_max_users=STORAGE_CACHE_MAX_USERS,
+        cache_max_bytes=STORAGE_CACHE_MAX_BYTES,
+        flush_interval=STORAGE_FLUSH_INTERVAL,
+        tail_size=MESSAGE_PAGE_SIZE
+    )
+
+storage = create_storage()
+
+# ============================================
+# PERSISTENCE QUEUE
+# ============================================
+class PersistenceQueue:
+    """Writes chat turns to storage from a background thread
+    
+    Submitted turns are drained in batches: messages for the same
+    conversation are merged, the batch is committed with one
+    append_batch() call, and with `fsync` enabled the touched users are
+    synced once per batch (group commit). Pending work is flushed on exit.
+    """
+    
+    def __init__(self, storage: UserStorage, maxsize: int = 1000, batch_size: int = 64,
+                 group_window: float = 0.005, fsync: bool = False):
+        self.storage = storage
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.group_window = group_window
+        self.fsync = fsync
+        self.pending = {}          # email -> turns submitted but not yet committed
+        self.cond = threading.Condition()
+        self.batches = 0
+        self.items = 0
+        self.worker = threading.Thread(target=self._run, name="persistence", daemon=True)
+        self.worker.start()
+        atexit.register(self.close)
+    
+    def submit(self, email: str, conv_id: str, messages: list):
+        """Queue messages for appending; falls back to an inline write when full
+        
+        Never blocks an event loop: called from one, the inline write runs
+        on the loop's default executor instead. A thread waits up to a
+        second for room in the queue first.
+        """
+        with self.cond:
+            self.pending[email] = self.pending.get(email, 0) + 1
+        item = (email, conv_id, messages)
+        try:
+            self.queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            logger.warning(f"Persistence queue full, writing in an executor for {email}")
+            loop.run_in_executor(None, self._write_inline, *item)
+            return
+        try:
+            self.queue.put(item, timeout=1)
+        except queue.Full:
+            logger.warning(f"Persistence queue full, writing inline for {email}")
+            self._write_inline(*item)
+    
+    def _write_inline(self, email: str, conv_id: str, messages: list):
+        try:
+            self.storage.append_messages(email, conv_id, messages)
+        finally:
+            self._done([email])
+    
+    def wait_for(self, email: str, timeout: float = 5.0) -> bool:
+        """Block until the user's queued turns are committed"""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending.get(email), timeout=timeout)
+    
+    def close(self):
+        """Drain the queue and stop the worker"""
+        if self.worker.is_alive():
+            self.queue.put(None)
+            self.worker.join()
+    
+    def stats(self) -> dict:
+        return {
+            'queued': self.queue.qsize(),
+            'batches': self.batches,
+            'items': self.items
+        }
+    
+    def _done(self, emails: list):
+        with self.cond:
+            for email in emails:
+                self.pending[email] -= 1
+                if not self.pending[email]:
+                    del self.pending[email]
+            self.cond.notify_all()
+    
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            items = [item]
+            
+            # Collect whatever else arrives within the group window
+            deadline = time.monotonic() + self.group_window
+            while len(items) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+            
+            # Coalesce turns for the same conversation, keeping order
+            groups = OrderedDict()
+            for email, conv_id, messages in items:
+                groups.setdefault((email, conv_id), []).extend(messages)
+            emails = [email for email, _, _ in items]
+            
+            try:
+                self.storage.append_batch([(e, c, m) for (e, c), m in groups.items()])
+                if self.fsync:
+                    self.storage.sync(set(emails))
+            except Exception as e:
+                logger.error(f"Persistence error: {e}", exc_info=True)
+            finally:
+                self.batches += 1
+                self.items += len(items)
+                self._done(emails)
+
+persistence = PersistenceQueue(
+    storage,
+    maxsize=PERSIST_QUEUE_SIZE,
+    batch_size=PERSIST_BATCH_SIZE,
+    group_window=PERSIST_GROUP_WINDOW_MS / 1000,
+    fsync=PERSIST_FSYNC
+)
+
+# ============================================
+# OLLAMA CLIENT
+# ============================================
+class OllamaClient:
+    """Pooled HTTP client for one Ollama server
+    
+    All traffic shares a requests.Session so connections are kept alive and
+    reused. Only connection failures are retried: once a request has been
+    sent it may already be generating, so read errors are surfaced as-is.
+    """
+    
+    def __init__(self, url: str, pool_size: int = 32, connect_timeout: float = 3,
+                 read_timeout: float = 120, connect_retries: int = 2):
+        self.base_url = self.base_url_from(url)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        
+        retry = Retry(
+            total=connect_retries,
+            connect=connect_retries,
+            read=0,
+            status=0,
+            other=0,
+            allowed_methods=None,   # connect failures are safe to retry for POST too
+            backoff_factor=0.2
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+    
+    @staticmethod
+    def base_url_from(url: str) -> str:
+        """Accept either a server root or a full endpoint like .../api/chat"""
+        url = url.rstrip("/")
+        marker = url.find("/api/")
+        return url[:marker] if marker != -1 else url
+    
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+    
+    def chat(self, payload: dict, stream: bool = True) -> requests.Response:
+        """POST /api/chat"""
+        return self.session.post(
+            self.url("/api/chat"),
+            json=payload,
+            stream=stream,
+            timeout=(self.connect_timeout, self.read_timeout)
+        )
+    
+    @staticmethod
+    def abort(response: requests.Response):
+        """Drop a streaming response's connection from another thread
+        
+        Response.close() doesn't wake a read blocked in the streaming
+        thread (say, during a long prefill); shutting the socket down makes
+        that read fail at once, and Ollama sees the client go away.
+        """
+        raw = response.raw
+        connection = getattr(raw, "connection", None) or getattr(raw, "_connection", None)
+        sock = getattr(connection, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        else:
+            response.close()
+    
+    def embed(self, model: str, text: str) -> requests.Response:
+        """POST /api/embed"""
+        return self.session.post(
+            self.url("/api/embed"),
+            json={"model": model, "input": text},
+            timeout=(self.connect_timeout, self.read_timeout)
+        )
+    
+    def generate(self, payload: dict) -> requests.Response:
+        """POST /api/generate (non-streaming)"""
+        return self.session.post(
+            self.url("/api/generate"),
+            json={**payload, "stream": False},
+            timeout=(self.connect_timeout, self.read_timeout)
+        )
+    
+    def ps(self, timeout: float = 2) -> requests.Response:
+        """GET /api/ps (models currently loaded)"""
+        return self.session.get(self.url("/api/ps"), timeout=(self.connect_timeout, timeout))
+    
+    def tags(self, timeout: float = 2) -> requests.Response:
+        """GET /api/tags"""
+        return self.session.get(self.url("/api/tags"), timeout=(self.connect_timeout, timeout))
+    
+    def is_online(self) -> bool:
+        try:
+            return self.tags().status_code == 200
+        except requests.RequestException:
+            return False
+
+class OllamaBackend:
+    """One Ollama server in the pool, with its routing state"""
+    
+    def __init__(self, client: OllamaClient):
+        self.client = client
+        self.healthy = True
+        self.in_flight = 0
+        self.tokens_per_sec = None     # EWMA of generation speed
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.last_error = None
+    
+    @property
+    def name(self) -> str:
+        return self.client.base_url
+    
+    def stats(self) -> dict:
+        return {
+            'url': self.name,
+            'healthy': self.healthy,
+            'in_flight': self.in_flight,
+            'tokens_per_sec': round(self.tokens_per_sec, 1) if self.tokens_per_sec else None,
+            'failures': self.failures,
+            'last_error': self.last_error
+        }
+
+class OllamaPool:
+    """Routes requests across several Ollama servers
+    
+    Each request goes to the healthy backend with the fewest requests in
+    flight, preferring the faster one (measured tokens/sec) on ties. With
+    `sticky` on, a conversation keeps going to the backend that served it
+    last while that backend stays healthy, so its prompt prefix is still in
+    that server's KV cache. A backend that refuses connections is ejected
+    for `eject_seconds` and then re-probed via /api/tags before it takes
+    traffic again.
+    """
+    
+    MAX_AFFINITY = 10000
+    EWMA_ALPHA = 0.3
+    
+    def __init__(self, urls: list, sticky: bool = True, eject_seconds: float = 30,
+                 probe_interval: float = 10, **client_options):
+        self.backends = [OllamaBackend(OllamaClient(url, **client_options)) for url in urls]
+        self.sticky = sticky
+        self.eject_seconds = eject_seconds
+        self.probe_interval = probe_interval
+        self.affinity = OrderedDict()   # conv_id -> backend
+        self.lock = threading.Lock()
+        self.prober = threading.Thread(target=self._probe_loop, name="ollama-prober", daemon=True)
+        self.prober.start()
+    
+    def acquire(self, key: str = None, exclude=()) -> OllamaBackend:
+        """Pick a backend for `key` (a conversation id) and count it in flight"""
+        with self.lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                raise requests.ConnectionError("No Ollama backend reachable")
+            # With every backend ejected, still try one rather than failing outright
+            healthy = [b for b in candidates if b.healthy] or candidates
+            
+            backend = self.affinity.get(key) if self.sticky and key else None
+            if backend not in healthy:
+                backend = min(healthy, key=lambda b: (b.in_flight, -(b.tokens_per_sec or 0)))
+            
+            if self.sticky and key:
+                self.affinity[key] = backend
+                self.affinity.move_to_end(key)
+                while len(self.affinity) > self.MAX_AFFINITY:
+                    self.affinity.popitem(last=False)
+            
+            backend.in_flight += 1
+            return backend
+    
+    def release(self, backend: OllamaBackend):
+        with self.lock:
+            backend.in_flight -= 1
+    
+    def mark_failure(self, backend: OllamaBackend, error: Exception):
+        with self.lock:
+            backend.failures += 1
+            backend.last_error = str(error)
+            backend.ejected_until = time.monotonic() + self.eject_seconds
+            if backend.healthy:
+                backend.healthy = False
+                logger.warning(f"Ejected Ollama backend {backend.name}: {error}")
+    
+    def mark_healthy(self, backend: OllamaBackend):
+        with self.lock:
+            if not backend.healthy:
+                backend.healthy = True
+                backend.last_error = None
+                logger.info(f"Ollama backend {backend.name} is back")
+    
+    def record(self, backend: OllamaBackend, stats: dict):
+        """Fold a finished generation's speed into the backend's tokens/sec"""
+        if not stats.get("eval_count") or not stats.get("eval_duration"):
+            return
+        tps = stats["eval_count"] / (stats["eval_duration"] / 1e9)
+        with self.lock:
+            if backend.tokens_per_sec is None:
+                backend.tokens_per_sec = tps
+            else:
+                backend.tokens_per_sec += self.EWMA_ALPHA * (tps - backend.tokens_per_sec)
+    
+    @contextmanager
+    def chat(self, payload: dict, key: str = None, stream: bool = True):
+        """POST /api/chat to the chosen backend, yielding (backend, response)
+        
+        A backend that can't be connected to is ejected and the next one is
+        tried; nothing has been generated at that point, so it's safe.
+        """
+        backend, response = self._send(key, lambda client: client.chat(payload, stream=stream))
+        try:
+            with response:
+                yield backend, response
+        finally:
+            self.release(backend)
+    
+    def embed(self, model: str, text: str) -> list:
+        """Embedding vector for `text` from whichever backend is least busy"""
+        backend, response = self._send(None, lambda client: client.embed(model, text))
+        try:
+            with response:
+                response.raise_for_status()
+                return response.json()["embeddings"][0]
+        finally:
+            self.release(backend)
+    
+    def _send(self, key: str, call):
+        """Run `call(client)` on a backend, moving on to the next if it can't connect"""
+        tried = []
+        while True:
+            backend = self.acquire(key, exclude=tried)
+            try:
+                response = call(backend.client)
+            except requests.ConnectionError as e:
+                self.release(backend)
+                self.mark_failure(backend, e)
+                tried.append(backend)
+                continue
+            except BaseException:
+                self.release(backend)
+                raise
+            self.mark_healthy(backend)
+            return backend, response
+    
+    def is_online(self) -> bool:
+        return any(b.client.is_online() for b in self.backends)
+    
+    def models_loaded(self, models: list) -> dict:
+        """Whether each of `models` is loaded on each backend (None if /api/ps failed)
+        
+        Asks every backend once, however many models are checked.
+        """
+        names = {model: model if ":" in model else f"{model}:latest" for model in models}
+        loaded = {model: {} for model in models}
+        for backend in self.backends:
+            try:
+                response = backend.client.ps()
+                response.raise_for_status()
+                running = set()
+                for m in response.json().get("models", []):
+                    running.update((m.get("name"), m.get("model")))
+            except (requests.RequestException, ValueError):
+                running = None
+            for model, name in names.items():
+                loaded[model][backend.name] = name in running if running is not None else None
+        return loaded
+    
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            for backend in self.backends:
+                # Ejected backends wait out their cooldown before being re-probed
+                if not backend.healthy and time.monotonic() < backend.ejected_until:
+                    continue
+                try:
+                    online = backend.client.tags().status_code == 200
+                    error = None
+                except requests.RequestException as e:
+                    online, error = False, e
+                if online:
+                    self.mark_healthy(backend)
+                else:
+                    self.mark_failure(backend, error or RuntimeError("/api/tags failed"))
+    
+    def stats(self) -> list:
+        with self.lock:
+            return [b.stats() for b in self.backends]
+
+ollama = OllamaPool(
+    OLLAMA_URLS,
+    sticky=OLLAMA_STICKY,
+    eject_seconds=OLLAMA_EJECT_SECONDS,
+    probe_interval=OLLAMA_PROBE_INTERVAL,
+    pool_size=OLLAMA_POOL_SIZE,
+    connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+    read_timeout=OLLAMA_READ_TIMEOUT,
+    connect_retries=OLLAMA_CONNECT_RETRIES
+)
+
+# ============================================
+# MODEL WARM-UP
+# ============================================
+class WarmupManager:
+    """Keeps the chat models loaded in every Ollama backend so chats skip the load time
+    
+    The models are preloaded when the server starts it (start(), not on
+    import, so CLI commands don't load models) with an empty /api/generate
+    request carrying `keep_alive`, then refreshed every `interval` seconds
+    while they are wanted: during business `hours` (e.g. (8, 18), or
+    (22, 6) across midnight, local time) or while a user has been active in
+    the last `active_window` seconds. Rendering the assistant page can
+    request an early preload via request_preload().
+    """
+    
+    MIN_PRELOAD_GAP = 60
+    
+    def __init__(self, models: list, keep_alive: str, interval: float, hours=None,
+                 active_window: float = 900):
+        self.models = models
+        self.keep_alive = keep_alive
+        self.interval = interval
+        self.hours = hours
+        self.active_window = active_window
+        self.last_activity = None
+        self.last_preload = None
+        self.preloads = 0
+        self.failures = 0
+        self.results = {}       # "<backend url> <model>" -> outcome of its last preload
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.started = False
+        self.worker = threading.Thread(target=self._run, name="warmup", daemon=True)
+    
+    def start(self):
+        """Preload now and keep the models warm from then on; later calls do nothing"""
+        if self.started:
+            return
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        self.worker.start()
+    
+    @staticmethod
+    def parse_hours(spec: str):
+        """"8-18" -> (8, 18), "22-6" wraps past midnight; empty or malformed means no scheduled hours"""
+        if not spec:
+            return None
+        try:
+            start, end = (int(part) for part in spec.split("-"))
+        except ValueError:
+            start = end = None
+        if start is None or not (0 <= start <= 23 and 0 <= end <= 24):
+            logger.warning(f"Ignoring malformed WARMUP_HOURS {spec!r}, expected e.g. \"8-18\"")
+            return None
+        return start, end
+    
+    def touch(self):
+        """Note user activity, which keeps the model warm for `active_window`"""
+        self.last_activity = time.monotonic()
+    
+    def request_preload(self):
+        """Preload soon unless that was done very recently (non-blocking)"""
+        self.touch()
+        last = self.last_preload
+        if last is None or time.monotonic() - last > self.MIN_PRELOAD_GAP:
+            self.wake.set()
+    
+    def wanted(self) -> bool:
+        if self.hours is not None:
+            start, end = self.hours
+            hour = datetime.now().hour
+            if start <= end:
+                in_hours = start <= hour < end
+            else:
+                # e.g. "22-6", past midnight
+                in_hours = hour >= start or hour < end
+            if in_hours:
+                return True
+        return self.last_activity is not None and time.monotonic() - self.last_activity < self.active_window
+    
+    def _run(self):
+        self.preload("startup")
+        while True:
+            requested = self.wake.wait(self.interval)
+            self.wake.clear()
+            if requested:
+                self.preload("page view")
+            elif self.wanted():
+                self.preload("keep-alive")
+    
+    def preload(self, reason: str):
+        for backend in ollama.backends:
+            if not backend.healthy:
+                continue
+            for model in self.models:
+                self._preload(backend, model, reason)
+        self.last_preload = time.monotonic()
+    
+    def _preload(self, backend: OllamaBackend, model: str, reason: str):
+        started = time.monotonic()
+        try:
+            response = backend.client.generate({"model": model, "keep_alive": self.keep_alive})
+            response.raise_for_status()
+            data = response.json()
+            outcome = {
+                'ok': True,
+                'at': datetime.now().isoformat(),
+                'seconds': round(time.monotonic() - started, 3),
+                'load_ms': round(data.get("load_duration", 0) / 1e6)
+            }
+            logger.info(f"Preloaded {model} on {backend.name} ({reason}) in {outcome['seconds']}s")
+        except (requests.RequestException, ValueError) as e:
+            outcome = {'ok': False, 'at': datetime.now().isoformat(), 'error': str(e)}
+            logger.warning(f"Preloading {model} on {backend.name} failed: {e}")
+        with self.lock:
+            self.results[f"{backend.name} {model}"] = outcome
+            self.preloads += 1
+            self.failures += not outcome['ok']
+    
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'keep_alive': self.keep_alive,
+                'wanted': self.wanted(),
+                'preloads': self.preloads,
+                'failures': self.failures,
+                'results': dict(self.results)
+            }
+
+warmup = WarmupManager(
+    [MODEL] + ([FAST_MODEL] if FAST_MODEL and FAST_MODEL != MODEL else []),
+    WARMUP_KEEP_ALIVE,
+    WARMUP_INTERVAL,
+    hours=WarmupManager.parse_hours(WARMUP_HOURS),
+    active_window=WARMUP_ACTIVE_SECONDS
+) if WARMUP_ENABLED else None
+
+# ============================================
+# ADMISSION CONTROL
+# ============================================
+class QueueFull(Exception):
+    """Raised when the chat queue is at capacity"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"Chat queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A request's place in the OllamaScheduler queue"""
+    
+    def __init__(self, scheduler: "OllamaScheduler", email: str):
+        self.scheduler = scheduler
+        self.email = email
+        self.enqueued_at = time.monotonic()
+        self.granted = threading.Event()
+        self.granted_at = None
+        self.callbacks = []
+        self.released = False
+    
+    def wait(self, timeout: float = None) -> bool:
+        return self.granted.wait(timeout)
+    
+    def position(self) -> int:
+        return self.scheduler.position(self)
+    
+    def on_grant(self, callback):
+        """Call `callback` (from any thread) once the ticket is granted"""
+        with self.scheduler.lock:
+            if not self.granted.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+    
+    def release(self):
+        """Free the slot, or leave the queue if never granted"""
+        self.scheduler.release(self)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.release()
+
+
+class OllamaScheduler:
+    """Global concurrency limit toward Ollama with per-user fair queuing
+    
+    At most `max_concurrency` tickets hold a slot at once. Waiting tickets
+    are kept in one FIFO per user and slots are handed out round-robin
+    across users, so a user with many queued requests can't starve others.
+    """
+    
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.waiting = OrderedDict()   # email -> deque of tickets, in round-robin order
+        self.depth = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.service_avg = 10.0        # EWMA of slot hold time, for Retry-After
+    
+    def enqueue(self, email: str) -> Ticket:
+        """Join the queue, or raise QueueFull"""
+        ticket = Ticket(self, email)
+        with self.lock:
+            if self.in_flight < self.max_concurrency and not self.depth:
+                self._grant(ticket)
+                return ticket
+            if self.depth >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(self._retry_after())
+            self.waiting.setdefault(email, deque()).append(ticket)
+            self.depth += 1
+        return ticket
+    
+    def acquire(self, email: str) -> Ticket:
+        """Blocking enqueue-and-wait for background work"""
+        ticket = self.enqueue(email)
+        ticket.wait()
+        return ticket
+    
+    def position(self, ticket: Ticket) -> int:
+        """Tickets that will be granted before this one (0 once granted)"""
+        with self.lock:
+            if ticket.granted.is_set() or ticket.email not in self.waiting:
+                return 0
+            users = list(self.waiting)
+            own = self.waiting[ticket.email]
+            k = own.index(ticket) if ticket in own else 0
+            mine = users.index(ticket.email)
+            ahead = k
+            for i, email in enumerate(users):
+                if email != ticket.email:
+                    ahead += min(len(self.waiting[email]), k + (1 if i < mine else 0))
+            return ahead + 1
+    
+    def release(self, ticket: Ticket):
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted.is_set():
+                self.in_flight -= 1
+                held = time.monotonic() - ticket.granted_at
+                self.service_avg = 0.9 * self.service_avg + 0.1 * held
+            else:
+                own = self.waiting.get(ticket.email)
+                if own is not None and ticket in own:
+                    own.remove(ticket)
+                    self.depth -= 1
+                    if not own:
+                        del self.waiting[ticket.email]
+            self._dispatch()
+    
+    def _dispatch(self):
+        while self.in_flight < self.max_concurrency and self.waiting:
+            email, own = next(iter(self.waiting.items()))
+            ticket = own.popleft()
+            self.depth -= 1
+            # Rotate: this user goes to the back of the round-robin order
+            del self.waiting[email]
+            if own:
+                self.waiting[email] = own
+            self._grant(ticket)
+    
+    def _grant(self, ticket: Ticket):
+        ticket.granted_at = time.monotonic()
+        waited = ticket.granted_at - ticket.enqueued_at
+        self.in_flight += 1
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        ticket.granted.set()
+        for callback in ticket.callbacks:
+            callback()
+        ticket.callbacks = []
+    
+    def _retry_after(self) -> int:
+        return max(1, int(self.service_avg * (self.depth + 1) / self.max_concurrency))
+    
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'in_flight': self.in_flight,
+                'queue_depth': self.depth,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'avg_wait_seconds': round(self.wait_total / self.admitted, 3) if self.admitted else 0.0,
+                'max_wait_seconds': round(self.wait_max, 3)
+            }
+
+scheduler = OllamaScheduler(OLLAMA_MAX_CONCURRENCY, CHAT_MAX_QUEUE)
+
+# ============================================
+# RESPONSE CACHE
+# ============================================
+class ResponseCache:
+    """Exact-match cache of finished Ollama replies
+    
+    Keyed by a hash of the model, options and the message list actually
+    sent, so a hit means Ollama would have been given the very same prompt.
+    Replies are kept as the chunks they streamed in, for replay over SSE.
+    Entries expire after `ttl` seconds and the least recently used are
+    dropped to stay within `max_bytes`.
+    """
+    
+    ENTRY_OVERHEAD = 200
+    
+    def __init__(self, max_bytes: int, ttl: float, force: bool = False):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.force = force
+        self.entries = OrderedDict()    # key -> (expires_at, nbytes, entry)
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expired = 0
+    
+    def applies(self, payload: dict) -> bool:
+        """Only deterministic requests are cached, unless the operator forces it"""
+        return self.force or payload["options"].get("temperature") == 0
+    
+    @staticmethod
+    def key(payload: dict) -> str:
+        normalized = {
+            "model": payload["model"],
+            "options": payload["options"],
+            "messages": [{"role": m["role"], "content": m["content"].strip()} for m in payload["messages"]]
+        }
+        blob = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None and item[0] < time.monotonic():
+                self._remove(key)
+                self.expired += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return item[2]
+    
+    def put(self, key: str, chunks: list, tokens: int):
+        nbytes = sum(len(c.encode("utf-8")) for c in chunks) + self.ENTRY_OVERHEAD
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, nbytes, {'chunks': chunks, 'tokens': tokens})
+            self.nbytes += nbytes
+            self.stores += 1
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+    
+    def _remove(self, key: str):
+        _, nbytes, _ = self.entries.pop(key)
+        self.nbytes -= nbytes
+    
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'expired': self.expired
+            }
+
+response_cache = (
+    ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, force=RESPONSE_CACHE_FORCE)
+    if RESPONSE_CACHE_ENABLED else None
+)
+
+class VectorIndex:
+    """Cosine-similarity search over unit vectors
+    
+    Small indexes are searched by brute force (one matrix-vector product).
+    From `ann_min_size` vectors on, search is approximate: every vector is
+    hashed into `tables` LSH tables by which side of `bits` random
+    hyperplanes it falls on, and only rows sharing a bucket with the query,
+    or one bit away from it, in some table are scored exactly.
+    """
+    
+    def __init__(self, dim: int, tables: int = 8, bits: int = 12, ann_min_size: int = 2048, seed: int = 0):
+        self.dim = dim
+        self.ann_min_size = ann_min_size
+        self.vectors = np.zeros((64, dim), dtype=np.float32)
+        self.ids = []           # row -> entry id
+        self.rows = {}          # entry id -> row
+        self.signatures = []    # row -> one LSH signature per table
+        self.buckets = [{} for _ in range(tables)]   # per table: signature -> set of rows
+        self.planes = np.random.default_rng(seed).standard_normal((tables * bits, dim)).astype(np.float32)
+        self.bits = bits
+        self.bit_values = 1 << np.arange(bits, dtype=np.int64)
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def _signatures(self, vec) -> list:
+        sides = ((self.planes @ vec) > 0).reshape(len(self.buckets), self.bits)
+        return (sides @ self.bit_values).tolist()
+    
+    def add(self, entry_id: int, vec):
+        row = len(self.ids)
+        if row == len(self.vectors):
+            self.vectors = np.resize(self.vectors, (row * 2, self.dim))
+        self.vectors[row] = vec
+        self.ids.append(entry_id)
+        self.rows[entry_id] = row
+        self.signatures.append(self._signatures(vec))
+        self._bucket(row)
+    
+    def remove(self, entry_id: int):
+        """Drop a vector, moving the last row into its place"""
+        row = self.rows.pop(entry_id)
+        last = len(self.ids) - 1
+        self._unbucket(row)
+        if row != last:
+            self._unbucket(last)
+            self.vectors[row] = self.vectors[last]
+            self.ids[row] = self.ids[last]
+            self.signatures[row] = self.signatures[last]
+            self.rows[self.ids[row]] = row
+            self._bucket(row)
+        self.ids.pop()
+        self.signatures.pop()
+    
+    def _bucket(self, row: int):
+        for table, signature in zip(self.buckets, self.signatures[row]):
+            table.setdefault(signature, set()).add(row)
+    
+    def _unbucket(self, row: int):
+        for table, signature in zip(self.buckets, self.signatures[row]):
+            bucket = table[signature]
+            bucket.discard(row)
+            if not bucket:
+                del table[signature]
+    
+    def search(self, vec):
+        """Return (entry id, cosine similarity) of the nearest vector, or None"""
+        n = len(self.ids)
+        if n == 0 or vec.shape != (self.dim,):
+            return None
+        
+        if n < self.ann_min_size:
+            rows = None
+            sims = self.vectors[:n] @ vec
+        else:
+            candidates = set()
+            for table, signature in zip(self.buckets, self._signatures(vec)):
+                for probe in [signature] + [signature ^ int(bit) for bit in self.bit_values]:
+                    candidates.update(table.get(probe, ()))
+            if not candidates:
+                return None
+            rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            sims = self.vectors[rows] @ vec
+        
+        best = int(np.argmax(sims))
+        row = best if rows is None else int(rows[best])
+        return self.ids[row], float(sims[best])
+
+class SemanticCache:
+    """Serves near-duplicate first questions from earlier answers
+    
+    The question is embedded through Ollama's /api/embed and looked up in a
+    VectorIndex; an answer whose question scores at least `threshold`
+    cosine similarity is replayed. Only opening messages of a conversation
+    are considered, since later answers depend on the history. Each chat
+    model has its own index, so a hit is always an answer by the model the
+    turn was routed to. With scope "user" every user also has their own
+    index, otherwise one is shared. At most `max_entries` answers are kept
+    overall, least recently used evicted.
+    """
+    
+    def __init__(self, model: str, threshold: float, scope: str = "global",
+                 max_entries: int = 5000, ann_min_size: int = 2048):
+        self.model = model
+        self.threshold = threshold
+        self.scope = scope
+        self.max_entries = max_entries
+        self.ann_min_size = ann_min_size
+        self.indexes = {}               # (scope key, chat model) -> VectorIndex
+        self.entries = OrderedDict()    # entry id -> (scope key, entry)
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.embed_errors = 0
+    
+    def _scope_key(self, email: str, model: str) -> tuple:
+        return email if self.scope == "user" else "*", model
+    
+    def embed(self, text: str):
+        """Unit-length embedding of `text`, or None if Ollama couldn't provide one"""
+        try:
+            vec = np.asarray(ollama.embed(self.model, text), dtype=np.float32)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            logger.warning(f"Embedding failed, skipping semantic cache: {e}")
+            with self.lock:
+                self.embed_errors += 1
+            return None
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else None
+    
+    def lookup(self, email: str, model: str, vec):
+        with self.lock:
+            index = self.indexes.get(self._scope_key(email, model))
+            found = index.search(vec) if index is not None else None
+            if found is None or found[1] < self.threshold:
+                self.misses += 1
+                return None
+            entry_id, similarity = found
+            self.entries.move_to_end(entry_id)
+            self.hits += 1
+            logger.info(f"Semantic cache hit for {email} (similarity {similarity:.3f})")
+            return self.entries[entry_id][1]
+    
+    def put(self, email: str, model: str, vec, chunks: list, tokens: int):
+        key = self._scope_key(email, model)
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None or index.dim != vec.shape[0]:
+                index = self.indexes[key] = VectorIndex(vec.shape[0], ann_min_size=self.ann_min_size)
+            entry_id = self.next_id
+            self.next_id += 1
+            index.add(entry_id, vec)
+            self.entries[entry_id] = (key, {'chunks': chunks, 'tokens': tokens, 'model': model})
+            self.stores += 1
+            
+            while len(self.entries) > self.max_entries:
+                old_id, (old_key, _) = self.entries.popitem(last=False)
+                old_index = self.indexes[old_key]
+                if old_id in old_index.rows:
+                    old_index.remove(old_id)
+                if not len(old_index):
+                    del self.indexes[old_key]
+                self.evictions += 1
+    
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'indexes': len(self.indexes),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'embed_errors': self.embed_errors
+            }
+
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    if np is None:
+        logger.warning("SEMANTIC_CACHE_ENABLED needs numpy (pip install -r requirements.txt); semantic cache is off")
+    else:
+        semantic_cache = SemanticCache(
+            EMBED_MODEL,
+            SEMANTIC_CACHE_THRESHOLD,
+            scope=SEMANTIC_CACHE_SCOPE,
+            max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+            ann_min_size=SEMANTIC_CACHE_ANN_MIN_SIZE
+        )
+
+# ============================================
+# HELPER FUNCTIONS
+# ============================================
+def get_logged_in_email():
+    """Get current logged-in email"""
+    return session.get("email")
+
+def with_latest_messages(email: str, conv: dict) -> dict:
+    """Attach the newest page of messages to conversation metadata"""
+    page = storage.load_messages(email, conv['id'], limit=MESSAGE_PAGE_SIZE)
+    return {
+        **conv,
+        'messages': page,
+        'has_more': bool(page) and page[0]['seq'] > 0
+    }
+
+def require_auth(f):
+    """Decorator to require authentication"""
+    from functools import wraps
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        email = get_logged_in_email()
+        if not email:
+            logger.warning("Unauthorized access attempt")
+            return redirect(url_for("login"))
+        return f(*args, **kwargs)
+    return decorated
+
+# ============================================
+# AUTHENTICATION ROUTES
+# ============================================
+@app.route("/login")
+def login():
+    """Start OAuth login"""
+    try:
+        if request.host.startswith('127.0.0.1') or request.host.startswith('localhost'):
+            redirect_uri = f"{LOCAL_URL}/auth/callback"
+        else:
+            redirect_uri = f"{PRODUCTION_URL}/auth/callback"
+        
+        logger.info(f"Initiating OAuth login with redirect: {redirect_uri}")
         return oauth.google.authorize_redirect(redirect_uri)
     except Exception as e:
         logger.error(f"Login error: {e}")
@@ -259,130 +2705,1262 @@ def login():
             message=str(e)
         ), 500
 
-@app.route("/auth/callback")
-def auth_callback():
-    """Handle OAuth callback"""
-    try:
-        logger.info("Processing OAuth callback")
-        token = oauth.google.authorize_access_token()
-        user = oauth.google.userinfo()
-        email = user.get("email", "").lower()
-        name = user.get("name", "")
+@app.route("/auth/callback")
+def auth_callback():
+    """Handle OAuth callback"""
+    try:
+        logger.info("Processing OAuth callback")
+        token = oauth.google.authorize_access_token()
+        user = oauth.google.userinfo()
+        email = user.get("email", "").lower()
+        name = user.get("name", "")
+        
+        logger.info(f"OAuth successful for: {email}")
+        
+        # Store user info in session
+        session["email"] = email
+        session["name"] = name
+        session.permanent = True
+        
+        # Initialize user storage
+        storage.init_user(email)
+        
+        logger.info(f"User authenticated: {email}")
+        return redirect(url_for("assistant"))
+    
+    except Exception as e:
+        logger.error(f"OAuth callback error: {e}", exc_info=True)
+        return render_template("error.html",
+            title="Authentication Error",
+            message=str(e)
+        ), 500
+
+@app.route("/logout")
+def logout():
+    """Logout user"""
+    email = session.get("email")
+    session.clear()
+    logger.info(f"User logged out: {email or 'unknown'}")
+    return redirect("/")
+
+# ============================================
+# MAIN ROUTES
+# ============================================
+@app.route("/")
+def index():
+    """Home page"""
+    email = get_logged_in_email()
+    if email:
+        return redirect(url_for("assistant"))
+    return redirect(url_for("login"))
+
+@app.route("/assistant")
+@require_auth
+def assistant():
+    """Main assistant page"""
+    email = session.get("email")
+    name = session.get("name", "User")
+    logger.info(f"Assistant page loaded for: {email}")
+    
+    # Have the model warm by the time the user types
+    if warmup is not None and WARMUP_ON_PAGE:
+        warmup.request_preload()
+    return render_template("assistant.html", email=email, name=name)
+
+@app.route("/health")
+def health():
+    """Health check"""
+    ollama_status = "online" if ollama.is_online() else "offline"
+    
+    return jsonify({
+        "status": "running",
+        "model": MODEL,
+        "ollama": ollama_status,
+        "storage": {"backend": STORAGE_BACKEND, **storage.stats()},
+        "persistence": persistence.stats(),
+        "scheduler": scheduler.stats(),
+        "streams": streams.stats(),
+        "model_loaded": ollama.models_loaded(router.models if router is not None else [MODEL]),
+        "router": router.stats() if router is not None else None,
+        "warmup": warmup.stats() if warmup is not None else None,
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "semantic_cache": semantic_cache.stats() if semantic_cache is not None else None,
+        "backends": ollama.stats()
+    })
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def start_warmup():
+    # Entry points start it too; this covers gunicorn and `flask run`
+    if warmup is not None:
+        warmup.start()
+
+@app.after_request
+def record_request_latency(response):
+    """Observe time to response headers; streamed bodies are covered by the chat metrics"""
+    started = g.get("request_started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        http_request_seconds.observe(time.perf_counter() - started, request.method, route, str(response.status_code))
+    return response
+
+def cache_lookups() -> dict:
+    lookups = {}
+    for name, cache in (("response", response_cache), ("semantic", semantic_cache)):
+        if cache is not None:
+            stats = cache.stats()
+            lookups[(name, "hit")] = stats["hits"]
+            lookups[(name, "miss")] = stats["misses"]
+    return lookups
+
+# Read from the components' own stats at scrape time
+metrics.gauge("active_streams", "Replies being generated",
+              function=lambda: streams.stats()["active"])
+metrics.counter("chat_coalesced_total", "Chat requests answered by another request's generation", ("kind",),
+                function=lambda: {("idempotent",): streams.deduplicated, ("shared",): streams.shared})
+metrics.gauge("scheduler_in_flight", "Generations holding a slot toward Ollama",
+              function=lambda: scheduler.stats()["in_flight"])
+metrics.gauge("scheduler_queue_depth", "Chat requests waiting for a slot toward Ollama",
+              function=lambda: scheduler.stats()["queue_depth"])
+metrics.counter("scheduler_rejected_total", "Chat requests turned away because the queue was full",
+                function=lambda: scheduler.rejected)
+metrics.gauge("persistence_queue_depth", "Chat turns waiting to be written to storage",
+              function=lambda: persistence.stats()["queued"])
+metrics.counter("cache_lookups_total", "Response and semantic cache lookups", ("cache", "result"),
+                function=cache_lookups)
+metrics.gauge("ollama_backend_healthy", "Whether an Ollama backend is taking requests", ("backend",),
+              function=lambda: {(b["url"],): int(b["healthy"]) for b in ollama.stats()}, aggregate="max")
+metrics.gauge("ollama_backend_in_flight", "Requests in flight to an Ollama backend", ("backend",),
+              function=lambda: {(b["url"],): b["in_flight"] for b in ollama.stats()})
+if METRICS_ENABLED:
+    metrics.start()
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Not found"}), 404
+    if METRICS_TOKEN and not secrets.compare_digest(request.headers.get("Authorization", ""),
+                                                    f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ============================================
+# CONVERSATION API
+# ============================================
+@app.route("/api/conversations", methods=["GET"])
+@require_auth
+def get_conversations():
+    """Get user's conversation list (metadata only)"""
+    email = get_logged_in_email()
+    persistence.wait_for(email)
+    conversations = storage.list_conversations(email)
+    return jsonify({"conversations": conversations})
+
+@app.route("/api/conversations/active", methods=["GET"])
+@require_auth
+def get_active_conversation():
+    """Get active conversation with its newest messages"""
+    email = get_logged_in_email()
+    persistence.wait_for(email)
+    conv = storage.get_active_conversation(email)
+    return jsonify(with_latest_messages(email, conv))
+
+@app.route("/api/conversations/new", methods=["POST"])
+@require_auth
+def new_conversation():
+    """Create new conversation"""
+    email = get_logged_in_email()
+    conv = storage.create_new_conversation(email)
+    return jsonify(conv)
+
+@app.route("/api/conversations/<conv_id>/activate", methods=["POST"])
+@require_auth
+def activate_conversation(conv_id):
+    """Set conversation as active"""
+    email = get_logged_in_email()
+    persistence.wait_for(email)
+    success = storage.set_active_conversation(email, conv_id)
+    
+    if success:
+        conv = storage.get_active_conversation(email)
+        return jsonify(with_latest_messages(email, conv))
+    else:
+        return jsonify({"error": "Conversation not found"}), 404
+
+@app.route("/api/conversations/<conv_id>/messages", methods=["GET"])
+@require_auth
+def get_conversation_messages(conv_id):
+    """Get a page of messages older than the `before` seq cursor"""
+    email = get_logged_in_email()
+    persistence.wait_for(email)
+    if storage.get_conversation(email, conv_id) is None:
+        return jsonify({"error": "Conversation not found"}), 404
+    
+    before = request.args.get("before", type=int)
+    limit = request.args.get("limit", MESSAGE_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+    
+    page = storage.load_messages(email, conv_id, before=before, limit=limit)
+    return jsonify({
+        "messages": page,
+        "has_more": bool(page) and page[0]['seq'] > 0
+    })
+
+@app.route("/api/conversations/<conv_id>", methods=["DELETE"])
+@require_auth
+def delete_conversation(conv_id):
+    """Delete conversation"""
+    email = get_logged_in_email()
+    storage.delete_conversation(email, conv_id)
+    return jsonify({"success": True})
+
+# ============================================
+# CHAT API
+# ============================================
+class Summarizer:
+    """Keeps a rolling summary of messages that fell out of the context window
+    
+    After a turn completes, schedule() queues the conversation if enough
+    messages have dropped out since the last summary. A background worker
+    folds them into the previous summary with a non-streaming Ollama call
+    and stores the result with the conversation.
+    """
+    
+    PROMPT = (
+        "Update the running summary of a conversation between a user and Light, an AI assistant. "
+        "Keep facts, names, preferences, decisions and open questions; drop pleasantries. "
+        "Reply with the updated summary only, in at most {words} words."
+    )
+    
+    def __init__(self, min_messages: int, max_tokens: int):
+        self.min_messages = min_messages
+        self.max_tokens = max_tokens
+        self.queue = queue.Queue()
+        self.scheduled = set()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, name="summarizer", daemon=True).start()
+    
+    def schedule(self, email: str, conv: dict, first_context_seq: int):
+        """Queue a summary update if enough messages precede the context window"""
+        summary = conv.get('summary') or {}
+        if first_context_seq - summary.get('upto_seq', 0) < self.min_messages:
+            return
+        key = (email, conv['id'])
+        with self.lock:
+            if key in self.scheduled:
+                return
+            self.scheduled.add(key)
+        self.queue.put((email, conv['id'], first_context_seq))
+    
+    def _run(self):
+        while True:
+            email, conv_id, upto_seq = self.queue.get()
+            try:
+                self.update(email, conv_id, upto_seq)
+            except Exception as e:
+                logger.error(f"Summary error for {email}/{conv_id}: {e}", exc_info=True)
+            finally:
+                with self.lock:
+                    self.scheduled.discard((email, conv_id))
+    
+    def update(self, email: str, conv_id: str, upto_seq: int):
+        """Fold messages [previous upto_seq, upto_seq) into the summary
+        
+        Messages are folded in chunks that fit the context window next to
+        the prompt and the summary so far, storing the summary after each
+        chunk, so a long backlog isn't truncated by Ollama.
+        """
+        conv = storage.get_conversation(email, conv_id)
+        if conv is None:
+            return
+        summary = conv.get('summary') or {'text': '', 'upto_seq': 0}
+        if upto_seq <= summary['upto_seq']:
+            return
+        
+        messages = storage.load_messages(
+            email, conv_id, before=upto_seq, limit=upto_seq - summary['upto_seq']
+        )
+        chunks = 0
+        while messages:
+            budget = NUM_CTX - self.max_tokens - estimate_tokens(self.system_prompt()) \
+                - estimate_tokens(summary['text']) - self.PROMPT_OVERHEAD
+            chunk, messages = self._take_chunk(messages, budget)
+            text = self._fold(summary['text'], chunk)
+            summary = {
+                'text': text,
+                'upto_seq': chunk[-1]['seq'] + 1 if messages else upto_seq,
+                'tokens': estimate_tokens(text),
+                'updated_at': datetime.now().isoformat()
+            }
+            storage.set_summary(email, conv_id, summary)
+            chunks += 1
+        logger.info(f"Summarized {conv_id} for {email} up to seq {upto_seq} in {chunks} chunk(s)")
+    
+    PROMPT_OVERHEAD = 32   # "Current summary:" / "New messages:" framing
+    
+    def system_prompt(self) -> str:
+        return self.PROMPT.format(words=int(self.max_tokens * 0.75))
+    
+    @staticmethod
+    def _take_chunk(messages: list, budget: int) -> tuple:
+        """The leading messages that fit in `budget` tokens (at least one, cut to fit), and the rest"""
+        used = 0
+        for i, message in enumerate(messages):
+            used += message_tokens(message)
+            if used > budget:
+                if i:
+                    return messages[:i], messages[i:]
+                # A single message over the budget is cut down to it
+                content = message['content'][:max(0, budget - 4) * 4]
+                return [{**message, 'content': content}], messages[1:]
+        return messages, []
+    
+    def _fold(self, summary_text: str, messages: list) -> str:
+        """Ask Ollama for the summary updated with `messages`"""
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        prompt = (
+            f"Current summary:\n{summary_text or '(none)'}\n\n"
+            f"New messages:\n{transcript}"
+        )
+        
+        # Summaries share Ollama's capacity with chats, queued as their own "user"
+        with scheduler.acquire("(summarizer)"), ollama.chat({
+                "model": MODEL,
+                "messages": [
+                    {"role": "system", "content": self.system_prompt()},
+                    {"role": "user", "content": prompt}
+                ],
+                "stream": False,
+                "options": {"temperature": 0.2, "num_predict": self.max_tokens, "num_ctx": NUM_CTX}
+            }, stream=False) as (_, response):
+            response.raise_for_status()
+            return response.json()["message"]["content"].strip()
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token plus per-message overhead)"""
+    return len(text) // 4 + 4
+
+def message_tokens(message: dict) -> int:
+    """Token count cached on the stored message, estimated for older messages"""
+    tokens = message.get('tokens')
+    return tokens if tokens is not None else estimate_tokens(message['content'])
+
+def build_context(email: str, conv_id: str, user_message: dict, budget: int,
+                  block: int = 0) -> list:
+    """Pack the newest history that fits in `budget` tokens, ending with user_message
+    
+    History is read a page at a time from the newest end, so only as much
+    of a long conversation is loaded as the budget can hold. With `block`,
+    the window starts at the first multiple of `block` that fits, keeping
+    the prompt prefix unchanged across turns.
+    """
+    selected = [user_message]
+    used = message_tokens(user_message)
+    before = None
+    
+    while True:
+        page = storage.load_messages(email, conv_id, before=before, limit=MESSAGE_PAGE_SIZE)
+        for msg in reversed(page):
+            used += message_tokens(msg)
+            if used > budget:
+                return _align_window(selected[::-1], block)
+            selected.append(msg)
+        if not page or page[0]['seq'] == 0:
+            return selected[::-1]
+        before = page[0]['seq']
+
+def _align_window(window: list, block: int) -> list:
+    """Drop leading history so the window starts on a block boundary"""
+    if block <= 0 or len(window) < 2:
+        return window
+    start = -(-window[0]['seq'] // block) * block
+    return [m for m in window if m.get('seq', start) >= start]
+
+class ModelRouter:
+    """Picks the fast or the strong model for each turn
+    
+    Cheap features of the turn count toward the strong model: a long
+    message, a deep conversation, a code fence and complexity keywords;
+    `strong_score` of them are needed. An explicit request for detail always gets the strong
+    model. Otherwise the strong model is skipped when its observed speed
+    (EWMA tokens/sec) can't produce `max_tokens` within `latency_budget`
+    seconds. Users can pin "fast" or "strong" instead of "auto".
+    """
+    
+    PREFERENCES = ("auto", "fast", "strong")
+    DETAIL_PHRASES = ("in detail", "detailed", "elaborate", "step by step", "in depth",
+                      "thorough", "explain fully", "long answer")
+    EWMA_ALPHA = 0.3
+    
+    def __init__(self, fast_model: str, strong_model: str, keywords: list, long_tokens: int = 60,
+                 deep_messages: int = 20, strong_score: int = 2, latency_budget: float = 10,
+                 max_tokens: int = NUM_PREDICT):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.keywords = keywords
+        self.keyword_pattern = self._phrase_pattern(keywords) if keywords else None
+        self.detail_pattern = self._phrase_pattern(self.DETAIL_PHRASES)
+        self.long_tokens = long_tokens
+        self.deep_messages = deep_messages
+        self.strong_score = strong_score
+        self.latency_budget = latency_budget
+        self.max_tokens = max_tokens
+        self.tps = {}               # model -> EWMA tokens/sec
+        self.routed = {fast_model: 0, strong_model: 0}
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def _phrase_pattern(phrases) -> re.Pattern:
+        """Regex for any of `phrases` as whole words (so "plan" doesn't match "planet")"""
+        return re.compile(
+            r"\b(?:" + "|".join(r"\s+".join(map(re.escape, p.split())) for p in phrases) + r")\b",
+            re.IGNORECASE
+        )
+    
+    @property
+    def models(self) -> list:
+        return [self.strong_model, self.fast_model]
+    
+    def features(self, message: str, depth: int) -> dict:
+        return {
+            'long': estimate_tokens(message) >= self.long_tokens,
+            'deep': depth >= self.deep_messages,
+            'code': '```' in message,
+            'keyword': self.keyword_pattern is not None and self.keyword_pattern.search(message) is not None,
+            'detail': self.detail_pattern.search(message) is not None
+        }
+    
+    def choose(self, message: str, depth: int, preference: str = "auto", tps: dict = None) -> tuple:
+        """(model, reason) for a message sent with `depth` messages already in the conversation"""
+        if preference == "fast":
+            return self.fast_model, "user preference"
+        if preference == "strong":
+            return self.strong_model, "user preference"
+        
+        features = self.features(message, depth)
+        if features['detail']:
+            return self.strong_model, "asked for detail"
+        if features['long'] + features['deep'] + features['code'] + features['keyword'] < self.strong_score:
+            return self.fast_model, "simple turn"
+        
+        strong_tps = (tps if tps is not None else self.tps).get(self.strong_model)
+        if strong_tps and self.max_tokens / strong_tps > self.latency_budget:
+            return self.fast_model, "strong model too slow"
+        return self.strong_model, "complex turn"
+    
+    def route(self, message: str, depth: int, preference: str = "auto") -> str:
+        model, reason = self.choose(message, depth, preference)
+        with self.lock:
+            self.routed[model] += 1
+        logger.info(f"Routed to {model} ({reason})")
+        return model
+    
+    def record(self, model: str, stats: dict):
+        """Fold a finished generation's speed into the model's tokens/sec"""
+        if model not in self.routed or not stats.get("eval_count") or not stats.get("eval_duration"):
+            return
+        tps = stats["eval_count"] / (stats["eval_duration"] / 1e9)
+        with self.lock:
+            previous = self.tps.get(model)
+            self.tps[model] = tps if previous is None else previous + self.EWMA_ALPHA * (tps - previous)
+    
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'routed': dict(self.routed),
+                'tokens_per_sec': {m: round(t, 1) for m, t in self.tps.items()}
+            }
+
+router = ModelRouter(
+    FAST_MODEL,
+    MODEL,
+    ROUTER_KEYWORDS,
+    long_tokens=ROUTER_LONG_TOKENS,
+    deep_messages=ROUTER_DEEP_MESSAGES,
+    strong_score=ROUTER_STRONG_SCORE,
+    latency_budget=ROUTER_LATENCY_BUDGET,
+    max_tokens=MAX_TOKENS
+) if FAST_MODEL and FAST_MODEL != MODEL else None
+
+SYSTEM_PROMPT = "You are Light, a helpful AI assistant. Keep your responses concise and to the point. Aim for 2-4 sentences unless the user specifically asks for a detailed explanation. Be friendly but brief."
+
+class ChatTurn:
+    """One user message and the assistant reply streamed back for it
+    
+    Holds no I/O: the threaded and async servers each read Ollama's NDJSON
+    their own way and pass every line to feed(), which returns the SSE
+    frames to send and persists the turn once Ollama reports done. A reply
+    found in the response cache is played back through the same path, as is
+    one mirrored from an identical prompt that is still generating.
+    
+    Content is coalesced into fewer, larger frames: it is held until
+    `coalesce_ms` have passed since the last frame or `coalesce_bytes` are
+    pending, except for the first token, which goes out immediately. Held
+    content is checked when the next chunk arrives; a quiet upstream is
+    covered by the stream's readers calling flush() once flush_delay() is 0.
+    
+    In `relay` (passthrough) mode, content chunks aren't parsed as a whole:
+    only their content string is decoded, and its JSON literal is copied
+    into the SSE frame unchanged.
+    """
+    
+    def __init__(self, email: str, conv: dict, user_message: dict, payload: dict,
+                 first_context_seq: int = 0, coalesce_ms: float = SSE_COALESCE_MS,
+                 coalesce_bytes: int = SSE_COALESCE_BYTES, relay: bool = STREAM_RELAY == "passthrough"):
+        self.email = email
+        self.conv = conv
+        self.user_message = user_message
+        self.payload = payload
+        self.first_context_seq = first_context_seq
+        self.parts = []         # reply content, joined once at the end
+        self.stats = {}
+        self.cache_key = None   # set when the reply may be served from / stored in the cache
+        self.cached = None      # cache entry to replay instead of calling Ollama
+        self.embedding = None   # question embedding, for the semantic cache
+        self.chunks = []
+        self.coalesce_seconds = coalesce_ms / 1000
+        self.coalesce_bytes = coalesce_bytes
+        self.pending = []       # JSON-escaped content not yet sent
+        self.pending_bytes = 0
+        self.pending_chars = 0
+        self.sent_chars = 0     # length of the reply text sent in frames so far
+        self.last_flush = None  # None until the first frame has gone out
+        self.relay = relay
+        self.shared = False     # reply mirrored from an identical generation already running
+        self.done = False
+        self.persisted = False
+        self.started = time.monotonic()
+        self.first_token_at = None
+    
+    @property
+    def full_response(self) -> str:
+        return "".join(self.parts)
+    
+    @property
+    def origin(self) -> str:
+        """Where the reply comes from: ollama, cache or shared"""
+        if self.cached is not None:
+            return "cache"
+        return "shared" if self.shared else "ollama"
+    
+    @staticmethod
+    def sse(data: dict) -> str:
+        return f"data: {json.dumps(data)}\n\n"
+    
+    STAT_FIELDS = ("prompt_eval_count", "prompt_eval_duration", "eval_count",
+                   "eval_duration", "load_duration", "total_duration")
+    
+    def record_stats(self, final_chunk: dict) -> dict:
+        """Keep Ollama's timing counters from the final chunk
+        
+        prompt_eval_count only covers prompt tokens that weren't served from
+        the KV cache, so it drops sharply when the prompt prefix is reused.
+        """
+        stats = {k: final_chunk[k] for k in self.STAT_FIELDS if k in final_chunk}
+        if "prompt_eval_count" in stats:
+            prompt_tokens = sum(message_tokens(m) for m in self.payload["messages"])
+            logger.info(
+                f"Prompt eval for {self.conv['id']}: {stats['prompt_eval_count']} of ~{prompt_tokens} tokens "
+                f"in {stats.get('prompt_eval_duration', 0) / 1e6:.0f}ms"
+            )
+        return stats
+    
+    def feed(self, line) -> list:
+        """Consume one NDJSON line from Ollama"""
+        if not line:
+            return []
+        
+        if self.relay:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", "replace")
+            frames = self._relay(line)
+            if frames is not None:
+                return frames
+        
+        try:
+            chunk_data = json.loads(line)
+        except json.JSONDecodeError:
+            return []
+        return self.handle(chunk_data)
+    
+    CONTENT_KEY = '"content":'
+    DONE_KEY = '"done":'
+    _decoder = json.JSONDecoder()
+    
+    def _relay(self, line: str):
+        """Fast path for content chunks; None when the line needs a full decode"""
+        done = line.rfind(self.DONE_KEY)
+        if done == -1 or line[done + len(self.DONE_KEY):].lstrip()[:1] != "f":
+            return None
+        start = line.find(self.CONTENT_KEY)
+        if start == -1:
+            return None
+        start += len(self.CONTENT_KEY)
+        while start < len(line) and line[start] == " ":
+            start += 1
+        try:
+            content, end = self._decoder.raw_decode(line, start)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(content, str):
+            return None
+        return self._content(content, line[start:end])
+    
+    def _content(self, content: str, literal: str = None) -> list:
+        """Buffer reply content; `literal` is its JSON string literal if already at hand"""
+        if not content:
+            return []
+        self.parts.append(content)
+        if self.cache_key is not None or self.embedding is not None:
+            self.chunks.append(content)
+        escaped = (literal or json.dumps(content))[1:-1]
+        self.pending.append(escaped)
+        self.pending_bytes += len(escaped)
+        self.pending_chars += len(content)
+        if (self.last_flush is None
+                or self.pending_bytes >= self.coalesce_bytes
+                or time.monotonic() - self.last_flush >= self.coalesce_seconds):
+            return [self.flush()]
+        return []
+    
+    def flush_delay(self):
+        """Seconds until held content is due to be sent (0 if it is), or None if none is held"""
+        if not self.pending:
+            return None
+        return max(0.0, self.last_flush + self.coalesce_seconds - time.monotonic())
+    
+    def flush(self) -> str:
+        """Frame for all pending content, assembled without re-encoding it"""
+        content = "".join(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        self.sent_chars += self.pending_chars
+        self.pending_chars = 0
+        self.last_flush = time.monotonic()
+        if self.first_token_at is None:
+            self.first_token_at = self.last_flush
+            ttft_seconds.observe(self.first_token_at - self.started, self.payload["model"], self.origin)
+        return 'data: {"content": "' + content + '"}\n\n'
+    
+    def restart(self) -> list:
+        """Drop the reply so far, for generating it again from scratch"""
+        self.parts = []
+        self.chunks = []
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_chars = 0
+        self.sent_chars = 0
+        self.last_flush = None
+        self.shared = False
+        return [self.sse({'snapshot': ''})]
+    
+    def replay(self):
+        """Chunks playing the cached reply back through handle(), one per originally streamed chunk"""
+        for content in self.cached['chunks']:
+            yield {"message": {"content": content}}
+        yield {"done": True, "eval_count": self.cached['tokens']}
+    
+    def handle(self, chunk_data: dict) -> list:
+        frames = []
+        if "message" in chunk_data and "content" in chunk_data["message"]:
+            frames.extend(self._content(chunk_data["message"]["content"]))
+        
+        if chunk_data.get("done", False):
+            self.done = True
+            if self.pending:
+                frames.append(self.flush())
+            stats = self.stats = self.record_stats(chunk_data)
+            full_response = self.full_response
+            assistant_message = {
+                "role": "assistant",
+                "content": full_response,
+                "timestamp": datetime.now().isoformat(),
+                # Ollama reports the exact count for generated text
+                "tokens": chunk_data.get("eval_count") or estimate_tokens(full_response),
+                "stats": stats,
+                "model": self.payload["model"]
+            }
+            if self.cached is not None:
+                assistant_message["cached"] = True
+            else:
+                if self.cache_key is not None and not self.shared:
+                    response_cache.put(self.cache_key, self.chunks, assistant_message["tokens"])
+                if self.embedding is not None:
+                    semantic_cache.put(self.email, self.payload["model"], self.embedding, self.chunks,
+                                       assistant_message["tokens"])
+            
+            self._persist(assistant_message)
+            self._record_metrics("done", assistant_message["tokens"])
+            frames.append(self.sse({'done': True}))
+        return frames
+    
+    def stop(self) -> list:
+        """Final frames for a generation cut short, persisting the partial reply
+        
+        Nothing is stored if no reply text was produced yet.
+        """
+        if self.persisted:
+            return []
+        frames = [self.flush()] if self.pending else []
+        full_response = self.full_response
+        if full_response:
+            self._persist({
+                "role": "assistant",
+                "content": full_response,
+                "timestamp": datetime.now().isoformat(),
+                "tokens": estimate_tokens(full_response),
+                "stats": {},
+                "model": self.payload["model"],
+                "stopped": True
+            })
+        self._record_metrics("stopped")
+        frames.append(self.sse({'stopped': True}))
+        return frames
+    
+    def _record_metrics(self, outcome: str, tokens: int = 0):
+        model, origin = self.payload["model"], self.origin
+        replies_total.inc(model, origin, outcome)
+        if outcome != "done":
+            return
+        generation_seconds.observe(time.monotonic() - self.started, model, origin)
+        if origin != "ollama":
+            return
+        
+        # Ollama's own counters, only for replies it actually generated
+        stats = self.stats
+        generated_tokens.inc(model, amount=tokens)
+        if stats.get("eval_count") and stats.get("eval_duration"):
+            tokens_per_second.observe(stats["eval_count"] / (stats["eval_duration"] / 1e9), model)
+        prompt_tokens.observe(sum(message_tokens(m) for m in self.payload["messages"]), model, "estimated")
+        if "prompt_eval_count" in stats:
+            prompt_tokens.observe(stats["prompt_eval_count"], model, "evaluated")
+        if "load_duration" in stats:
+            model_load_seconds.observe(stats["load_duration"] / 1e9, model)
+    
+    def _persist(self, assistant_message: dict):
+        # Persist this turn in the background
+        self.persisted = True
+        persistence.submit(self.email, self.conv['id'], [self.user_message, assistant_message])
+        
+        if summarizer is not None:
+            summarizer.schedule(self.email, self.conv, self.first_context_seq)
+
+def start_chat_turn(email: str, message: str, preference: str = "auto") -> ChatTurn:
+    """Load context for a new message and build the Ollama request (blocking)"""
+    started = time.monotonic()
+    if warmup is not None:
+        warmup.touch()
+    
+    # Get active conversation (after any of its turns still being persisted)
+    persistence.wait_for(email)
+    conv = storage.get_active_conversation(email)
+    
+    # Add user message
+    user_message = {
+        "role": "user",
+        "content": message,
+        "timestamp": datetime.now().isoformat(),
+        "tokens": estimate_tokens(message)
+    }
+    
+    # Fit as much recent history as the context window allows
+    summary = conv.get('summary') if summarizer is not None else None
+    budget = NUM_CTX - NUM_PREDICT - estimate_tokens(SYSTEM_PROMPT)
+    if summary:
+        budget -= summary['tokens']
+    context_messages = build_context(email, conv['id'], user_message, budget, CONTEXT_BLOCK_MESSAGES)
+    first_context_seq = context_messages[0].get('seq', conv['message_count'])
+    
+    # Prepare Ollama payload with system prompt for concise responses
+    ollama_messages = [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT
+        }
+    ]
+    if summary:
+        ollama_messages.append({
+            "role": "system",
+            "content": f"Summary of the earlier conversation:\n{summary['text']}"
+        })
+    ollama_messages.extend([{"role": m["role"], "content": m["content"]} for m in context_messages])
+    
+    model = router.route(message, conv['message_count'], preference) if router is not None else MODEL
+    payload = {
+        "model": model,
+        "messages": ollama_messages,
+        "stream": True,
+        "options": {
+            "temperature": CHAT_TEMPERATURE,
+            "num_predict": NUM_PREDICT,  # Shorter responses
+            "num_ctx": NUM_CTX
+        }
+    }
+    if OLLAMA_KEEP_ALIVE:
+        payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+    
+    turn = ChatTurn(email, conv, user_message, payload, first_context_seq)
+    turn.started = started
+    if response_cache is not None and response_cache.applies(payload):
+        turn.cache_key = response_cache.key(payload)
+        turn.cached = response_cache.get(turn.cache_key)
+    
+    # Near-duplicate opening questions can be answered from the semantic cache
+    if turn.cached is None and semantic_cache is not None and conv['message_count'] == 0:
+        turn.embedding = semantic_cache.embed(message)
+        if turn.embedding is not None:
+            turn.cached = semantic_cache.lookup(email, model, turn.embedding)
+    return turn
+
+summarizer = Summarizer(SUMMARY_MIN_MESSAGES, SUMMARY_MAX_TOKENS) if SUMMARY_ENABLED else None
+
+class GenerationStream:
+    """A chat reply being generated, decoupled from the clients reading it
+    
+    A producer (a thread, or an asyncio task in ASGI mode) reads Ollama at
+    full speed and appends the turn's SSE frames here under increasing
+    event ids, so a slow client doesn't hold the Ollama slot and a dropped
+    one can reconnect with Last-Event-ID. Only the newest `max_bytes` of
+    frames are kept; a client resuming from before them first gets a
+    snapshot of the reply text up to the trimmed point.
+    
+    Generation is cancelled explicitly via cancel(), or once no client has
+    been attached for `grace` seconds; the producer then closes the Ollama
+    response through `abort` so the model stops generating.
+    
+    A stream with a `source` doesn't call Ollama: its turn mirrors the
+    content of that stream, an identical prompt already generating, which
+    counts it as one of its readers meanwhile.
+    """
+    
+    def __init__(self, email: str, turn: ChatTurn, ticket: Ticket = None, max_bytes: int = 262144):
+        self.id = secrets.token_urlsafe(12)
+        self.email = email
+        self.turn = turn
+        self.ticket = ticket
+        self.max_bytes = max_bytes
+        self.events = deque()       # (event id, frame, reply chars sent through this event)
+        self.nbytes = 0
+        self.last_id = 0
+        self.trimmed_id = 0         # newest event id dropped from the buffer
+        self.trimmed_chars = 0
+        self.finished_at = None
+        self.cond = threading.Condition()
+        self.listeners = []
+        self.readers = 0
+        self.grace_timer = None
+        self.cancelled = None       # reason, once cancelled
+        self.abort = None           # set by the producer: stops reading Ollama at once
+        self.idempotency_key = None
+        self.source = None          # stream whose generation this one mirrors
+        self.mirrored = 0           # source content chunks copied so far
+    
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+    
+    def queued(self) -> bool:
+        source, ticket = self.source, self.ticket
+        if source is not None:
+            return source.queued()
+        return ticket is not None and not ticket.granted.is_set()
+    
+    def position(self) -> int:
+        source, ticket = self.source, self.ticket
+        if source is not None:
+            return source.position()
+        return ticket.position() if ticket is not None else 0
+    
+    def take_shared(self) -> tuple:
+        """Append source content not mirrored yet; the source's last event id, and whether it's finished
         
-        logger.info(f"OAuth successful for: {email}")
+        Once the source is finished, the turn is done too if the source
+        completed; otherwise it has to be generated on its own.
+        """
+        source = self.source
+        with source.cond:
+            chunks = source.turn.chunks[self.mirrored:]
+            last_id = source.last_id
+            finished = source.finished
+        self.mirrored += len(chunks)
+        for content in chunks:
+            self.push(self.turn.handle, {"message": {"content": content}})
+        if finished and source.turn.done:
+            self.push(self.turn.handle, {"done": True, **source.turn.stats})
+        return last_id, finished
+    
+    def push(self, step, *args):
+        """Append the frames of `step(*args)`, a call into the turn, in one locked step
         
-        # Store user info in session
-        session["email"] = email
-        session["name"] = name
-        session.permanent = True
+        Readers flush held-back content from their own threads, so a turn
+        update must not interleave with one between computing its frames
+        and appending them.
+        """
+        with self.cond:
+            frames = step(*args)
+            if frames:
+                self.append(frames)
+            elif len(self.turn.pending) == 1:
+                # Content just started being held: readers need its deadline
+                self._notify()
+    
+    def flush_held(self):
+        """Send content the turn held back for coalescing if it is due
         
-        # Initialize user storage
-        storage.get_user_dir(email)
+        Returns the seconds until held content will be due, or None if
+        nothing is held.
+        """
+        with self.cond:
+            delay = self.turn.flush_delay()
+            if delay == 0:
+                self.append([self.turn.flush()])
+                return None
+            return delay
+    
+    def append(self, frames: list):
+        if not frames:
+            return
+        with self.cond:
+            chars = self.turn.sent_chars
+            for frame in frames:
+                self.last_id += 1
+                self.events.append((self.last_id, frame, chars))
+                self.nbytes += len(frame)
+            while self.nbytes > self.max_bytes and len(self.events) > 1:
+                self.trimmed_id, frame, self.trimmed_chars = self.events.popleft()
+                self.nbytes -= len(frame)
+            self._notify()
+    
+    def finish(self):
+        with self.cond:
+            self.finished_at = time.monotonic()
+            self._notify()
+    
+    def _notify(self):
+        self.cond.notify_all()
+        for listener in self.listeners:
+            listener()
+    
+    def read(self, after: int) -> tuple:
+        """SSE text for events after id `after`, the id read up to, and whether that's all"""
+        with self.cond:
+            out = []
+            if after < self.trimmed_id:
+                snapshot = self.turn.full_response[:self.trimmed_chars]
+                out.append(f"id: {self.trimmed_id}\n" + ChatTurn.sse({'snapshot': snapshot}))
+                after = self.trimmed_id
+            if self.events and after < self.last_id:
+                start = after + 1 - self.events[0][0]
+                for event_id, frame, _ in islice(self.events, start, None):
+                    out.append(f"id: {event_id}\n{frame}")
+                after = self.last_id
+            return "".join(out), after, self.finished
+    
+    def wait(self, after: int, timeout: float) -> bool:
+        """Block until there are events after `after` or the stream ends
         
-        logger.info(f"User authenticated: {email}")
-        return redirect(url_for("assistant"))
+        Content held for coalescing is sent meanwhile once it's due, even
+        if Ollama has gone quiet.
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not (self.last_id > after or self.finished):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                held = self.flush_held()
+                if self.last_id > after:
+                    break
+                self.cond.wait(remaining if held is None else min(held, remaining))
+            return True
     
-    except Exception as e:
-        logger.error(f"OAuth callback error: {e}", exc_info=True)
-        return render_template("error.html",
-            title="Authentication Error",
-            message=str(e)
-        ), 500
-
-@app.route("/logout")
-def logout():
-    """Logout user"""
-    email = session.get("email")
-    session.clear()
-    logger.info(f"User logged out: {email or 'unknown'}")
-    return redirect("/")
+    def attach(self):
+        with self.cond:
+            self.readers += 1
+            if self.grace_timer is not None:
+                self.grace_timer.cancel()
+                self.grace_timer = None
+    
+    def detach(self, grace: float):
+        """A client went away; cancel if none is back within `grace` seconds"""
+        with self.cond:
+            self.readers -= 1
+            if self.readers or self.finished:
+                return
+            self.grace_timer = threading.Timer(grace, self._grace_expired)
+            self.grace_timer.daemon = True
+            self.grace_timer.start()
+    
+    def _grace_expired(self):
+        with self.cond:
+            if self.readers or self.finished:
+                return
+        logger.info(f"No client on stream {self.id} for {STREAM_CANCEL_GRACE}s, stopping generation")
+        self.cancel("disconnected")
+    
+    def cancel(self, reason: str) -> bool:
+        """Stop generating; False if the reply had already finished"""
+        with self.cond:
+            if self.finished or self.cancelled:
+                return False
+            self.cancelled = reason
+            abort = self.abort
+        if abort is not None:
+            abort()
+        return True
+    
+    def subscribe(self, listener):
+        """Call `listener` (from the appending thread) on every change"""
+        with self.cond:
+            self.listeners.append(listener)
+    
+    def unsubscribe(self, listener):
+        with self.cond:
+            self.listeners.remove(listener)
 
-# ============================================
-# MAIN ROUTES
-# ============================================
-@app.route("/")
-def index():
-    """Home page"""
-    email = get_logged_in_email()
-    if email:
-        return redirect(url_for("assistant"))
-    return redirect(url_for("login"))
+class StreamRegistry:
+    """Live and recently finished generation streams, by id
+    
+    Also indexes them by the client's idempotency key, so a duplicate chat
+    request gets the existing stream, and by response cache key while they
+    are generating, so an identical prompt can mirror one of them.
+    """
+    
+    def __init__(self, retain_seconds: float):
+        self.retain_seconds = retain_seconds
+        self.streams = {}
+        self.keys = {}          # (email, idempotency key) -> stream id
+        self.flights = {}       # (email, idempotency key) -> Event, while its stream is set up
+        self.generating = {}    # response cache key -> stream calling Ollama for it
+        self.lock = threading.Lock()
+        self.deduplicated = 0
+        self.shared = 0
+    
+    def add(self, stream: GenerationStream):
+        with self.lock:
+            now = time.monotonic()
+            expired = [sid for sid, s in self.streams.items()
+                       if s.finished and now - s.finished_at > self.retain_seconds]
+            for sid in expired:
+                expired_stream = self.streams.pop(sid)
+                if expired_stream.idempotency_key is not None:
+                    self.keys.pop((expired_stream.email, expired_stream.idempotency_key), None)
+            for key in [k for k, s in self.generating.items() if s.finished]:
+                del self.generating[key]
+            self.streams[stream.id] = stream
+            if stream.idempotency_key is not None:
+                self.keys[(stream.email, stream.idempotency_key)] = stream.id
+    
+    def get(self, stream_id: str, email: str):
+        """The stream if it exists and belongs to `email`"""
+        with self.lock:
+            stream = self.streams.get(stream_id)
+        return stream if stream is not None and stream.email == email else None
+    
+    def open(self, email: str, idempotency_key: str, create) -> tuple:
+        """(stream, created): the stream for this key, set up by create() only once
+        
+        Single-flight: while one request for the key is in create(), the
+        others wait and then get its stream. If create() raises, a waiting
+        request tries in its place.
+        """
+        if not idempotency_key:
+            stream = create()
+            self.add(stream)
+            return stream, True
+        
+        ident = (email, idempotency_key)
+        while True:
+            with self.lock:
+                stream = self.streams.get(self.keys.get(ident))
+                if stream is not None:
+                    self.deduplicated += 1
+                    return stream, False
+                flight = self.flights.get(ident)
+                if flight is None:
+                    flight = self.flights[ident] = threading.Event()
+                    break
+            flight.wait()
+        
+        try:
+            stream = create()
+            stream.idempotency_key = idempotency_key
+            self.add(stream)
+            return stream, True
+        finally:
+            with self.lock:
+                del self.flights[ident]
+            flight.set()
+    
+    def generating_for(self, cache_key: str):
+        """The stream still generating the reply for `cache_key`, if any"""
+        with self.lock:
+            stream = self.generating.get(cache_key)
+            if stream is None or stream.finished or stream.cancelled:
+                return None
+            self.shared += 1
+            return stream
+    
+    def lead(self, cache_key: str, stream: GenerationStream):
+        """Register `stream` as generating for `cache_key`, unless another got there first
+        
+        Returns that other stream, or None.
+        """
+        with self.lock:
+            leader = self.generating.get(cache_key)
+            if leader is not None and not leader.finished and not leader.cancelled:
+                self.shared += 1
+                return leader
+            self.generating[cache_key] = stream
+            return None
+    
+    def stats(self) -> dict:
+        with self.lock:
+            active = sum(1 for s in self.streams.values() if not s.finished)
+            return {'active': active, 'retained': len(self.streams) - active,
+                    'deduplicated': self.deduplicated, 'shared': self.shared}
 
-@app.route("/assistant")
-@require_auth
-def assistant():
-    """Main assistant page"""
-    email = session.get("email")
-    name = session.get("name", "User")
-    logger.info(f"Assistant page loaded for: {email}")
-    return render_template("assistant.html", email=email, name=name)
+streams = StreamRegistry(STREAM_RETAIN_SECONDS)
 
-@app.route("/health")
-def health():
-    """Health check"""
-    try:
-        response = requests.get("http://localhost:11434/api/tags", timeout=2)
-        ollama_status = "online" if response.status_code == 200 else "offline"
-    except:
-        ollama_status = "offline"
+def create_stream(email: str, message: str, preference: str = "auto") -> GenerationStream:
+    """Set up the stream for a new chat message (blocking); raises QueueFull
     
-    return jsonify({
-        "status": "running",
-        "model": MODEL,
-        "ollama": ollama_status
-    })
-
-# ============================================
-# CONVERSATION API
-# ============================================
-@app.route("/api/conversations", methods=["GET"])
-@require_auth
-def get_conversations():
-    """Get user's conversations"""
-    email = get_logged_in_email()
-    conversations = storage.load_conversations(email)
-    return jsonify({"conversations": conversations})
+    Cached replies don't need a slot toward Ollama, and neither do ones
+    mirrored from an identical prompt that is already generating.
+    """
+    turn = start_chat_turn(email, message, preference)
+    stream = GenerationStream(email, turn, None, STREAM_BUFFER_BYTES)
+    if turn.cached is not None:
+        return stream
+    
+    coalesce = RESPONSE_CACHE_COALESCE and turn.cache_key is not None
+    if coalesce:
+        stream.source = streams.generating_for(turn.cache_key)
+    if stream.source is None:
+        stream.ticket = scheduler.enqueue(email)
+        if coalesce:
+            stream.source = streams.lead(turn.cache_key, stream)
+            if stream.source is not None:
+                stream.ticket.release()
+                stream.ticket = None
+    if stream.source is not None:
+        turn.shared = True
+        logger.info(f"Stream {stream.id} mirrors identical generation {stream.source.id}")
+    return stream
 
-@app.route("/api/conversations/active", methods=["GET"])
-@require_auth
-def get_active_conversation():
-    """Get active conversation"""
-    email = get_logged_in_email()
-    conv = storage.get_active_conversation(email)
-    return jsonify(conv)
+def mirror(stream: GenerationStream) -> bool:
+    """Copy the source stream's reply into this one; False if it didn't complete"""
+    source = stream.source
+    source.attach()
+    try:
+        while True:
+            last_id, finished = stream.take_shared()
+            if finished:
+                return source.turn.done
+            if stream.cancelled:
+                return False
+            source.wait(last_id, timeout=1.0)
+    finally:
+        source.detach(STREAM_CANCEL_GRACE)
 
-@app.route("/api/conversations/new", methods=["POST"])
-@require_auth
-def new_conversation():
-    """Create new conversation"""
-    email = get_logged_in_email()
-    conv = storage.create_new_conversation(email)
-    return jsonify(conv)
+def produce(stream: GenerationStream):
+    """Generate the reply into the stream (runs on its own thread)"""
+    turn = stream.turn
+    try:
+        if turn.cached is not None:
+            for chunk in turn.replay():
+                if stream.cancelled:
+                    return
+                stream.push(turn.handle, chunk)
+                if RESPONSE_CACHE_REPLAY_DELAY_MS:
+                    time.sleep(RESPONSE_CACHE_REPLAY_DELAY_MS / 1000)
+            return
+        
+        if stream.source is not None:
+            if mirror(stream) or stream.cancelled:
+                return
+            # The generation being mirrored failed or was stopped: run our own
+            logger.info(f"Stream {stream.id} lost its source {stream.source.id}, generating on its own")
+            stream.source = None
+            stream.push(turn.restart)
+            stream.ticket = scheduler.enqueue(stream.email)
+        
+        while not stream.ticket.wait(timeout=1.0):
+            if stream.cancelled:
+                return
+        
+        with ollama.chat(turn.payload, key=turn.conv['id']) as (backend, response):
+            # Dropping the connection from another thread makes Ollama stop
+            # generating, and fails our read even if no line is arriving
+            stream.abort = lambda: OllamaClient.abort(response)
+            if stream.cancelled or response.status_code != 200:
+                if not stream.cancelled:
+                    stream.append([turn.sse({'error': f'Ollama error: {response.status_code}'})])
+                return
+            
+            # Read to the end of the stream (rather than breaking on done)
+            # so the pooled connection can be reused
+            for line in response.iter_lines(chunk_size=OLLAMA_READ_CHUNK_SIZE):
+                if stream.cancelled:
+                    return
+                stream.push(turn.feed, line)
+            ollama.record(backend, turn.stats)
+            if router is not None:
+                router.record(turn.payload["model"], turn.stats)
+    
+    except Exception as e:
+        if not stream.cancelled:
+            logger.error(f"Stream error: {e}", exc_info=True)
+            stream.append([turn.sse({'error': str(e)})])
+    finally:
+        if stream.cancelled:
+            logger.info(f"Stopped stream {stream.id} ({stream.cancelled}) after {len(turn.full_response)} chars")
+            stream.push(turn.stop)
+        if stream.ticket is not None:
+            stream.ticket.release()
+        stream.finish()
 
-@app.route("/api/conversations/<conv_id>/activate", methods=["POST"])
-@require_auth
-def activate_conversation(conv_id):
-    """Set conversation as active"""
-    email = get_logged_in_email()
-    success = storage.set_active_conversation(email, conv_id)
+def follow(stream: GenerationStream, after: int = 0):
+    """SSE for a client reading `stream` from event id `after` on
     
-    if success:
-        conv = storage.get_active_conversation(email)
-        return jsonify(conv)
-    else:
-        return jsonify({"error": "Conversation not found"}), 404
+    While nothing else is sent, a comment goes out every
+    STREAM_HEARTBEAT_SECONDS so a vanished client shows up as a failed write.
+    """
+    stream.attach()
+    try:
+        last_write = time.monotonic()
+        while True:
+            text, after, finished = stream.read(after)
+            if text:
+                yield text
+                last_write = time.monotonic()
+            if finished:
+                return
+            if stream.wait(after, timeout=1.0):
+                continue
+            # Report queue position until a slot toward Ollama frees up
+            if stream.queued():
+                yield ChatTurn.sse({'queued': True, 'position': stream.position()})
+                last_write = time.monotonic()
+            elif time.monotonic() - last_write >= STREAM_HEARTBEAT_SECONDS:
+                yield ": keep-alive\n\n"
+                last_write = time.monotonic()
+    finally:
+        stream.detach(STREAM_CANCEL_GRACE)
+
+def last_event_id() -> int:
+    """Last-Event-ID from the header (or query string) of a resuming client"""
+    value = request.headers.get("Last-Event-ID") or request.args.get("last_event_id", "0")
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return 0
 
-@app.route("/api/conversations/<conv_id>", methods=["DELETE"])
-@require_auth
-def delete_conversation(conv_id):
-    """Delete conversation"""
-    email = get_logged_in_email()
-    storage.delete_conversation(email, conv_id)
-    return jsonify({"success": True})
 
-# ============================================
-# CHAT API
-# ============================================
 @app.route("/api/chat", methods=["POST"])
 @require_auth
 def chat():
@@ -394,97 +3972,494 @@ def chat():
         if not message:
             return jsonify({"error": "No message provided"}), 400
         
+        key = request.headers.get("Idempotency-Key", "").strip()
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return jsonify({"error": "Idempotency key too long"}), 400
+        
         email = get_logged_in_email()
         logger.info(f"Chat request from {email}: {message[:50]}...")
         
-        # Get active conversation
-        conv = storage.get_active_conversation(email)
-        messages = conv.get('messages', [])
+        preference = session.get("model_preference", "auto")
+        try:
+            stream, created = streams.open(email, key, lambda: create_stream(email, message, preference))
+        except QueueFull as e:
+            logger.warning(f"Rejected chat from {email}: {e}")
+            response = jsonify({"error": "Server busy, please retry shortly"})
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response, 429
         
-        # Add user message
-        messages.append({
-            "role": "user",
-            "content": message,
-            "timestamp": datetime.now().isoformat()
-        })
+        if created:
+            # The reply is generated on its own thread whether or not anyone is reading
+            threading.Thread(target=produce, args=(stream,), name=f"stream-{stream.id}", daemon=True).start()
+        elif stream.turn.user_message["content"] != message:
+            return jsonify({"error": "Idempotency key was used for a different message"}), 422
+        else:
+            logger.info(f"Duplicate chat request from {email}, attaching to stream {stream.id}")
+        
+        response = Response(follow(stream), mimetype="text/event-stream")
+        response.headers["X-Stream-Id"] = stream.id
+        return response
+    
+    except Exception as e:
+        logger.error(f"Chat endpoint error: {e}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/chat/<stream_id>/cancel", methods=["POST"])
+@require_auth
+def cancel_chat(stream_id):
+    """Stop generating a reply; the partial answer is kept, marked stopped"""
+    stream = streams.get(stream_id, get_logged_in_email())
+    if stream is None:
+        return jsonify({"error": "Stream not found"}), 404
+    return jsonify({"success": True, "stopped": stream.cancel("user")})
+
+@app.route("/api/chat/<stream_id>/events", methods=["GET"])
+@require_auth
+def resume_chat(stream_id):
+    """Resume a reply's SSE stream after the event id in Last-Event-ID"""
+    stream = streams.get(stream_id, get_logged_in_email())
+    if stream is None:
+        return jsonify({"error": "Stream not found"}), 404
+    
+    response = Response(follow(stream, last_event_id()), mimetype="text/event-stream")
+    response.headers["X-Stream-Id"] = stream.id
+    return response
+
+@app.route("/api/settings/model", methods=["GET", "POST"])
+@require_auth
+def model_preference():
+    """Get or set which model answers this user: auto (routed), fast or strong"""
+    if request.method == "POST":
+        preference = (request.get_json(silent=True) or {}).get("preference", "")
+        if preference not in ModelRouter.PREFERENCES:
+            return jsonify({"error": f"preference must be one of {', '.join(ModelRouter.PREFERENCES)}"}), 400
+        session["model_preference"] = preference
+    
+    return jsonify({
+        "preference": session.get("model_preference", "auto"),
+        "fast_model": router.fast_model if router is not None else None,
+        "strong_model": MODEL
+    })
+
+# ============================================
+# ASYNC SERVING (ASGI)
+# ============================================
+class AsyncChatServer:
+    """ASGI entry point that streams /api/chat on an event loop
+    
+    Each chat stream is a coroutine reading Ollama through an httpx
+    AsyncClient, so idle-waiting generations don't hold OS threads. Every
+    other route is delegated to the Flask app through asgiref's WsgiToAsgi.
+    Run with SERVER_MODE=asgi, or `uvicorn main:asgi_app`.
+    """
+    
+    def __init__(self, flask_app: Flask):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.client = None
+        self.producers = set()      # running producer tasks, referenced until done
+    
+    def _client(self) -> "httpx.AsyncClient":
+        # Created lazily so it binds to the server's running event loop
+        if self.client is None:
+            # One client for every backend; requests use absolute URLs.
+            # Limits go on the transport: the client ignores its own when given one
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT, pool=None),
+                transport=httpx.AsyncHTTPTransport(
+                    retries=OLLAMA_CONNECT_RETRIES,
+                    limits=httpx.Limits(max_connections=OLLAMA_POOL_SIZE,
+                                        max_keepalive_connections=OLLAMA_POOL_SIZE)
+                )
+            )
+        return self.client
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http" and scope["path"] == "/api/chat" and scope["method"] == "POST":
+            await self._timed("/api/chat", self.chat, scope, receive, send)
+        elif (scope["type"] == "http" and scope["method"] == "GET"
+              and scope["path"].startswith("/api/chat/") and scope["path"].endswith("/events")):
+            await self._timed("/api/chat/<stream_id>/events", self.resume, scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+    
+    async def _timed(self, route: str, handler, scope, receive, send):
+        """Run a route handled here, observing its time to response headers like the Flask hooks"""
+        started = time.perf_counter()
         
-        # Keep last 20 messages for context
-        context_messages = messages[-20:]
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                http_request_seconds.observe(time.perf_counter() - started, scope["method"], route,
+                                             str(message["status"]))
+            await send(message)
         
-        # Prepare Ollama payload with system prompt for concise responses
-        ollama_messages = [
-            {
-                "role": "system",
-                "content": "You are Light, a helpful AI assistant. Keep your responses concise and to the point. Aim for 2-4 sentences unless the user specifically asks for a detailed explanation. Be friendly but brief."
-            }
-        ]
-        ollama_messages.extend([{"role": m["role"], "content": m["content"]} for m in context_messages])
-        
-        payload = {
-            "model": MODEL,
-            "messages": ollama_messages,
-            "stream": True,
-            "options": {
-                "temperature": 0.7,
-                "num_predict": 256  # Shorter responses
-            }
-        }
+        await handler(scope, receive, timed_send)
+    
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if warmup is not None:
+                    warmup.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.client is not None:
+                    await self.client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    
+    def session_email(self, scope):
+        """Read the logged-in email from Flask's signed session cookie"""
+        return (self.session_data(scope) or {}).get("email")
+    
+    def session_data(self, scope):
+        """Flask's session from its signed cookie, or None"""
+        headers = dict(scope["headers"])
+        cookies = parse_cookie(headers.get(b"cookie", b"").decode("latin-1"))
+        cookie = cookies.get(self.flask_app.config["SESSION_COOKIE_NAME"])
+        if not cookie:
+            return None
+        serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+        try:
+            data = serializer.loads(
+                cookie, max_age=int(self.flask_app.permanent_session_lifetime.total_seconds())
+            )
+        except BadSignature:
+            return None
+        return data
+    
+    async def _redirect_login(self, send):
+        logger.warning("Unauthorized access attempt")
+        await send({"type": "http.response.start", "status": 302,
+                    "headers": [(b"location", b"/login")]})
+        await send({"type": "http.response.body", "body": b""})
+    
+    async def _send_json(self, send, status: int, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+    
+    async def chat(self, scope, receive, send):
+        """Async equivalent of the chat() view"""
+        email = self.session_email(scope)
+        if not email:
+            await self._redirect_login(send)
+            return
+        
+        body = b""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
         
-        def generate():
-            """Stream response from Ollama"""
-            full_response = ""
+        try:
+            data = json.loads(body or b"{}")
+            message = data.get("message", "").strip()
+            
+            if not message:
+                await self._send_json(send, 400, {"error": "No message provided"})
+                return
+            
+            key = dict(scope["headers"]).get(b"idempotency-key", b"").decode("latin-1").strip()
+            if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                await self._send_json(send, 400, {"error": "Idempotency key too long"})
+                return
+            
+            logger.info(f"Chat request from {email}: {message[:50]}...")
             
+            preference = (self.session_data(scope) or {}).get("model_preference", "auto")
+            try:
+                stream, created = await asyncio.to_thread(
+                    streams.open, email, key, lambda: create_stream(email, message, preference))
+            except QueueFull as e:
+                logger.warning(f"Rejected chat from {email}: {e}")
+                await send({"type": "http.response.start", "status": 429,
+                            "headers": [(b"content-type", b"application/json"),
+                                        (b"retry-after", str(e.retry_after).encode())]})
+                await send({"type": "http.response.body",
+                            "body": json.dumps({"error": "Server busy, please retry shortly"}).encode()})
+                return
+        except Exception as e:
+            logger.error(f"Chat endpoint error: {e}", exc_info=True)
+            await self._send_json(send, 500, {"error": str(e)})
+            return
+        
+        if created:
+            producer = asyncio.ensure_future(self._produce(stream))
+            self.producers.add(producer)
+            producer.add_done_callback(self.producers.discard)
+        elif stream.turn.user_message["content"] != message:
+            await self._send_json(send, 422, {"error": "Idempotency key was used for a different message"})
+            return
+        else:
+            logger.info(f"Duplicate chat request from {email}, attaching to stream {stream.id}")
+        
+        await self._serve(stream, 0, receive, send)
+    
+    async def resume(self, scope, receive, send):
+        """Async equivalent of the resume_chat() view"""
+        email = self.session_email(scope)
+        if not email:
+            await self._redirect_login(send)
+            return
+        
+        stream = streams.get(scope["path"][len("/api/chat/"):-len("/events")], email)
+        if stream is None:
+            await self._send_json(send, 404, {"error": "Stream not found"})
+            return
+        
+        value = dict(scope["headers"]).get(b"last-event-id", b"").decode("latin-1")
+        if not value:
+            value = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1"))).get("last_event_id", "0")
+        try:
+            after = max(0, int(value))
+        except ValueError:
+            after = 0
+        await self._serve(stream, after, receive, send)
+    
+    async def _serve(self, stream: GenerationStream, after: int, receive, send):
+        """Send the stream's SSE from event id `after` until it ends or the client leaves"""
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                                (b"x-stream-id", stream.id.encode())]})
+        
+        # The producer keeps going if the client disconnects
+        follow = asyncio.ensure_future(self._follow(stream, after, send))
+        disconnect = asyncio.ensure_future(self._wait_disconnect(receive))
+        done, _ = await asyncio.wait({follow, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        if follow in done:
+            disconnect.cancel()
+            await send({"type": "http.response.body", "body": b""})
+        else:
+            follow.cancel()
+    
+    async def _wait_disconnect(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+    
+    async def _follow(self, stream: GenerationStream, after: int, send):
+        async def emit(text):
+            await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+        
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        listener = lambda: loop.call_soon_threadsafe(changed.set)
+        stream.subscribe(listener)
+        stream.attach()
+        try:
+            last_write = time.monotonic()
+            while True:
+                changed.clear()
+                text, after, finished = stream.read(after)
+                if text:
+                    await emit(text)
+                    last_write = time.monotonic()
+                if finished:
+                    return
+                # Content held for coalescing goes out once due, even if Ollama is quiet
+                held = stream.flush_held()
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=1.0 if held is None else min(held, 1.0))
+                except asyncio.TimeoutError:
+                    # Report queue position until a slot toward Ollama frees up
+                    if stream.queued():
+                        await emit(ChatTurn.sse({'queued': True, 'position': stream.position()}))
+                        last_write = time.monotonic()
+                    elif time.monotonic() - last_write >= STREAM_HEARTBEAT_SECONDS:
+                        await emit(": keep-alive\n\n")
+                        last_write = time.monotonic()
+        finally:
+            stream.unsubscribe(listener)
+            stream.detach(STREAM_CANCEL_GRACE)
+    
+    async def _wait_granted(self, ticket: Ticket):
+        """Await a scheduler slot without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        granted = asyncio.Event()
+        ticket.on_grant(lambda: loop.call_soon_threadsafe(granted.set))
+        await granted.wait()
+    
+    async def _mirror(self, stream: GenerationStream) -> bool:
+        """Async equivalent of mirror()"""
+        source = stream.source
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        listener = lambda: loop.call_soon_threadsafe(changed.set)
+        source.subscribe(listener)
+        source.attach()
+        try:
+            while True:
+                changed.clear()
+                _, finished = stream.take_shared()
+                if finished:
+                    return source.turn.done
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            source.unsubscribe(listener)
+            source.detach(STREAM_CANCEL_GRACE)
+    
+    async def _produce(self, stream: GenerationStream):
+        """Generate the reply into the stream, independently of any client"""
+        turn = stream.turn
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        stream.abort = lambda: loop.call_soon_threadsafe(task.cancel)
+        try:
+            if stream.cancelled:
+                return
+            if turn.cached is not None:
+                for chunk in turn.replay():
+                    stream.push(turn.handle, chunk)
+                    if RESPONSE_CACHE_REPLAY_DELAY_MS:
+                        await asyncio.sleep(RESPONSE_CACHE_REPLAY_DELAY_MS / 1000)
+                return
+            
+            if stream.source is not None:
+                if await self._mirror(stream):
+                    return
+                # The generation being mirrored failed or was stopped: run our own
+                logger.info(f"Stream {stream.id} lost its source {stream.source.id}, generating on its own")
+                stream.source = None
+                stream.push(turn.restart)
+                stream.ticket = scheduler.enqueue(stream.email)
+            
+            await self._wait_granted(stream.ticket)
+            
+            backend, response = await self._open(turn)
             try:
-                response = requests.post(
-                    OLLAMA_URL,
-                    json=payload,
-                    stream=True,
-                    timeout=120
-                )
-                
                 if response.status_code != 200:
-                    yield f"data: {json.dumps({'error': f'Ollama error: {response.status_code}'})}\n\n"
+                    stream.append([turn.sse({'error': f'Ollama error: {response.status_code}'})])
                     return
                 
-                for line in response.iter_lines():
-                    if not line:
-                        continue
-                    
-                    try:
-                        chunk_data = json.loads(line)
-                        
-                        if "message" in chunk_data and "content" in chunk_data["message"]:
-                            content = chunk_data["message"]["content"]
-                            if content:
-                                full_response += content
-                                yield f"data: {json.dumps({'content': content})}\n\n"
-                        
-                        if chunk_data.get("done", False):
-                            # Add assistant response to messages
-                            messages.append({
-                                "role": "assistant",
-                                "content": full_response,
-                                "timestamp": datetime.now().isoformat()
-                            })
-                            
-                            # Save updated conversation
-                            storage.update_conversation(email, conv['id'], messages)
-                            
-                            yield f"data: {json.dumps({'done': True})}\n\n"
-                            break
-                    
-                    except json.JSONDecodeError:
-                        continue
-            
-            except Exception as e:
-                logger.error(f"Stream error: {e}", exc_info=True)
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                async for line in response.aiter_lines():
+                    stream.push(turn.feed, line)
+                ollama.record(backend, turn.stats)
+                if router is not None:
+                    router.record(turn.payload["model"], turn.stats)
+            finally:
+                await response.aclose()
+                ollama.release(backend)
         
-        return Response(generate(), mimetype="text/event-stream")
+        except asyncio.CancelledError:
+            if not stream.cancelled:
+                raise
+        except Exception as e:
+            logger.error(f"Stream error: {e}", exc_info=True)
+            stream.append([turn.sse({'error': str(e)})])
+        finally:
+            if stream.cancelled:
+                logger.info(f"Stopped stream {stream.id} ({stream.cancelled}) after {len(turn.full_response)} chars")
+                stream.push(turn.stop)
+            if stream.ticket is not None:
+                stream.ticket.release()
+            stream.finish()
     
-    except Exception as e:
-        logger.error(f"Chat endpoint error: {e}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+    async def _open(self, turn: ChatTurn):
+        """Start the chat request on a backend, failing over on connect errors"""
+        tried = []
+        while True:
+            backend = ollama.acquire(turn.conv['id'], exclude=tried)
+            request = self._client().build_request("POST", backend.client.url("/api/chat"), json=turn.payload)
+            try:
+                response = await self._client().send(request, stream=True)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                ollama.release(backend)
+                ollama.mark_failure(backend, e)
+                tried.append(backend)
+                continue
+            except BaseException:
+                ollama.release(backend)
+                raise
+            ollama.mark_healthy(backend)
+            return backend, response
+
+asgi_app = AsyncChatServer(app) if httpx is not None and WsgiToAsgi is not None else None
+
+# ============================================
+# CLI COMMANDS
+# ============================================
+@app.cli.command("route-eval")
+@click.option("--fast-tps", type=float, help="Tokens/sec to assume for FAST_MODEL (default: observed in history)")
+@click.option("--strong-tps", type=float, help="Tokens/sec to assume for MODEL (default: observed in history)")
+@click.option("--user", "emails", multiple=True, help="Only replay these users (repeatable)")
+def route_eval(fast_tps, strong_tps, emails):
+    """Replay stored conversations through the model router and report the expected latency mix"""
+    if router is None:
+        raise click.UsageError("Set FAST_MODEL (different from MODEL) to evaluate routing")
+    
+    emails = list(emails) or storage.list_users()
+    conversations = [
+        (email, conv['id']) for email in emails for conv in storage.list_conversations(email)
+    ]
+    
+    # Generation speed per model, from Ollama's stats on stored replies
+    observed = {}
+    turns = []
+    for email, conv_id in conversations:
+        messages = storage.load_messages(email, conv_id)
+        for depth, msg in enumerate(messages):
+            stats = msg.get('stats') or {}
+            if msg['role'] == 'assistant' and stats.get('eval_count') and stats.get('eval_duration'):
+                observed.setdefault(msg.get('model', MODEL), []).append(
+                    stats['eval_count'] / (stats['eval_duration'] / 1e9)
+                )
+            if msg['role'] == 'user':
+                reply = messages[depth + 1] if depth + 1 < len(messages) else {}
+                turns.append((msg['content'], depth, reply.get('tokens') or NUM_PREDICT))
+    
+    def median(values):
+        return sorted(values)[len(values) // 2] if values else None
+    
+    tps = {
+        router.fast_model: fast_tps or median(observed.get(router.fast_model, [])),
+        router.strong_model: strong_tps or median(observed.get(router.strong_model, []))
+    }
+    missing = [m for m, t in tps.items() if not t]
+    if missing:
+        raise click.UsageError(f"No observed speed for {', '.join(missing)}; pass --fast-tps/--strong-tps")
+    if not turns:
+        click.echo("No stored user messages to replay")
+        return
+    
+    def percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(p * len(values)))]
+    
+    routed = {m: [] for m in router.models}
+    reasons = {}
+    baseline = []
+    for message, depth, tokens in turns:
+        model, reason = router.choose(message, depth, tps=tps)
+        routed[model].append(tokens / tps[model])
+        reasons[reason] = reasons.get(reason, 0) + 1
+        baseline.append(tokens / tps[router.strong_model])
+    
+    click.echo(f"Replayed {len(turns)} turns from {len(conversations)} conversations of {len(emails)} users")
+    for model, latencies in routed.items():
+        share = len(latencies) / len(turns)
+        line = f"  {model:30s} {len(latencies):6d} turns ({share:6.1%}) at {tps[model]:.1f} tok/s"
+        if latencies:
+            line += f", mean {sum(latencies) / len(latencies):.2f}s, p95 {percentile(latencies, 0.95):.2f}s"
+        click.echo(line)
+    for reason, count in sorted(reasons.items(), key=lambda r: -r[1]):
+        click.echo(f"  {reason:30s} {count:6d}")
+    
+    latencies = [l for values in routed.values() for l in values]
+    click.echo(
+        f"Expected generation time: mean {sum(latencies) / len(latencies):.2f}s, "
+        f"p95 {percentile(latencies, 0.95):.2f}s "
+        f"(all on {router.strong_model}: mean {sum(baseline) / len(baseline):.2f}s, "
+        f"p95 {percentile(baseline, 0.95):.2f}s)"
+    )
 
 # ============================================
 # ERROR HANDLERS
@@ -515,13 +4490,24 @@ if __name__ == "__main__":
     print("="*60 + "\n")
     
     # Test Ollama
-    try:
-        test = requests.get("http://localhost:11434/api/tags", timeout=2)
-        print("[✓] Ollama is running" if test.status_code == 200 else "[!] Ollama issue")
-    except:
-        print("[✗] Ollama not running! Start with: ollama serve")
-    
-    print("\nStarting server on http://127.0.0.1:5050\n")
+    for backend in ollama.backends:
+        try:
+            test = backend.client.tags()
+            print(f"[✓] Ollama is running at {backend.name}" if test.status_code == 200 else f"[!] Ollama issue at {backend.name}")
+        except requests.RequestException:
+            print(f"[✗] Ollama not reachable at {backend.name}! Start with: ollama serve")
     
     host = "0.0.0.0" if os.getenv("PRODUCTION") else "127.0.0.1"
-    app.run(host=host, port=5050, debug=False, threaded=True)
\ No newline at end of file
+    
+    if warmup is not None:
+        warmup.start()
+    
+    if SERVER_MODE == "asgi":
+        if asgi_app is None:
+            raise SystemExit("SERVER_MODE=asgi requires httpx, asgiref and uvicorn (pip install -r requirements.txt)")
+        import uvicorn
+        print("\nStarting async server on http://127.0.0.1:5050\n")
+        uvicorn.run(asgi_app, host=host, port=5050, log_level="info")
+    else:
+        print("\nStarting server on http://127.0.0.1:5050\n")
+        app.run(host=host, port=5050, debug=False, threaded=True)
\ No newline at end of file
@@ -37,9 +37,16 @@ const state = {
   isStreaming: false,
   conversations: [],
   currentStreamReader: null,
-  uploadedFile: null
+  currentStreamId: null,
+  uploadedFile: null,
+  oldestSeq: null,
+  hasMoreMessages: false,
+  isLoadingOlder: false
 };
 
+// How many times a dropped reply stream is resumed before giving up
+const MAX_STREAM_RECONNECTS = 5;
+
 // ============================================
 // WAVEFORM
 // ============================================
@@ -199,6 +206,11 @@ function copyToClipboard(text, button) {
 function stopGeneration() {
   if (state.currentStreamReader) {
     console.log('[STREAM] Stopping generation...');
+    // Tell the server too, so it stops generating (the partial reply is kept)
+    if (state.currentStreamId) {
+      fetch(`/api/chat/${state.currentStreamId}/cancel`, { method: 'POST' })
+        .catch(err => console.warn('[STREAM] Cancel request failed:', err));
+    }
     state.currentStreamReader.cancel();
     state.currentStreamReader = null;
     state.isStreaming = false;
@@ -413,7 +425,8 @@ async function loadActiveConversation() {
     
     console.log('[CONV] Loaded conversation:', state.currentConversation.id);
     
-    // Render existing messages
+    // Render newest page; older pages load on scroll
+    setPaging(state.currentConversation);
     if (state.currentConversation.messages && state.currentConversation.messages.length > 0) {
       renderMessages(state.currentConversation.messages);
     }
@@ -422,6 +435,70 @@ async function loadActiveConversation() {
   }
 }
 
+function setPaging(page) {
+  const messages = page.messages || [];
+  state.oldestSeq = messages.length > 0 ? messages[0].seq : null;
+  state.hasMoreMessages = Boolean(page.has_more);
+}
+
+function createMessageElement(msg) {
+  const div = document.createElement('div');
+  if (msg.role === 'user') {
+    div.className = 'message-bubble user-message';
+    div.textContent = msg.content;
+  } else {
+    div.className = 'message-bubble assistant-message';
+    div.innerHTML = marked.parse(msg.content);
+    addCopyButton(div, msg.content);
+  }
+  return div;
+}
+
+async function loadOlderMessages() {
+  if (!state.hasMoreMessages || state.isLoadingOlder || !state.currentConversation) return;
+  
+  state.isLoadingOlder = true;
+  const convId = state.currentConversation.id;
+  
+  try {
+    const res = await fetch(`/api/conversations/${convId}/messages?before=${state.oldestSeq}`);
+    const page = await res.json();
+    
+    // Conversation switched while loading
+    if (!state.currentConversation || state.currentConversation.id !== convId) return;
+    
+    console.log('[CONV] Loaded', page.messages.length, 'older messages');
+    
+    // Prepend while keeping the viewport anchored on the same message
+    const output = elements.assistantOutput;
+    const previousHeight = output.scrollHeight;
+    const fragment = document.createDocumentFragment();
+    page.messages
+      .filter(msg => msg.role === 'user' || msg.role === 'assistant')
+      .forEach(msg => fragment.appendChild(createMessageElement(msg)));
+    output.insertBefore(fragment, output.firstChild);
+    output.scrollTop += output.scrollHeight - previousHeight;
+    
+    setPaging(page);
+  } catch (err) {
+    console.error('[CONV] Failed to load older messages:', err);
+  } finally {
+    state.isLoadingOlder = false;
+  }
+}
+
+// Older pages otherwise only load on scroll, which can't happen
+// until the messages overflow the output area
+async function fillOutput() {
+  const output = elements.assistantOutput;
+  while (state.hasMoreMessages && !state.isLoadingOlder && output.scrollHeight <= output.clientHeight) {
+    const oldestSeq = state.oldestSeq;
+    await loadOlderMessages();
+    // Stop if the load failed rather than retrying in a tight loop
+    if (state.oldestSeq === oldestSeq) break;
+  }
+}
+
 function renderMessages(messages) {
   // Clear output except welcome message
   const welcome = elements.assistantOutput.querySelector('.welcome-message');
@@ -434,23 +511,15 @@ function renderMessages(messages) {
     return;
   }
   
-  // Render all messages
+  // Render the loaded page
   messages.forEach(msg => {
-    if (msg.role === 'user') {
-      const div = document.createElement('div');
-      div.className = 'message-bubble user-message';
-      div.textContent = msg.content;
-      elements.assistantOutput.appendChild(div);
-    } else if (msg.role === 'assistant') {
-      const div = document.createElement('div');
-      div.className = 'message-bubble assistant-message';
-      div.innerHTML = marked.parse(msg.content);
-      addCopyButton(div, msg.content);
-      elements.assistantOutput.appendChild(div);
+    if (msg.role === 'user' || msg.role === 'assistant') {
+      elements.assistantOutput.appendChild(createMessageElement(msg));
     }
   });
   
   scrollToBottom();
+  fillOutput();
 }
 
 async function createNewChat() {
@@ -458,6 +527,7 @@ async function createNewChat() {
     console.log('[CONV] Creating new conversation...');
     const res = await fetch('/api/conversations/new', { method: 'POST' });
     state.currentConversation = await res.json();
+    setPaging(state.currentConversation);
     
     // Clear UI
     elements.assistantOutput.innerHTML = `
@@ -483,7 +553,8 @@ async function activateConversation(convId) {
     const res = await fetch(`/api/conversations/${convId}/activate`, { method: 'POST' });
     state.currentConversation = await res.json();
     
-    // Render messages
+    // Render newest page of messages
+    setPaging(state.currentConversation);
     renderMessages(state.currentConversation.messages);
     
     // Update list
@@ -521,6 +592,17 @@ async function deleteConversation(event, convId) {
 // ============================================
 // CHAT API
 // ============================================
+
+// Sent with a message so the server runs it once however many times the request arrives
+function newIdempotencyKey() {
+  if (crypto.randomUUID) {
+    return crypto.randomUUID();
+  }
+  // randomUUID is only available in secure contexts
+  return Array.from(crypto.getRandomValues(new Uint8Array(16)),
+    b => b.toString(16).padStart(2, '0')).join('');
+}
+
 async function sendMessage(message) {
   if (!message || !message.trim()) {
     console.error('[CHAT] Empty message received');
@@ -564,13 +646,35 @@ async function sendMessage(message) {
   try {
     console.log('[CHAT] Calling /api/chat endpoint...');
     
-    const response = await fetch('/api/chat', {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json'
-      },
-      body: JSON.stringify(requestBody)
-    });
+    // Retried with the same key if the request fails on the network: a
+    // duplicate that did reach the server attaches to the same reply
+    const idempotencyKey = newIdempotencyKey();
+    let response;
+    for (let attempt = 0; ; attempt++) {
+      try {
+        response = await fetch('/api/chat', {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': idempotencyKey
+          },
+          body: JSON.stringify(requestBody)
+        });
+        break;
+      } catch (err) {
+        if (attempt >= MAX_STREAM_RECONNECTS) {
+          throw err;
+        }
+        console.warn('[CHAT] Request failed, retrying:', err);
+        setStatus('processing', 'Reconnecting...');
+        await new Promise(resolve => setTimeout(resolve, Math.min(1000 * (attempt + 1), 5000)));
+      }
+    }
+    
+    if (response.status === 429) {
+      const retryAfter = response.headers.get('Retry-After');
+      throw new Error(`Light is busy right now. Please try again${retryAfter ? ` in ${retryAfter}s` : ''}.`);
+    }
     
     if (!response.ok) {
       throw new Error(`HTTP ${response.status}: ${response.statusText}`);
@@ -585,82 +689,188 @@ async function sendMessage(message) {
     // Add stop button
     const actionsDiv = addStopButton(messageDiv);
     
-    const reader = response.body.getReader();
-    state.currentStreamReader = reader;
-    
-    const decoder = new TextDecoder();
+    const streamId = response.headers.get('X-Stream-Id');
+    state.currentStreamId = streamId;
     let fullResponse = '';
     let chunkCount = 0;
+    let lastEventId = 0;
+    let finished = false;
+    let stopped = false;
+    let renderFrame = null;
+    
+    // Re-render the markdown at most once per animation frame
+    const render = () => {
+      if (renderFrame !== null) {
+        cancelAnimationFrame(renderFrame);
+        renderFrame = null;
+      }
+      messageDiv.innerHTML = marked.parse(fullResponse);
+      scrollToBottom();
+    };
+    const scheduleRender = () => {
+      if (renderFrame === null) {
+        renderFrame = requestAnimationFrame(render);
+      }
+    };
     
-    try {
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done) {
-          console.log('[CHAT] Stream ended');
-          break;
+    const handleEvent = (data) => {
+      if (data.error) {
+        console.error('[CHAT] Server error:', data.error);
+        showError(data.error);
+        finished = true;
+        return;
+      }
+      
+      if (data.queued) {
+        setStatus('processing', `Queued (position ${data.position})...`);
+      }
+      
+      // Generation was cancelled (Stop here or elsewhere, or the server gave up)
+      if (data.stopped) {
+        finished = true;
+        stopped = true;
+      }
+      
+      // Sent on resume when the events we missed are no longer buffered
+      if (data.snapshot !== undefined) {
+        fullResponse = data.snapshot;
+        scheduleRender();
+      }
+      
+      if (data.content) {
+        if (chunkCount === 0) {
+          setStatus('processing', 'Thinking...');
         }
+        chunkCount++;
+        fullResponse += data.content;
+        scheduleRender();
+      }
+      
+      if (data.done) {
+        finished = true;
+        console.log(`[CHAT] Stream complete. ${chunkCount} chunks, ${fullResponse.length} chars`);
+        render();
+        
+        // Remove stop button, add copy button
+        actionsDiv.remove();
+        addCopyButton(messageDiv, fullResponse);
         
-        const chunk = decoder.decode(value);
-        const lines = chunk.split('\n');
+        setStatus('', 'Ready');
         
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
-            try {
-              const data = JSON.parse(line.slice(6));
-              
-              if (data.error) {
-                console.error('[CHAT] Server error:', data.error);
-                showError(data.error);
-                break;
-              }
-              
-              if (data.content) {
-                chunkCount++;
-                fullResponse += data.content;
-                messageDiv.innerHTML = marked.parse(fullResponse);
-                scrollToBottom();
+        // Clear file after sending
+        if (state.uploadedFile) {
+          removeFile();
+        }
+        
+        // Reload conversations list to update title
+        loadConversations();
+      }
+    };
+    
+    // Read one SSE response until it ends or the connection drops
+    const readStream = async (body) => {
+      const reader = body.getReader();
+      state.currentStreamReader = reader;
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let eventId = null;
+      
+      try {
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) {
+            console.log('[CHAT] Stream ended');
+            break;
+          }
+          
+          // A frame can be split across reads: keep the trailing partial line
+          buffer += decoder.decode(value, { stream: true });
+          const lines = buffer.split('\n');
+          buffer = lines.pop();
+          
+          for (const line of lines) {
+            if (line.startsWith('id: ')) {
+              eventId = parseInt(line.slice(4), 10);
+            } else if (line.startsWith('data: ')) {
+              try {
+                handleEvent(JSON.parse(line.slice(6)));
+              } catch (e) {
+                console.error('[CHAT] Parse error:', e);
               }
-              
-              if (data.done) {
-                console.log(`[CHAT] Stream complete. ${chunkCount} chunks, ${fullResponse.length} chars`);
-                
-                // Remove stop button, add copy button
-                actionsDiv.remove();
-                addCopyButton(messageDiv, fullResponse);
-                
-                setStatus('', 'Ready');
-                
-                // Clear file after sending
-                if (state.uploadedFile) {
-                  removeFile();
-                }
-                
-                // Reload conversations list to update title
-                loadConversations();
+              if (eventId !== null) {
+                lastEventId = eventId;
               }
-            } catch (e) {
-              console.error('[CHAT] Parse error:', e);
+            } else if (line === '') {
+              eventId = null;
             }
           }
         }
+      } catch (err) {
+        console.warn('[CHAT] Stream interrupted:', err);
       }
-    } catch (err) {
-      if (err.name === 'AbortError') {
-        console.log('[CHAT] Stream stopped by user');
-        messageDiv.innerHTML += '<p style="color: #8b5a2b; font-style: italic; margin-top: 8px;">[Generation stopped]</p>';
-        actionsDiv.remove();
-        addCopyButton(messageDiv, fullResponse);
-      } else {
-        throw err;
+    };
+    
+    await readStream(response.body);
+    
+    // The reply keeps generating on the server: reconnect and pick up where we left off
+    let reconnects = 0;
+    while (!finished) {
+      // The Stop button clears the current reader
+      if (state.currentStreamReader === null) {
+        stopped = true;
+        break;
+      }
+      if (!streamId || reconnects >= MAX_STREAM_RECONNECTS) {
+        throw new Error('Connection lost. Please try again.');
+      }
+      
+      reconnects++;
+      setStatus('processing', 'Reconnecting...');
+      await new Promise(resolve => setTimeout(resolve, Math.min(1000 * reconnects, 5000)));
+      if (state.currentStreamReader === null) {
+        continue;
+      }
+      
+      let resumed;
+      try {
+        resumed = await fetch(`/api/chat/${streamId}/events`, {
+          headers: { 'Last-Event-ID': String(lastEventId) }
+        });
+      } catch (err) {
+        console.warn('[CHAT] Reconnect failed:', err);
+        continue;
+      }
+      if (resumed.status === 404) {
+        throw new Error('This reply is no longer available. Please try again.');
+      }
+      if (!resumed.ok) {
+        continue;
+      }
+      
+      console.log(`[CHAT] Resumed stream ${streamId} after event ${lastEventId}`);
+      setStatus('processing', 'Thinking...');
+      const before = lastEventId;
+      await readStream(resumed.body);
+      if (lastEventId > before) {
+        reconnects = 0;
       }
     }
     
+    if (stopped) {
+      console.log('[CHAT] Generation stopped');
+      render();
+      messageDiv.innerHTML += '<p style="color: #8b5a2b; font-style: italic; margin-top: 8px;">[Generation stopped]</p>';
+      actionsDiv.remove();
+      addCopyButton(messageDiv, fullResponse);
+    }
+    
   } catch (error) {
     console.error('[CHAT] Error:', error);
     showError(error.message);
   } finally {
     state.isStreaming = false;
     state.currentStreamReader = null;
+    state.currentStreamId = null;
     setStatus('', 'Ready');
   }
 }
@@ -721,6 +931,13 @@ elements.textInput.addEventListener('keydown', async (e) => {
 // New Chat
 elements.btnNewChat.addEventListener('click', createNewChat);
 
+// Load older messages when scrolled near the top
+elements.assistantOutput.addEventListener('scroll', () => {
+  if (elements.assistantOutput.scrollTop < 100) {
+    loadOlderMessages();
+  }
+});
+
 // Sidebar Toggle
 elements.sidebarToggle.addEventListener('click', () => {
   elements.sidebar.classList.toggle('collapsed');
@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# main creates ./data and starts background work on import: keep it out of the repo
+WORK_DIR = tempfile.mkdtemp(prefix="light-tests-")
+os.chdir(WORK_DIR)
+os.environ.setdefault("WARMUP_ENABLED", "0")
+os.environ.setdefault("METRICS_DIR", "")
+
+
+def pytest_unconfigure(config):
+    # pytest goes back to the starting directory at the end; main's exit-time
+    # writeback flush must still find ./data
+    os.chdir(WORK_DIR)
@@ -0,0 +1,175 @@
+"""A local stand-in for an Ollama server, for tests and benchmarks
+
+Each FakeOllama listens on its own port and streams `tokens` chat chunks
+`delay` seconds apart, after `stall` silent seconds (like a long prompt
+prefill) once the response headers are out. It records the requests it got, how long each
+streamed chat kept generating, and how many were cut off by the client
+closing the connection. Embeddings are hashed bags of words, so texts
+sharing more words are closer.
+"""
+
+import hashlib
+import json
+import math
+import re
+import select
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBED_DIM = 64
+
+
+def embedding(text: str) -> list:
+    """Unit vector of signed word-hash counts; the same words give the same vector"""
+    vec = [0.0] * EMBED_DIM
+    for word in re.findall(r"\w+", text.lower()):
+        h = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+        vec[h % EMBED_DIM] += 1.0 if h >> 63 else -1.0
+    norm = math.sqrt(sum(v * v for v in vec))
+    return [v / norm for v in vec] if norm else vec
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024   # benchmarks open hundreds of streams at once
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up is what the cancel and failover tests are about
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class FakeOllama:
+    def __init__(self, tokens: int = 5, delay: float = 0.0, models=("llama3:latest",), port: int = 0,
+                 stall: float = 0.0):
+        self.tokens = tokens
+        self.delay = delay
+        self.stall = stall
+        self.models = list(models)
+        self.calls = []         # (path, request body or None for GET)
+        self.busy = []          # seconds each streamed chat spent generating
+        self.aborted = 0        # streamed chats the client hung up on
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.server = Server(("127.0.0.1", port), self._handler())
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def chats(self) -> int:
+        return sum(1 for path, _ in self.calls if path == "/api/chat")
+
+    def stop(self):
+        """Stop listening and drop open connections, so clients see it as down"""
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            for conn in list(self.connections):
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with fake.lock:
+                    fake.connections.add(self.connection)
+
+            def finish(self):
+                with fake.lock:
+                    fake.connections.discard(self.connection)
+                super().finish()
+
+            def _json(self, obj, code=200):
+                body = json.dumps(obj).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                fake.calls.append((self.path, None))
+                if self.path in ("/api/tags", "/api/ps"):
+                    self._json({"models": [{"name": m} for m in fake.models]})
+                else:
+                    self._json({}, 404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                fake.calls.append((self.path, body))
+                if self.path == "/api/generate":
+                    return self._json({"done": True, "response": ""})
+                if self.path == "/api/embed":
+                    texts = body.get("input", "")
+                    texts = [texts] if isinstance(texts, str) else texts
+                    return self._json({"embeddings": [embedding(t) for t in texts]})
+                if self.path != "/api/chat":
+                    return self._json({}, 404)
+                if not body.get("stream", True):
+                    return self._json({"message": {"role": "assistant", "content": "summary"}, "done": True,
+                                       "prompt_eval_count": 10, "eval_count": 3})
+                self._stream(body)
+
+            def _stream(self, body):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def write(obj):
+                    data = (json.dumps(obj) + "\n").encode()
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    self.wfile.flush()
+
+                started = time.monotonic()
+                try:
+                    if fake.stall and not self._wait_silently(fake.stall):
+                        raise ConnectionResetError("client hung up while stalled")
+                    for i in range(fake.tokens):
+                        write({"model": body["model"], "done": False,
+                               "message": {"role": "assistant", "content": f"tok{i} "}})
+                        if fake.delay:
+                            time.sleep(fake.delay)
+                    write({"model": body["model"], "done": True, "message": {"role": "assistant", "content": ""},
+                           "eval_count": fake.tokens, "eval_duration": max(1, fake.tokens) * 10_000_000,
+                           "prompt_eval_count": 42, "prompt_eval_duration": 5_000_000,
+                           "load_duration": 1000, "total_duration": 100_000_000})
+                    self.wfile.write(b"0\r\n\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    with fake.lock:
+                        fake.aborted += 1
+                finally:
+                    with fake.lock:
+                        fake.busy.append(time.monotonic() - started)
+
+            def _wait_silently(self, seconds: float) -> bool:
+                """Sleep without writing; False as soon as the client closes the connection"""
+                deadline = time.monotonic() + seconds
+                while time.monotonic() < deadline:
+                    readable, _, _ = select.select([self.connection], [], [], 0.02)
+                    if readable and not self.connection.recv(1, socket.MSG_PEEK):
+                        return False
+                return True
+
+        return Handler
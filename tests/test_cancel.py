@@ -0,0 +1,183 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import main
+from fake_ollama import FakeOllama
+
+TOKENS = 400
+DELAY = 0.02        # a full reply would take 8s
+
+
+@pytest.fixture
+def slow_backend(monkeypatch):
+    fake = FakeOllama(tokens=TOKENS, delay=DELAY)
+    pool = main.OllamaPool([fake.url], probe_interval=3600, connect_retries=0)
+    monkeypatch.setattr(main, "ollama", pool)
+    yield fake
+    fake.stop()
+
+
+def wait_until(predicate, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return predicate()
+
+
+def assert_stopped_upstream_and_stored(fake: FakeOllama, email: str, stream_id: str):
+    # The upstream connection was dropped long before the reply could finish
+    assert wait_until(lambda: fake.aborted == 1)
+    assert fake.busy and max(fake.busy) < TOKENS * DELAY / 2
+
+    stream = main.streams.get(stream_id, email)
+    assert main.persistence.wait_for(email)
+    messages = main.storage.load_messages(email, stream.turn.conv['id'])
+    reply = messages[-1]
+    assert [m["role"] for m in messages[-2:]] == ["user", "assistant"]
+    assert reply["stopped"] is True
+    assert reply["content"].startswith("tok0 ")
+    assert f"tok{TOKENS - 1}" not in reply["content"]
+
+
+def login(client, email: str):
+    with client.session_transaction() as session:
+        session["email"] = email
+        session["name"] = "Test"
+
+
+def read_until(chunks, marker: str) -> str:
+    text = ""
+    for chunk in chunks:
+        text += chunk.decode("utf-8")
+        if marker in text:
+            break
+    return text
+
+
+def test_cancel_stops_upstream_and_keeps_partial_reply(slow_backend):
+    email = "cancel@example.com"
+    client = main.app.test_client()
+    login(client, email)
+
+    response = client.post("/api/chat", json={"message": "Tell me a long story"})
+    stream_id = response.headers["X-Stream-Id"]
+    chunks = response.iter_encoded()
+    read_until(chunks, '"content"')
+
+    cancelled = client.post(f"/api/chat/{stream_id}/cancel")
+    assert cancelled.get_json() == {"success": True, "stopped": True}
+    assert '"stopped": true' in read_until(chunks, '"stopped": true')
+    response.close()
+
+    assert_stopped_upstream_and_stored(slow_backend, email, stream_id)
+
+
+def test_cancel_while_upstream_is_silent(monkeypatch):
+    # Headers sent, then a long prefill: the producer is blocked in a read
+    fake = FakeOllama(tokens=3, stall=6)
+    monkeypatch.setattr(main, "ollama", main.OllamaPool([fake.url], probe_interval=3600, connect_retries=0))
+    # The test client waits for the first body chunk, here a keep-alive
+    monkeypatch.setattr(main, "STREAM_HEARTBEAT_SECONDS", 0)
+    email = "prefill@example.com"
+    client = main.app.test_client()
+    login(client, email)
+    try:
+        response = client.post("/api/chat", json={"message": "Summarize this long document"})
+        stream_id = response.headers["X-Stream-Id"]
+        stream = main.streams.get(stream_id, email)
+        assert wait_until(lambda: stream.abort is not None)
+
+        started = time.monotonic()
+        assert client.post(f"/api/chat/{stream_id}/cancel").get_json()["stopped"] is True
+        assert wait_until(lambda: fake.aborted == 1, timeout=2)
+        assert wait_until(lambda: stream.finished, timeout=2)
+        assert time.monotonic() - started < 2
+        assert '"stopped": true' in read_until(response.iter_encoded(), '"stopped": true')
+        response.close()
+    finally:
+        fake.stop()
+
+
+def test_disconnect_stops_upstream_after_grace(slow_backend, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_CANCEL_GRACE", 0.1)
+    email = "disconnect@example.com"
+    client = main.app.test_client()
+    login(client, email)
+
+    response = client.post("/api/chat", json={"message": "Tell me a long story"})
+    stream_id = response.headers["X-Stream-Id"]
+    read_until(response.iter_encoded(), '"content"')
+    response.close()
+
+    assert_stopped_upstream_and_stored(slow_backend, email, stream_id)
+    assert main.streams.get(stream_id, email).cancelled == "disconnected"
+
+
+async def asgi_chat(email: str, message: str, leave) -> tuple:
+    """POST /api/chat through the ASGI app; `leave(stream_id)` runs after the first token
+
+    It returns True to then disconnect, False to keep reading to the end.
+    Returns (stream id, SSE text received).
+    """
+    cookie = main.app.session_interface.get_signing_serializer(main.app).dumps({"email": email})
+    scope = {"type": "http", "method": "POST", "path": "/api/chat", "query_string": b"",
+             "headers": [(b"cookie", f"session={cookie}".encode()),
+                         (b"content-type", b"application/json")]}
+    incoming = asyncio.Queue()
+    await incoming.put({"type": "http.request", "body": json.dumps({"message": message}).encode()})
+    state = {"id": None, "text": "", "left": False}
+
+    async def send(event):
+        if event["type"] == "http.response.start":
+            state["id"] = dict(event["headers"])[b"x-stream-id"].decode()
+        elif event["type"] == "http.response.body":
+            state["text"] += event.get("body", b"").decode("utf-8")
+            if '"content"' in state["text"] and not state["left"]:
+                state["left"] = True
+                if await asyncio.to_thread(leave, state["id"]):
+                    await incoming.put({"type": "http.disconnect"})
+
+    await main.asgi_app(scope, incoming.get, send)
+    return state["id"], state["text"]
+
+
+def run_asgi(coro):
+    async def main_():
+        try:
+            return await coro
+        finally:
+            # Let the producer task see its cancellation through
+            while main.asgi_app.producers:
+                await asyncio.sleep(0.02)
+            await main.asgi_app.client.aclose()
+    return asyncio.run(main_())
+
+
+@pytest.mark.skipif(main.asgi_app is None, reason="needs httpx and asgiref")
+def test_asgi_cancel_stops_upstream_and_keeps_partial_reply(slow_backend, monkeypatch):
+    monkeypatch.setattr(main.asgi_app, "client", None)
+    email = "asgi-cancel@example.com"
+    client = main.app.test_client()
+    login(client, email)
+
+    def cancel(stream_id):
+        assert client.post(f"/api/chat/{stream_id}/cancel").get_json()["stopped"] is True
+        return False
+
+    stream_id, text = run_asgi(asgi_chat(email, "Tell me a long story", cancel))
+    assert '"stopped": true' in text
+    assert_stopped_upstream_and_stored(slow_backend, email, stream_id)
+
+
+@pytest.mark.skipif(main.asgi_app is None, reason="needs httpx and asgiref")
+def test_asgi_disconnect_stops_upstream_after_grace(slow_backend, monkeypatch):
+    monkeypatch.setattr(main.asgi_app, "client", None)
+    monkeypatch.setattr(main, "STREAM_CANCEL_GRACE", 0.1)
+    email = "asgi-disconnect@example.com"
+
+    stream_id, _ = run_asgi(asgi_chat(email, "Tell me a long story", lambda stream_id: True))
+    assert_stopped_upstream_and_stored(slow_backend, email, stream_id)
+    assert main.streams.get(stream_id, email).cancelled == "disconnected"
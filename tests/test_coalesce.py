@@ -0,0 +1,71 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+import main
+
+COALESCE_MS = 100
+
+
+def content_line(text: str) -> bytes:
+    return json.dumps({"model": "m", "message": {"role": "assistant", "content": text}, "done": False}).encode()
+
+
+@pytest.fixture
+def quiet_stream():
+    """A stream whose first token went out and whose second is held, with nothing more coming"""
+    turn = main.ChatTurn("coalesce@example.com", {"id": "c1"}, {"role": "user", "content": "hi"},
+                         {"model": "m", "messages": []}, coalesce_ms=COALESCE_MS)
+    stream = main.GenerationStream("coalesce@example.com", turn)
+    stream.push(turn.feed, content_line("tok0 "))
+    stream.push(turn.feed, content_line("tok1 "))
+    assert turn.pending
+    yield stream
+    stream.finish()
+
+
+def test_held_content_is_flushed_when_upstream_goes_quiet(quiet_stream, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_HEARTBEAT_SECONDS", 0.5)
+    reader = main.follow(quiet_stream)
+    assert '"tok0 "' in next(reader)
+    started = time.monotonic()
+    # Before, the reader slept until the next chunk, sending keep-alives meanwhile
+    assert '"tok1 "' in next(reader)
+    assert time.monotonic() - started < COALESCE_MS / 1000 + 0.2
+    reader.close()
+
+
+def test_reader_wakes_for_content_held_while_it_waits(quiet_stream):
+    turn = quiet_stream.turn
+    after = quiet_stream.last_id
+    quiet_stream.append([turn.flush()])
+    # The reader is already waiting when the next token gets held
+    threading.Timer(0.05, lambda: quiet_stream.push(turn.feed, content_line("tok2 "))).start()
+    started = time.monotonic()
+    assert quiet_stream.wait(after + 1, timeout=2.0)
+    assert time.monotonic() - started < 0.05 + COALESCE_MS / 1000 + 0.2
+    assert '"tok2 "' in quiet_stream.read(after + 1)[0]
+
+
+@pytest.mark.skipif(main.asgi_app is None, reason="needs httpx and asgiref")
+def test_asgi_flushes_held_content_when_upstream_goes_quiet(quiet_stream):
+    sent = []
+
+    async def send(event):
+        sent.append((time.monotonic(), event["body"].decode("utf-8")))
+
+    async def follow():
+        task = asyncio.ensure_future(main.asgi_app._follow(quiet_stream, 0, send))
+        started = time.monotonic()
+        while not any('"tok1 "' in body for _, body in sent) and time.monotonic() - started < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        return started
+
+    started = asyncio.run(follow())
+    assert '"tok0 "' in sent[0][1]
+    flushed = next(at for at, body in sent if '"tok1 "' in body)
+    assert flushed - started < COALESCE_MS / 1000 + 0.2
@@ -0,0 +1,55 @@
+import json
+import os
+import subprocess
+import sys
+
+import main
+
+
+def other_process(directory, pid: int, families: dict):
+    (directory / f"{pid}.json").write_text(json.dumps(families), encoding="utf-8")
+
+
+def gauge(value, aggregate: str) -> dict:
+    return {"kind": "gauge", "help": "", "labels": ["backend"], "aggregate": aggregate,
+            "samples": [[["http://a"], value]]}
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_gauges_combine_across_processes(tmp_path):
+    registry = main.MetricsRegistry("t_", str(tmp_path))
+    registry.gauge("backend_healthy", "", ("backend",), function=lambda: {("http://a",): 1}, aggregate="max")
+    registry.gauge("backend_in_flight", "", ("backend",), function=lambda: {("http://a",): 2})
+    requests = registry.counter("requests_total", "")
+    requests.inc(amount=3)
+
+    # Another live worker, and one that has exited
+    for pid, healthy, in_flight in ((os.getppid(), 1, 5), (dead_pid(), 1, 7)):
+        other_process(tmp_path, pid, {
+            "t_backend_healthy": gauge(healthy, "max"),
+            "t_backend_in_flight": gauge(in_flight, "sum"),
+            "t_requests_total": {"kind": "counter", "help": "", "labels": [], "samples": [[[], 4]]},
+        })
+
+    families = registry.collect()
+    assert families["t_backend_healthy"]["samples"] == [[["http://a"], 1]]
+    assert families["t_backend_in_flight"]["samples"] == [[["http://a"], 7]]
+    assert families["t_requests_total"]["samples"] == [[[], 11]]
+    assert 't_backend_healthy{backend="http://a"} 1\n' in registry.render()
+
+
+def test_unhealthy_here_healthy_elsewhere_reports_healthy(tmp_path):
+    registry = main.MetricsRegistry("t_", str(tmp_path))
+    registry.gauge("backend_healthy", "", ("backend",), function=lambda: {("http://a",): 0}, aggregate="max")
+    other_process(tmp_path, os.getppid(), {"t_backend_healthy": gauge(1, "max")})
+    assert registry.collect()["t_backend_healthy"]["samples"] == [[["http://a"], 1]]
+
+
+def test_backend_healthy_gauge_is_not_summed():
+    family = next(m for m in main.metrics.metrics if m.name == "light_ollama_backend_healthy")
+    assert family.snapshot()["aggregate"] == "max"
@@ -0,0 +1,123 @@
+import time
+from contextlib import ExitStack
+
+import pytest
+
+import main
+from fake_ollama import FakeOllama
+
+PAYLOAD = {"model": "llama3:latest", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+
+
+@pytest.fixture
+def fakes():
+    servers = [FakeOllama(tokens=3) for _ in range(3)]
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+def make_pool(fakes, **options):
+    options.setdefault("eject_seconds", 30)
+    options.setdefault("probe_interval", 3600)
+    return main.OllamaPool([f.url for f in fakes], connect_timeout=1, read_timeout=5,
+                           connect_retries=0, **options)
+
+
+def chat(pool, key=None) -> str:
+    """Run one streamed chat to completion; the URL of the backend that served it"""
+    with pool.chat(PAYLOAD, key=key) as (backend, response):
+        for _ in response.iter_lines():
+            pass
+    return backend.name
+
+
+def test_routes_to_least_outstanding(fakes):
+    pool = make_pool(fakes)
+    with ExitStack() as stack:
+        served = [stack.enter_context(pool.chat(PAYLOAD))[0] for _ in range(3)]
+        assert len({b.name for b in served}) == 3
+        assert [b.in_flight for b in pool.backends] == [1, 1, 1]
+    assert [f.chats() for f in fakes] == [1, 1, 1]
+    assert [b.in_flight for b in pool.backends] == [0, 0, 0]
+
+
+def test_prefers_faster_backend_on_ties(fakes):
+    pool = make_pool(fakes)
+    pool.record(pool.backends[2], {"eval_count": 100, "eval_duration": 1_000_000_000})
+    pool.record(pool.backends[0], {"eval_count": 10, "eval_duration": 1_000_000_000})
+    assert chat(pool) == fakes[2].url
+
+
+def test_sticky_conversation_keeps_its_backend(fakes):
+    pool = make_pool(fakes)
+    home = chat(pool, key="conv-a")
+    with pool.chat(PAYLOAD) as (busy, _):
+        assert busy.name == home
+        # Still the same backend while it is busier than the others
+        assert all(chat(pool, key="conv-a") == home for _ in range(4))
+    assert sum(f.chats() for f in fakes if f.url == home) == 6
+    assert chat(pool, key="conv-b") == home
+
+
+def test_not_sticky_spreads_load(fakes):
+    pool = make_pool(fakes, sticky=False)
+    with pool.chat(PAYLOAD, key="conv-a") as (first, _):
+        with pool.chat(PAYLOAD, key="conv-a") as (second, _):
+            assert first is not second
+
+
+def test_ejects_unreachable_backend_and_fails_over(fakes):
+    pool = make_pool(fakes)
+    home = chat(pool, key="conv-a")
+    down = next(f for f in fakes if f.url == home)
+    down.stop()
+
+    served = chat(pool, key="conv-a")
+    assert served != home
+    backend = next(b for b in pool.backends if b.name == home)
+    assert not backend.healthy and backend.failures == 1 and backend.last_error
+
+    # The conversation moved, and new traffic avoids the ejected backend
+    for _ in range(4):
+        assert chat(pool) != home
+    assert chat(pool, key="conv-a") == served
+
+
+def test_all_backends_down_raises(fakes):
+    pool = make_pool(fakes)
+    for fake in fakes:
+        fake.stop()
+    with pytest.raises(main.requests.ConnectionError):
+        chat(pool)
+    assert not any(b.healthy for b in pool.backends)
+
+
+def test_reprobes_after_cooldown(fakes):
+    pool = make_pool(fakes, eject_seconds=0.6, probe_interval=0.05)
+    down = fakes[0]
+    port = down.port
+    down.stop()
+    pool.mark_failure(pool.backends[0], ConnectionError("refused"))
+
+    fakes[0] = FakeOllama(tokens=3, port=port)
+    # Back up at once, but not re-probed until the cooldown is over
+    time.sleep(0.3)
+    assert not pool.backends[0].healthy
+
+    deadline = time.monotonic() + 3
+    while not pool.backends[0].healthy and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert pool.backends[0].healthy
+    assert pool.backends[0].last_error is None
+    assert ("/api/tags", None) in fakes[0].calls
+
+
+def test_probe_ejects_backend_that_went_away(fakes):
+    pool = make_pool(fakes, probe_interval=0.05)
+    fakes[1].stop()
+    deadline = time.monotonic() + 3
+    while pool.backends[1].healthy and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not pool.backends[1].healthy
+    assert pool.backends[0].healthy and pool.backends[2].healthy
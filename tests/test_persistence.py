@@ -0,0 +1,49 @@
+import asyncio
+import threading
+import time
+
+import main
+
+
+class SlowStorage:
+    """Batches block until released; inline appends record their thread"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.inline_threads = []
+
+    def append_batch(self, batch):
+        self.release.wait(10)
+
+    def append_messages(self, email, conv_id, messages):
+        self.inline_threads.append(threading.current_thread())
+
+    def sync(self, emails):
+        pass
+
+
+def test_full_queue_does_not_block_event_loop():
+    storage = SlowStorage()
+    persistence = main.PersistenceQueue(storage, maxsize=1, group_window=0)
+    message = [{"role": "user", "content": "hi"}]
+    try:
+        persistence.submit("a@example.com", "c1", message)   # taken by the stuck worker
+        time.sleep(0.1)
+        persistence.submit("a@example.com", "c1", message)   # fills the queue
+
+        async def submit_on_loop():
+            started = time.monotonic()
+            persistence.submit("a@example.com", "c1", message)
+            elapsed = time.monotonic() - started
+            # The inline write runs on the default executor, off the loop thread
+            while not storage.inline_threads:
+                await asyncio.sleep(0.01)
+            return elapsed, threading.current_thread()
+
+        elapsed, loop_thread = asyncio.run(submit_on_loop())
+        assert elapsed < 0.1
+        assert storage.inline_threads[0] is not loop_thread
+    finally:
+        storage.release.set()
+        persistence.close()
+    assert persistence.wait_for("a@example.com", timeout=5)
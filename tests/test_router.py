@@ -0,0 +1,75 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def router():
+    return main.ModelRouter("fast", "strong", ["explain", "how does", "plan", "code"])
+
+
+@pytest.mark.parametrize("message", [
+    "Explain recursion",
+    "Can you make a plan?",
+    "HOW DOES this work",
+    "how   does it\nwork",
+    "review my code: x = 1",
+])
+def test_keywords_match_whole_words(router, message):
+    assert router.features(message, 0)["keyword"]
+
+
+@pytest.mark.parametrize("message", [
+    "Which planet is largest?",
+    "the airplane landed",
+    "barcode scanner",
+    "explained already",
+    "show does it",
+])
+def test_keywords_ignore_substrings(router, message):
+    assert not router.features(message, 0)["keyword"]
+
+
+def test_no_keywords_never_match():
+    assert not main.ModelRouter("fast", "strong", []).features("explain the plan", 0)["keyword"]
+
+
+def test_keyword_in_longer_word_does_not_route_strong(router):
+    # Deep conversation + keyword would be enough for the strong model
+    assert router.choose("what about the planets", 50)[0] == "fast"
+    assert router.choose("what about the plan", 50)[0] == "strong"
+
+
+@pytest.mark.parametrize("message", [
+    "Tell me in detail",
+    "Walk me through it STEP BY STEP",
+    "explain\nfully please",
+    "a detailed answer",
+])
+def test_detail_phrases_match_whole_words(router, message):
+    assert router.choose(message, 0) == ("strong", "asked for detail")
+
+
+@pytest.mark.parametrize("message", [
+    "the undetailed version",
+    "a thoroughbred horse",
+    "stop to elaborated",
+])
+def test_detail_phrases_ignore_substrings(router, message):
+    assert not router.features(message, 0)["detail"]
+
+
+def test_code_fence_counts_toward_strong(router):
+    snippet = "Why is this slow?\n```python\nfor x in xs: pass\n```"
+    assert router.features(snippet, 0)["code"]
+    assert not router.features("inline `code` only", 0)["code"]
+    # A fence alone is one point; with a deep conversation it reaches two
+    assert router.choose("```x = 1```", 0)[0] == "fast"
+    assert router.choose("```x = 1```", 50)[0] == "strong"
+
+
+def test_latency_guard_uses_max_tokens():
+    router = main.ModelRouter("fast", "strong", ["plan"], max_tokens=1000, latency_budget=10)
+    # 1000 tokens at 50 tokens/sec is 20s, over the 10s budget
+    assert router.choose("make a plan", 50, tps={"strong": 50}) == ("fast", "strong model too slow")
+    assert router.choose("make a plan", 50, tps={"strong": 200}) == ("strong", "complex turn")
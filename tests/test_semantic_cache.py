@@ -0,0 +1,114 @@
+import pytest
+
+import main
+from fake_ollama import FakeOllama, embedding
+
+np = pytest.importorskip("numpy")
+
+QUESTION = "What is the capital of France?"
+PARAPHRASE = "What is the capital city of France?"     # cosine 0.93 to QUESTION
+OTHER = "What is the capital of Spain?"                 # cosine 0.83
+
+
+def unit(*values):
+    vec = np.asarray(values, dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+def vec(text: str):
+    return np.asarray(embedding(text), dtype=np.float32)
+
+
+def test_hits_are_scoped_to_the_routed_model():
+    cache = main.SemanticCache("embed", 0.9)
+    cache.put("a@example.com", "strong", unit(1, 0, 0), ["strong answer"], 2)
+
+    assert cache.lookup("a@example.com", "fast", unit(1, 0, 0)) is None
+    hit = cache.lookup("a@example.com", "strong", unit(1, 0, 0))
+    assert hit["chunks"] == ["strong answer"] and hit["model"] == "strong"
+
+
+def test_hit_above_threshold_and_miss_below():
+    cache = main.SemanticCache("embed", 0.9)
+    cache.put("a@example.com", "m", vec(QUESTION), ["Paris."], 2)
+
+    assert cache.lookup("b@example.com", "m", vec(PARAPHRASE))["chunks"] == ["Paris."]
+    assert cache.lookup("b@example.com", "m", vec(OTHER)) is None
+    assert cache.lookup("b@example.com", "m", vec("How do I bake sourdough bread?")) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+@pytest.mark.parametrize("scope, shared", [("user", False), ("global", True)])
+def test_scope(scope, shared):
+    cache = main.SemanticCache("embed", 0.9, scope=scope)
+    cache.put("a@example.com", "m", vec(QUESTION), ["Paris."], 2)
+
+    assert cache.lookup("a@example.com", "m", vec(QUESTION)) is not None
+    assert (cache.lookup("b@example.com", "m", vec(QUESTION)) is not None) == shared
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = main.SemanticCache("embed", 0.9, max_entries=2)
+    questions = [QUESTION, "How do I bake sourdough bread?", "Which planet is largest?"]
+    cache.put("a@example.com", "m", vec(questions[0]), ["0"], 1)
+    cache.put("a@example.com", "m", vec(questions[1]), ["1"], 1)
+    # A hit makes the first entry the most recently used
+    assert cache.lookup("a@example.com", "m", vec(questions[0])) is not None
+    cache.put("a@example.com", "m", vec(questions[2]), ["2"], 1)
+
+    assert cache.lookup("a@example.com", "m", vec(questions[1])) is None
+    assert cache.lookup("a@example.com", "m", vec(questions[0]))["chunks"] == ["0"]
+    assert cache.lookup("a@example.com", "m", vec(questions[2]))["chunks"] == ["2"]
+    assert cache.stats()["entries"] == 2 and cache.stats()["evictions"] == 1
+
+
+def test_lsh_finds_the_same_near_duplicates_as_brute_force():
+    rng = np.random.default_rng(1)
+    dim, count = 64, 3000
+    vectors = rng.standard_normal((count, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    exact = main.VectorIndex(dim, ann_min_size=count + 1)
+    lsh = main.VectorIndex(dim, ann_min_size=0)
+    for i, v in enumerate(vectors):
+        exact.add(i, v)
+        lsh.add(i, v)
+    # Removal moves rows around; both must still agree
+    removed = set(range(0, count, 7))
+    for i in removed:
+        exact.remove(i)
+        lsh.remove(i)
+
+    for i in set(range(1, count, 37)) - removed:
+        query = vectors[i] + 0.02 * rng.standard_normal(dim).astype(np.float32)
+        query /= np.linalg.norm(query)
+        expected = exact.search(query)
+        assert expected[0] == i and expected[1] > 0.95
+        assert lsh.search(query) == pytest.approx(expected)
+
+
+def chat(email: str, message: str) -> list:
+    client = main.app.test_client()
+    with client.session_transaction() as session:
+        session["email"] = email
+        session["name"] = "Test"
+    client.post("/api/chat", json={"message": message}).get_data()
+    assert main.persistence.wait_for(email)
+    conv_id = main.storage.get_active_conversation(email)["id"]
+    return main.storage.load_messages(email, conv_id)
+
+
+def test_chat_answers_paraphrase_from_cache(monkeypatch):
+    fake = FakeOllama(tokens=3)
+    monkeypatch.setattr(main, "ollama", main.OllamaPool([fake.url], probe_interval=3600, connect_retries=0))
+    monkeypatch.setattr(main, "semantic_cache", main.SemanticCache(main.EMBED_MODEL, 0.9))
+    try:
+        first = chat("semantic-1@example.com", QUESTION)
+        paraphrased = chat("semantic-2@example.com", PARAPHRASE)
+        other = chat("semantic-3@example.com", OTHER)
+    finally:
+        fake.stop()
+
+    assert fake.chats() == 2
+    assert paraphrased[-1]["content"] == first[-1]["content"] == "tok0 tok1 tok2 "
+    assert paraphrased[-1]["cached"] is True
+    assert "cached" not in other[-1]
@@ -0,0 +1,122 @@
+"""Hammer one user's storage from many threads and processes"""
+
+import multiprocessing
+import threading
+
+import pytest
+
+import main
+
+EMAIL = "stress@example.com"
+CACHE_MODES = ["writeback", "writethrough", "off"]
+
+
+def make_storage(data_dir, mode):
+    if mode == "sqlite":
+        return main.SQLiteUserStorage(data_dir / "conversations.db")
+    return main.JSONUserStorage(data_dir, cache_mode=mode, flush_interval=0.01)
+
+
+def append_turns(storage, conv_id, worker, turns):
+    for i in range(turns):
+        storage.append_messages(EMAIL, conv_id, [
+            {"role": "user", "content": f"w{worker} q{i}"},
+            {"role": "assistant", "content": f"w{worker} a{i}"},
+        ])
+
+
+def assert_consistent(data_dir, conv_id, expected, mode="off"):
+    # A fresh instance sees only what reached the disk
+    storage = make_storage(data_dir, "sqlite" if mode == "sqlite" else "off")
+    messages = storage.load_messages(EMAIL, conv_id)
+    assert [m["seq"] for m in messages] == list(range(expected))
+    assert storage.get_conversation(EMAIL, conv_id)["message_count"] == expected
+    assert len({m["content"] for m in messages}) == expected
+    # Each turn's two messages stay adjacent
+    for user, assistant in zip(messages[::2], messages[1::2]):
+        assert user["content"].replace(" q", " a") == assistant["content"]
+
+
+@pytest.mark.parametrize("mode", CACHE_MODES + ["sqlite"])
+def test_threads_append_to_one_user(tmp_path, mode):
+    storage = make_storage(tmp_path, mode)
+    conv_id = storage.get_active_conversation(EMAIL)["id"]
+    threads = [threading.Thread(target=append_turns, args=(storage, conv_id, w, 25)) for w in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if mode != "sqlite":
+        storage.flush_all()
+    
+    assert_consistent(tmp_path, conv_id, 16 * 25 * 2, mode)
+
+
+def process_worker(data_dir, mode, conv_id, worker, turns):
+    storage = make_storage(data_dir, mode)
+    threads = [threading.Thread(target=append_turns, args=(storage, conv_id, worker * 10 + t, turns))
+               for t in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if mode != "sqlite":
+        storage.flush_all()
+
+
+@pytest.mark.skipif(main.fcntl is None, reason="cross-process locking needs fcntl")
+@pytest.mark.parametrize("mode", CACHE_MODES + ["sqlite"])
+def test_processes_append_to_one_user(tmp_path, mode):
+    conv_id = make_storage(tmp_path, "sqlite" if mode == "sqlite" else "writethrough").get_active_conversation(EMAIL)["id"]
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=process_worker, args=(tmp_path, mode, conv_id, w, 10)) for w in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    
+    assert_consistent(tmp_path, conv_id, 4 * 4 * 10 * 2, mode)
+
+
+@pytest.mark.skipif(main.fcntl is None, reason="cross-process locking needs fcntl")
+def test_writeback_merges_conversations_created_elsewhere(tmp_path):
+    first = make_storage(tmp_path, "writeback")
+    second = make_storage(tmp_path, "writeback")
+    conv_id = first.get_active_conversation(EMAIL)["id"]
+    first.flush_all()
+    
+    # Both have unflushed changes to the same index
+    append_turns(first, conv_id, 1, 1)
+    second.load_messages(EMAIL, conv_id)
+    append_turns(second, conv_id, 2, 1)
+    new_id = second.create_new_conversation(EMAIL)["id"]
+    first.flush_all()
+    second.flush_all()
+    
+    assert_consistent(tmp_path, conv_id, 4)
+    fresh = make_storage(tmp_path, "off")
+    conversations = {c["id"]: c for c in fresh.list_conversations(EMAIL)}
+    assert set(conversations) == {conv_id, new_id}
+    assert conversations[new_id]["is_active"] and not conversations[conv_id]["is_active"]
+
+
+def open_active(data_dir, mode, results):
+    results.put(make_storage(data_dir, mode).get_active_conversation(EMAIL)["id"])
+
+
+@pytest.mark.parametrize("mode", ["sqlite"])
+def test_first_requests_share_one_active_conversation(tmp_path, mode):
+    make_storage(tmp_path, mode)
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    procs = [ctx.Process(target=open_active, args=(tmp_path, mode, results)) for _ in range(8)]
+    for p in procs:
+        p.start()
+    ids = {results.get(timeout=30) for _ in procs}
+    for p in procs:
+        p.join()
+    
+    assert len(ids) == 1
+    conversations = make_storage(tmp_path, mode).list_conversations(EMAIL)
+    assert [c["id"] for c in conversations if c["is_active"]] == list(ids)
@@ -0,0 +1,37 @@
+"""Summaries of long backlogs are folded in chunks that fit the context window"""
+
+import main
+
+
+def test_long_backlog_is_folded_in_chunks(tmp_path, monkeypatch):
+    storage = main.JSONUserStorage(tmp_path, cache_mode="writethrough")
+    monkeypatch.setattr(main, "storage", storage)
+    email = "sum@example.com"
+    conv_id = storage.get_active_conversation(email)["id"]
+    for i in range(300):
+        content = f"message {i} " + "word " * 200
+        storage.append_messages(email, conv_id, [{"role": "user", "content": content,
+                                                  "tokens": main.estimate_tokens(content)}])
+    
+    folded = []
+    
+    def fold(self, summary_text, messages):
+        transcript = sum(main.message_tokens(m) for m in messages)
+        assert transcript + main.estimate_tokens(summary_text) + self.max_tokens <= main.NUM_CTX
+        folded.append([m["seq"] for m in messages])
+        return f"summary through {messages[-1]['seq']}"
+    
+    monkeypatch.setattr(main.Summarizer, "_fold", fold)
+    main.Summarizer(6, 256).update(email, conv_id, 280)
+    
+    assert len(folded) > 1
+    assert [seq for chunk in folded for seq in chunk] == list(range(280))
+    summary = storage.get_conversation(email, conv_id)["summary"]
+    assert summary["upto_seq"] == 280 and summary["text"] == "summary through 279"
+
+
+def test_oversized_message_is_cut_to_the_budget():
+    messages = [{"role": "user", "content": "x" * 100000, "seq": 0}, {"role": "user", "content": "y", "seq": 1}]
+    chunk, rest = main.Summarizer._take_chunk(messages, 1000)
+    assert len(chunk) == 1 and main.estimate_tokens(chunk[0]["content"]) <= 1000
+    assert rest == messages[1:]
@@ -0,0 +1,84 @@
+import logging
+import time
+from datetime import datetime
+
+import pytest
+
+import main
+from fake_ollama import FakeOllama
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    fake = FakeOllama(models=["llama3:latest", "phi3:mini"])
+    monkeypatch.setattr(main, "ollama", main.OllamaPool([fake.url], probe_interval=3600, connect_retries=0))
+    yield fake
+    fake.stop()
+
+
+def at_hour(monkeypatch, hour: int):
+    class Clock(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime(2026, 10, 15, hour, 30)
+    monkeypatch.setattr(main, "datetime", Clock)
+
+
+@pytest.mark.parametrize("spec, hours", [
+    ("8-18", (8, 18)),
+    ("22-6", (22, 6)),
+    ("0-24", (0, 24)),
+    ("", None),
+])
+def test_parse_hours(spec, hours):
+    assert main.WarmupManager.parse_hours(spec) == hours
+
+
+@pytest.mark.parametrize("spec", ["8to18", "8-", "8-18-20", "25-3", "9-30"])
+def test_parse_hours_warns_on_malformed(spec, caplog):
+    with caplog.at_level(logging.WARNING):
+        assert main.WarmupManager.parse_hours(spec) is None
+    assert "WARMUP_HOURS" in caplog.text
+
+
+@pytest.mark.parametrize("hour, wanted", [(21, False), (22, True), (23, True), (0, True), (5, True), (6, False), (12, False)])
+def test_hours_wrap_past_midnight(monkeypatch, hour, wanted):
+    at_hour(monkeypatch, hour)
+    assert main.WarmupManager(["llama3"], "30m", 3600, hours=(22, 6)).wanted() is wanted
+
+
+@pytest.mark.parametrize("hour, wanted", [(7, False), (8, True), (17, True), (18, False)])
+def test_hours_within_a_day(monkeypatch, hour, wanted):
+    at_hour(monkeypatch, hour)
+    assert main.WarmupManager(["llama3"], "30m", 3600, hours=(8, 18)).wanted() is wanted
+
+
+def test_preloads_only_once_started(backend):
+    warmup = main.WarmupManager(["llama3"], "30m", 3600)
+    time.sleep(0.2)
+    assert not warmup.worker.is_alive()
+    assert not any(path == "/api/generate" for path, _ in backend.calls)
+
+    warmup.start()
+    warmup.start()
+    deadline = time.monotonic() + 3
+    while warmup.stats()["preloads"] < 1 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    preloads = [body for path, body in backend.calls if path == "/api/generate"]
+    assert [(body["model"], body["keep_alive"]) for body in preloads] == [("llama3", "30m")]
+
+
+def test_models_loaded_asks_each_backend_once(backend, monkeypatch):
+    other = FakeOllama(models=["llama3:latest"])
+    try:
+        pool = main.OllamaPool([backend.url, other.url], probe_interval=3600, connect_retries=0)
+        loaded = pool.models_loaded(["llama3", "phi3:mini", "mistral"])
+    finally:
+        other.stop()
+    assert loaded == {
+        "llama3": {backend.url: True, other.url: True},
+        "phi3:mini": {backend.url: True, other.url: False},
+        "mistral": {backend.url: False, other.url: False},
+    }
+    for fake in (backend, other):
+        assert [path for path, _ in fake.calls] == ["/api/ps"]